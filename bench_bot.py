@@ -0,0 +1,312 @@
+"""Офлайн-бенчмарк бота: приложение работает против локального поддельного Bot API.
+
+Пример:
+    python bench_bot.py --users 2000 --updates 20000 --latency 30 --rate-429 0.01 --fail-rate 0.005
+
+Отчет: обновления в секунду, p50/p99 обработки обновления, время рассылки и
+пачки напоминаний, поиск по индексу ежедневных сообщений, память. С --json
+результат печатается одной строкой JSON, чтобы сравнивать прогоны между собой.
+"""
+
+import argparse
+import asyncio
+import itertools
+import json
+import multiprocessing
+import os
+import random
+import resource
+import shutil
+import sys
+import tempfile
+import time
+import tracemalloc
+
+import aiohttp
+from aiohttp import web
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Нагрузочный тест бота с поддельным Bot API")
+    parser.add_argument("--users", type=int, default=500, help="синтетические чаты")
+    parser.add_argument("--notes", type=int, default=20, help="заметок на чат")
+    parser.add_argument("--reminders", type=int, default=3, help="напоминаний на чат")
+    parser.add_argument("--updates", type=int, default=5000, help="входящие обновления")
+    parser.add_argument("--latency", type=float, default=20.0, help="средняя задержка Bot API, мс")
+    parser.add_argument("--rate-429", type=float, default=0.0, help="доля ответов 429")
+    parser.add_argument("--fail-rate", type=float, default=0.0, help="доля ответов 403 (бот заблокирован)")
+    parser.add_argument("--rate", type=float, default=None, help="глобальный лимит отправки, сообщений/с")
+    parser.add_argument("--storage", choices=("sqlite", "memory"), default="sqlite")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--json", action="store_true", help="вывести результат в JSON")
+    return parser.parse_args()
+
+# ========== ПОДДЕЛЬНЫЙ BOT API ==========
+
+class FakeBotAPI:
+    """Локальный сервер, отвечающий как Bot API, с задержкой и внедрением ошибок"""
+
+    def __init__(self, latency, rate_429, fail_rate):
+        self.latency = latency / 1000
+        self.rate_429 = rate_429
+        self.fail_rate = fail_rate
+        self.calls = {}
+        self.errors = {"429": 0, "403": 0}
+        self._message_ids = itertools.count(1)
+
+    async def stats(self, request):
+        return web.json_response({"calls": self.calls, "errors": self.errors})
+
+    async def handle(self, request):
+        method = request.match_info["method"]
+        self.calls[method] = self.calls.get(method, 0) + 1
+        if request.content_type == "application/json":
+            params = await request.json()
+        else:
+            params = dict(await request.post())
+        if self.latency:
+            await asyncio.sleep(random.expovariate(1 / self.latency))
+
+        if method in ("sendMessage", "editMessageText"):
+            if random.random() < self.rate_429:
+                self.errors["429"] += 1
+                return web.json_response({
+                    "ok": False, "error_code": 429, "description": "Too Many Requests: retry after 1",
+                    "parameters": {"retry_after": 1},
+                }, status=429)
+            if random.random() < self.fail_rate:
+                self.errors["403"] += 1
+                return web.json_response({
+                    "ok": False, "error_code": 403, "description": "Forbidden: bot was blocked by the user",
+                }, status=403)
+            return web.json_response({"ok": True, "result": {
+                "message_id": next(self._message_ids),
+                "date": int(time.time()),
+                "chat": {"id": int(params.get("chat_id", 0)), "type": "private"},
+                "text": str(params.get("text", "")),
+            }})
+        if method == "getMe":
+            return web.json_response({"ok": True, "result": {
+                "id": 1, "is_bot": True, "first_name": "Bench", "username": "bench_bot",
+                "can_join_groups": False, "can_read_all_group_messages": False, "supports_inline_queries": False,
+            }})
+        return web.json_response({"ok": True, "result": True})
+
+def serve_fake_api(conn, latency, rate_429, fail_rate, seed):
+    """Точка входа процесса с поддельным API: сервер не делит event loop и GIL с ботом"""
+    random.seed(seed)
+    api = FakeBotAPI(latency, rate_429, fail_rate)
+
+    async def serve():
+        app = web.Application()
+        app.router.add_post("/bot{token}/{method}", api.handle)
+        app.router.add_get("/stats", api.stats)
+        runner = web.AppRunner(app, access_log=None)
+        await runner.setup()
+        await web.TCPSite(runner, "127.0.0.1", 0).start()
+        conn.send(runner.addresses[0][1])
+        await asyncio.Event().wait()
+
+    asyncio.run(serve())
+
+def start_fake_api(args):
+    """Запускает поддельный API в отдельном процессе. Возвращает процесс и адрес сервера"""
+    parent, child = multiprocessing.Pipe()
+    process = multiprocessing.Process(
+        target=serve_fake_api, args=(child, args.latency, args.rate_429, args.fail_rate, args.seed), daemon=True
+    )
+    process.start()
+    return process, f"http://127.0.0.1:{parent.recv()}"
+
+# ========== СИНТЕТИЧЕСКИЕ ДАННЫЕ ==========
+
+WORDS = ("купить", "молоко", "позвонить", "маме", "отчет", "встреча", "спорт", "книга", "врач", "проект")
+
+MESSAGES = (
+    "/start",
+    "/help",
+    "/list_reminders",
+    "/create_note {words}",
+    "/search_notes {word}",
+    "/create_reminder 9 30 {words}",
+    "📝 заметки",
+    "🔔 напоминания",
+    "✍️ хочу интересную фразу",
+    "что-то непонятное",
+)
+
+def random_text(size=4):
+    return " ".join(random.choice(WORDS) for _ in range(size))
+
+def populate(bot, users, notes, reminders):
+    """Заполняет состояние бота синтетическими чатами, заметками и напоминаниями"""
+    chat_ids = [10_000 + i for i in range(users)]
+    tz = bot.BotConfig.TIMEZONE
+    now = time.time()
+    for chat_id in chat_ids:
+        bot.set_daily_enabled(chat_id, True)
+        for _ in range(notes):
+            text = random_text()
+            bot.storage.add_note(chat_id, bot.notes_store.add(chat_id, text), text)
+        for _ in range(reminders):
+            reminder = bot.Reminder(
+                id=next(bot.reminder_ids), hours=random.randrange(24), minutes=random.randrange(60), text=random_text()
+            )
+            reminder.next_fire = bot.compute_next_fire(reminder, now, tz)
+            bot.user_reminders.setdefault(chat_id, []).append(reminder)
+            bot.storage.save_reminder(chat_id, reminder)
+    return chat_ids
+
+def make_update(update_id, chat_id):
+    """Входящее текстовое сообщение в формате Bot API"""
+    text = random.choice(MESSAGES).format(words=random_text(), word=random.choice(WORDS))
+    message = {
+        "message_id": update_id,
+        "date": int(time.time()),
+        "chat": {"id": chat_id, "type": "private"},
+        "from": {"id": chat_id, "is_bot": False, "first_name": "User"},
+        "text": text,
+    }
+    if text.startswith("/"):
+        message["entities"] = [{"type": "bot_command", "offset": 0, "length": len(text.split()[0])}]
+    return {"update_id": update_id, "message": message}
+
+def percentile(values, q):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(q * len(values)))]
+
+# ========== ПРОГОН ==========
+
+async def run_benchmark(bot, args):
+    from telegram import Update
+    from telegram.ext import TypeHandler
+
+    results = {"params": vars(args)}
+    api_process, api_url = start_fake_api(args)
+
+    if args.rate:
+        bot.BotConfig.GLOBAL_RATE_LIMIT = args.rate
+    bot.broadcaster = bot.Broadcaster()
+    # Анти-флуд отключен: бенчмарк измеряет обработку, а не отсечение флуда
+    bot.flood_guard = bot.FloodGuard(1e9, 1e9)
+
+    # Память считаем только на заполнении: трассировка аллокаций сильно замедляет остальные замеры
+    tracemalloc.start()
+    started = time.perf_counter()
+    chat_ids = populate(bot, args.users, args.notes, args.reminders)
+    results["populate_seconds"] = time.perf_counter() - started
+    results["state_memory_mb"] = tracemalloc.get_traced_memory()[0] / 2**20
+    tracemalloc.stop()
+    await bot.storage.flush()
+
+    app = bot.create_application(base_url=f"{api_url}/bot")
+    enqueued = {}
+    latencies = []
+    all_done = asyncio.Event()
+
+    async def mark_done(update, context):
+        latencies.append(time.perf_counter() - enqueued.pop(update.update_id))
+        if len(latencies) == args.updates:
+            all_done.set()
+
+    app.add_handler(TypeHandler(Update, mark_done), group=99)
+    await app.initialize()
+    storage_task = asyncio.create_task(bot.storage.run())
+    await app.start()
+
+    try:
+        # Входящие обновления
+        started = time.perf_counter()
+        for update_id in range(1, args.updates + 1):
+            update = Update.de_json(make_update(update_id, random.choice(chat_ids)), app.bot)
+            enqueued[update_id] = time.perf_counter()
+            await app.update_queue.put(update)
+        await all_done.wait()
+        elapsed = time.perf_counter() - started
+        results["updates_per_second"] = args.updates / elapsed
+        results["update_p50_ms"] = percentile(latencies, 0.50) * 1000
+        results["update_p99_ms"] = percentile(latencies, 0.99) * 1000
+
+        # Утренняя рассылка всем подписчикам
+        started = time.perf_counter()
+        await bot.send_morning_message(app, list(bot.users_for_daily))
+        results["broadcast_seconds"] = time.perf_counter() - started
+        results["broadcast_recipients"] = len(bot.users_for_daily)
+
+        # Одновременное срабатывание всех напоминаний
+        due = [(chat_id, r) for chat_id, reminders in bot.user_reminders.items() for r in reminders]
+        started = time.perf_counter()
+        await asyncio.gather(*(bot.fire_reminder(app, chat_id, r) for chat_id, r in due))
+        results["reminder_burst_seconds"] = time.perf_counter() - started
+        results["reminders_fired"] = len(due)
+
+        # Поиск получателей ежедневных сообщений за сутки минутных тиков
+        first_minute = int(time.time() // 60)
+        started = time.perf_counter()
+        for minute in range(first_minute, first_minute + 1440):
+            bot.daily_index.due(minute)
+        results["daily_index_scan_ms"] = (time.perf_counter() - started) * 1000
+    finally:
+        await app.stop()
+        await app.shutdown()
+        storage_task.cancel()
+        await bot.storage.flush()
+        async with aiohttp.ClientSession() as session:
+            async with session.get(f"{api_url}/stats") as response:
+                stats = await response.json()
+        api_process.terminate()
+
+    results["max_rss_mb"] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+    results["api_calls"] = stats["calls"]
+    results["api_errors"] = stats["errors"]
+    return results
+
+def print_report(results):
+    params = results["params"]
+    print(f"Чатов: {params['users']}, обновлений: {params['updates']}, задержка API: {params['latency']} мс, "
+          f"429: {params['rate_429']:.1%}, 403: {params['fail_rate']:.1%}")
+    print(f"  Заполнение состояния:     {results['populate_seconds']:.2f} с")
+    print(f"  Обновлений в секунду:     {results['updates_per_second']:.0f}")
+    print(f"  Обработка p50 / p99:      {results['update_p50_ms']:.1f} / {results['update_p99_ms']:.1f} мс")
+    print(f"  Рассылка:                 {results['broadcast_seconds']:.2f} с на {results['broadcast_recipients']} чатов")
+    print(f"  Пачка напоминаний:        {results['reminder_burst_seconds']:.2f} с на {results['reminders_fired']}")
+    print(f"  Индекс ежедневных, сутки: {results['daily_index_scan_ms']:.1f} мс")
+    print(f"  Память состояния:         {results['state_memory_mb']:.1f} МБ")
+    print(f"  Max RSS:                  {results['max_rss_mb']:.1f} МБ")
+    print(f"  Вызовы API: {results['api_calls']}, ошибки: {results['api_errors']}")
+
+def main():
+    args = parse_args()
+    random.seed(args.seed)
+    workdir = tempfile.mkdtemp(prefix="bot-bench-")
+    # Окружение должно быть готово до импорта бота: конфигурация читается при импорте
+    os.environ.update({
+        "BOT_TOKEN": "123456:BENCHMARK",
+        "STORAGE_BACKEND": args.storage,
+        "STORAGE_PATH": os.path.join(workdir, "bench.db"),
+        "SHARD_COUNT": "1",
+        "WORKERS": "1",
+        "USE_WEBHOOK": "false",
+        "LOG_LEVEL": os.getenv("LOG_LEVEL", "CRITICAL"),
+    })
+    os.environ.pop("RENDER_URL", None)
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    import bot
+
+    try:
+        bot.load_state()
+        results = asyncio.run(run_benchmark(bot, args))
+    finally:
+        bot.storage.close()
+        bot.log_listener.stop()
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    if args.json:
+        print(json.dumps(results, ensure_ascii=False))
+    else:
+        print_report(results)
+
+if __name__ == "__main__":
+    main()
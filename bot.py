@@ -1,137 +1,2313 @@
-from telegram import Update, ReplyKeyboardMarkup
-from telegram.ext import Application, CommandHandler, MessageHandler, filters, ContextTypes
+# ========== БЫСТРЫЙ ХОЛОДНЫЙ СТАРТ ==========
+# До тяжелых импортов (telegram, aiohttp) поднимаем простейший ответ на health check:
+# на Render порт открывается сразу после пробуждения, а не после полного запуска бота
+import os
+import socket
+import threading
+import time
+
+STARTED = time.perf_counter()
+startup_phases = {}  # фаза запуска -> длительность, с
+_phase_started = STARTED
+
+def mark_startup(phase):
+    """Записывает длительность фазы запуска, прошедшей с предыдущей отметки"""
+    global _phase_started
+    now = time.perf_counter()
+    startup_phases[phase] = round(now - _phase_started, 4)
+    _phase_started = now
+
+class EarlyHealthServer:
+    """Отвечает 200 на / и /health, пока бот запускается; остальное - 503.
+    Закрывается перед запуском основного веб-сервера на том же порту"""
+
+    def __init__(self, port):
+        self._sock = socket.create_server(("0.0.0.0", port))
+        self._sock.settimeout(0.2)
+        self._stopped = False
+        self._thread = threading.Thread(target=self._serve, name="early-health", daemon=True)
+        self._thread.start()
+
+    def _serve(self):
+        while not self._stopped:
+            try:
+                conn, _ = self._sock.accept()
+            except socket.timeout:
+                continue
+            except OSError:
+                return
+            with conn:
+                try:
+                    conn.settimeout(1)
+                    path = conn.recv(1024).split(b"\r\n", 1)[0].split(b" ")[1:2]
+                    status, body = (b"200 OK", b"STARTING") if path in ([b"/"], [b"/health"]) else \
+                        (b"503 Service Unavailable", b"Bot is starting")
+                    conn.sendall(b"HTTP/1.1 %s\r\nContent-Length: %d\r\nConnection: close\r\n\r\n%s"
+                                 % (status, len(body), body))
+                except OSError:
+                    pass
+
+    def close(self):
+        self._stopped = True
+        try:
+            # Будит поток, ждущий в accept(), не дожидаясь таймаута
+            self._sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        self._thread.join()
+        self._sock.close()
+
+early_health = None
+if __name__ == "__main__" and os.getenv('BOT_ROLE', 'all') != 'scheduler':
+    try:
+        early_health = EarlyHealthServer(int(os.getenv('PORT', 10000)))
+    except OSError:
+        pass
+
+from telegram import Update, ReplyKeyboardMarkup, InlineKeyboardButton, InlineKeyboardMarkup
+from telegram.error import BadRequest, Forbidden, RetryAfter, NetworkError, TelegramError
+from telegram.ext import (
+    Application, BaseUpdateProcessor, CallbackQueryHandler, CommandHandler,
+    MessageHandler, TypeHandler, filters, ContextTypes
+)
 import datetime
-import pytz
+import functools
 import random
 import asyncio
-import os
-import requests
-from threading import Thread
-import time
-from flask import Flask
+import bisect
+import collections
+import contextlib
+import copy
+import csv
+from array import array
+import gzip
+import hashlib
+import heapq
+import io
+from collections import OrderedDict
+import itertools
+import json
+import logging
+import logging.handlers
+import math
+import queue
+import re
+import secrets
+import signal
+import sqlite3
+import string
+import sys
+import tempfile
+import aiohttp
+from aiohttp import web
+from zoneinfo import ZoneInfo, ZoneInfoNotFoundError
+
+mark_startup("imports")
 
 # ========== НАСТРОЙКИ ДЛЯ RENDER ==========
 BOT_TOKEN = os.getenv('BOT_TOKEN')
 RENDER_URL = os.getenv('RENDER_URL')
 PORT = int(os.getenv('PORT', 10000))
+STORAGE_BACKEND = os.getenv('STORAGE_BACKEND', 'sqlite')
+STORAGE_PATH = os.getenv('STORAGE_PATH', 'bot.db')
+# Режим webhook: обновления приходят на веб-сервер, а не через long polling
+USE_WEBHOOK = os.getenv('USE_WEBHOOK', '').lower() in ('1', 'true', 'yes')
+WEBHOOK_PATH = os.getenv('WEBHOOK_PATH', '/telegram')
+# Секрет должен совпадать у всех реплик: иначе каждая set_webhook перебивает его у остальных.
+# Без явного значения он выводится из токена бота - одинаково во всех процессах
+WEBHOOK_SECRET = os.getenv('WEBHOOK_SECRET') or hashlib.sha256(f"webhook:{BOT_TOKEN}".encode()).hexdigest()
+# Горизонтальное масштабирование: WORKERS процессов делят чаты на SHARD_COUNT шардов.
+# Обновления принимает процесс с ролью all, процессы с ролью scheduler только рассылают
+WORKERS = int(os.getenv('WORKERS', 1))
+SHARD_COUNT = int(os.getenv('SHARD_COUNT') or (1 if WORKERS <= 1 else WORKERS * 4))
+BOT_ROLE = os.getenv('BOT_ROLE', 'all')
+WORKER_ID = os.getenv('WORKER_ID') or f"{socket.gethostname()}-{os.getpid()}"
+# Каталог с корпусами цитат и стихов
+CONTENT_DIR = os.getenv('CONTENT_DIR', os.path.join(os.path.dirname(os.path.abspath(__file__)), 'content'))
+LOG_LEVEL = os.getenv('LOG_LEVEL', 'INFO').upper()
+# Из строк об успешной отправке в лог попадает только каждая LOG_SAMPLE_RATE-я
+LOG_SAMPLE_RATE = int(os.getenv('LOG_SAMPLE_RATE', 100))
+# Профилирование event loop (медленные колбэки, задержка цикла, CPU обработчиков) - только по запросу
+PROFILE = os.getenv('PROFILE', '').lower() in ('1', 'true', 'yes')
+# Токен для служебных эндпоинтов (/debug/profile, /admin/*); без него они отключены
+ADMIN_TOKEN = os.getenv('ADMIN_TOKEN')
+# Пользователи Telegram, которым доступны /export и /import (через запятую)
+ADMIN_IDS = {int(user_id) for user_id in os.getenv('ADMIN_IDS', '').split(',') if user_id.strip()}
+
+# ========== ЛОГИРОВАНИЕ ==========
+
+class JsonFormatter(logging.Formatter):
+    """Форматирует запись лога как одну строку JSON; поля из extra попадают в нее как есть"""
+
+    RESERVED = set(vars(logging.LogRecord("", 0, "", 0, "", (), None))) | {"message", "asctime"}
+
+    def format(self, record):
+        entry = {
+            "ts": datetime.datetime.fromtimestamp(record.created, datetime.timezone.utc).isoformat(timespec="milliseconds"),
+            "level": record.levelname,
+            "logger": record.name,
+            "msg": record.getMessage(),
+        }
+        for key, value in record.__dict__.items():
+            if key not in self.RESERVED:
+                entry[key] = value
+        if record.exc_info:
+            entry["exc"] = self.formatException(record.exc_info)
+        elif record.exc_text:
+            entry["exc"] = record.exc_text
+        if record.stack_info:
+            entry["stack"] = record.stack_info
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+class RecordQueueHandler(logging.handlers.QueueHandler):
+    """Кладет запись в очередь для потока вывода. Стандартный prepare вклеивает трассировку в msg
+    и стирает exc_info, так что JsonFormatter уже не может вынести ее в поле exc. Здесь сообщение
+    и трассировка форматируются сразу (аргументы и исключение могут измениться, пока запись в очереди),
+    но трассировка остается отдельно, в exc_text"""
+
+    def prepare(self, record):
+        record = copy.copy(record)
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+class SamplingFilter(logging.Filter):
+    """Пропускает каждую rate-ю запись с пометкой sampled, остальные отбрасывает сразу"""
+
+    def __init__(self, rate):
+        super().__init__()
+        self.rate = max(rate, 1)
+        self._seen = {}
+
+    def filter(self, record):
+        if not getattr(record, "sampled", False):
+            return True
+        count = self._seen.get(record.msg, 0) + 1
+        self._seen[record.msg] = count
+        if count % self.rate:
+            return False
+        record.sample_rate = self.rate
+        return True
+
+def setup_logging():
+    """Логи пишутся в очередь, а в stdout их выводит отдельный поток: event loop не ждет ввода-вывода"""
+    log_queue = queue.SimpleQueue()
+    queue_handler = RecordQueueHandler(log_queue)
+    queue_handler.addFilter(SamplingFilter(LOG_SAMPLE_RATE))
+
+    stream_handler = logging.StreamHandler(sys.stdout)
+    stream_handler.setFormatter(JsonFormatter())
+
+    root = logging.getLogger()
+    root.handlers[:] = [queue_handler]
+    root.setLevel(LOG_LEVEL)
+    # httpx пишет строку на каждый запрос к Bot API
+    logging.getLogger("httpx").setLevel(logging.WARNING)
+
+    listener = logging.handlers.QueueListener(log_queue, stream_handler)
+    listener.start()
+    return listener
+
+logger = logging.getLogger("bot")
+log_listener = setup_logging()
+
+# Проверка обязательных переменных
+if not BOT_TOKEN:
+    logger.critical("BOT_TOKEN не установлен! Установите переменную BOT_TOKEN в настройках Render")
+    log_listener.stop()
+    exit(1)
+
+if not RENDER_URL:
+    logger.warning("RENDER_URL не установлен: анти-засыпание недоступно")
+    if USE_WEBHOOK:
+        logger.warning("Режим webhook невозможен без RENDER_URL, будет использован polling")
+
+# Конфигурация бота
+class BotConfig:
+    TIMEZONE = ZoneInfo('Asia/Yekaterinburg')
+    # Лимиты Telegram: ~30 сообщений в секунду на бота и 1 в секунду на чат
+    GLOBAL_RATE_LIMIT = 30
+    PER_CHAT_INTERVAL = 1.0
+    BROADCAST_CONCURRENCY = int(os.getenv('BROADCAST_CONCURRENCY', 20))
+    SEND_RETRIES = 3
+    RETRY_BASE_DELAY = 1.0
+    # Напоминания одного чата, сработавшие в этом окне, уходят одним сообщением
+    COALESCE_WINDOW = 0.5
+    # Сколько хранить недоставленные сообщения
+    DEAD_LETTER_TTL = 7 * 86400
+    # Запись в хранилище пачками: не чаще раза в FLUSH_INTERVAL или по набору FLUSH_BATCH_SIZE операций
+    FLUSH_INTERVAL = 0.5
+    FLUSH_BATCH_SIZE = 500
+    DEFAULT_MORNING_TIME = (9, 0)
+    DEFAULT_EVENING_TIME = (18, 0)
+    # Сколько пропущенных минут догонять, если тик ежедневных сообщений опоздал
+    DAILY_CATCHUP_MINUTES = 30
+    # Параллельная обработка обновлений: всего и в очереди одного чата
+    HANDLER_CONCURRENCY = int(os.getenv('HANDLER_CONCURRENCY', 32))
+    MAX_PENDING_UPDATES_PER_CHAT = 20
+    # Анти-флуд: не больше FLOOD_RATE обновлений в секунду на чат со всплеском до FLOOD_BURST
+    FLOOD_RATE = 1.0
+    FLOOD_BURST = 5
+    # Квоты на данные одного чата
+    MAX_NOTES_PER_CHAT = 500
+    MAX_REMINDERS_PER_CHAT = 50
+    MAX_TEXT_LENGTH = 1000
+    # Наибольший интервал напоминания "каждые N минут"
+    MAX_REMINDER_INTERVAL = 24 * 60
+    # Список заметок выводится страницами; длинные заметки в списке обрезаются,
+    # чтобы страница гарантированно влезала в лимит Telegram (4096 символов)
+    NOTES_PAGE_SIZE = 10
+    NOTE_PREVIEW_LENGTH = 300
+    MAX_SEARCH_RESULTS = 20
+    # Пропущенные за время простоя напоминания: насколько давние догонять и сколько слать за раз
+    REMINDER_CATCHUP_WINDOW = 24 * 60 * 60
+    REMINDER_CATCHUP_BATCH = 100
+    # Пулы готовых текстов: размер и период пересборки (если вариантов больше размера пула)
+    CONTENT_POOL_SIZE = 2000
+    CONTENT_REFILL_INTERVAL = 6 * 3600
+    # Профилирование: порог медленного колбэка, период и число замеров задержки цикла
+    PROFILE_SLOW_CALLBACK = 0.1
+    PROFILE_LAG_INTERVAL = 0.5
+    PROFILE_LAG_SAMPLES = 600
+    PROFILE_SLOW_CALLBACKS_KEPT = 50
+    # Остановка: сколько ждать начатые отправки (Render дает 30 с между SIGTERM и SIGKILL)
+    SHUTDOWN_GRACE = 20
+    # Прерванную рассылку досылаем после перезапуска, только если она не старше этого
+    BROADCAST_RESUME_WINDOW = 3600
+    # Выгрузка и загрузка состояния: записей в одном куске (одна транзакция при загрузке)
+    DUMP_CHUNK_SIZE = 5000
+    # Лимиты Bot API на файлы: отправка ботом и скачивание ботом
+    TELEGRAM_UPLOAD_LIMIT = 50 * 1024 * 1024
+    TELEGRAM_DOWNLOAD_LIMIT = 20 * 1024 * 1024
+    # Аренда шардов: срок аренды и период продления/синхронизации
+    LEASE_TTL = 30
+    SHARD_SYNC_INTERVAL = 5
+
+# ========== ФУНКЦИИ ДЛЯ АНТИ-ЗАСЫПАНИЯ ==========
+
+async def keep_alive_pinger():
+    """Пингет сервер каждые 10 минут чтобы не засыпал на Render"""
+    if not RENDER_URL:
+        logger.warning("Анти-засыпание отключено: RENDER_URL не установлен")
+        return
+        
+    logger.info("Запуск анти-засыпания")
+    # Одна сессия на все пинги: соединение переиспользуется
+    async with aiohttp.ClientSession(timeout=aiohttp.ClientTimeout(total=10)) as session:
+        while True:
+            try:
+                async with session.get(RENDER_URL) as response:
+                    logger.debug("Пинг отправлен", extra={"status": response.status})
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                logger.warning("Ошибка пинга", extra={"error": repr(e)})
+            
+            # Ждем 10 минут (600 секунд)
+            await asyncio.sleep(600)
+
+# ========== ВЕБ-СЕРВЕР ДЛЯ RENDER ==========
+
+BOT_APP_KEY = web.AppKey("bot_app", Application)
+
+async def home(request):
+    current_time = datetime.datetime.now(BotConfig.TIMEZONE).strftime('%Y-%m-%d %H:%M:%S')
+    return web.Response(content_type='text/html', text=f"""
+    <h1>🤖 Telegram Bot Active</h1>
+    <p><strong>Статус:</strong> ✅ Работает нормально</p>
+    <p><strong>Время сервера:</strong> {current_time}</p>
+    <p><strong>Часовой пояс:</strong> Екатеринбург</p>
+    <p><strong>Планировщик:</strong> {len(scheduler)} задач в очереди</p>
+    <hr>
+    <p>Бот от: @Miha5050</p>
+    """)
+
+async def health_check(request):
+    """Эндпоинт для проверки здоровья"""
+    return web.Response(text="OK")
+
+async def metrics_endpoint(request):
+    """Метрики в формате Prometheus"""
+    return web.Response(text=metrics.render(), content_type='text/plain', charset='utf-8')
+
+def bot_running(request):
+    """Веб-сервер поднимается раньше бота: пока load_state в потоке заполняет глобальные переменные,
+    хранилище - пустая заглушка, и обработчикам, которые работают с состоянием, отвечать нечем"""
+    app = request.app.get(BOT_APP_KEY)
+    return app is not None and app.running
+
+async def telegram_webhook(request):
+    """Принимает обновления от Telegram и кладет их в очередь приложения"""
+    if request.headers.get('X-Telegram-Bot-Api-Secret-Token') != WEBHOOK_SECRET:
+        return web.Response(status=403, text="Forbidden")
+    if not bot_running(request):
+        return web.Response(status=503, text="Service Unavailable")
+    app = request.app[BOT_APP_KEY]
+
+    try:
+        data = await request.json()
+        if not isinstance(data, dict):
+            raise ValueError("update должен быть объектом")
+        update = Update.de_json(data, app.bot)
+    except (ValueError, TypeError, KeyError, AttributeError):
+        return web.Response(status=400, text="Bad Request")
+    await app.update_queue.put(update)
+    return web.Response(text="OK")
+
+def is_admin_request(request):
+    """Проверяет заголовок Authorization: Bearer <ADMIN_TOKEN>"""
+    scheme, _, token = request.headers.get('Authorization', '').partition(' ')
+    return scheme.lower() == 'bearer' and secrets.compare_digest(token.encode(), ADMIN_TOKEN.encode())
+
+def admin_only(handler):
+    """Служебный эндпоинт: без ADMIN_TOKEN его как будто нет, без верного токена в запросе - 403"""
+    @functools.wraps(handler)
+    async def wrapper(request):
+        if not ADMIN_TOKEN:
+            raise web.HTTPNotFound()
+        if not is_admin_request(request):
+            return web.Response(status=403, text="Forbidden")
+        return await handler(request)
+    return wrapper
+
+def json_dumps(data):
+    return json.dumps(data, ensure_ascii=False)
+
+@admin_only
+async def debug_profile(request):
+    """Снимок профилировщика event loop"""
+    return web.json_response(profiler.snapshot(), dumps=json_dumps)
+
+@admin_only
+async def admin_export(request):
+    """GET /admin/export?format=ndjson|csv - потоковая выгрузка всего состояния"""
+    if not bot_running(request):
+        return web.Response(status=503, text="Service Unavailable")
+    fmt = request.query.get('format', 'ndjson')
+    if fmt not in DUMP_FORMATS:
+        return web.Response(status=400, text="format: ndjson или csv")
+    response = web.StreamResponse(headers={
+        'Content-Type': DUMP_FORMATS[fmt],
+        'Content-Disposition': f'attachment; filename="{dump_filename(fmt)}"',
+    })
+    response.enable_chunked_encoding()
+    response.enable_compression()
+    await response.prepare(request)
+    async for data in export_dump(fmt):
+        await response.write(data)
+    await response.write_eof()
+    return response
+
+@admin_only
+async def admin_import(request):
+    """POST /admin/import?format=ndjson|csv - загрузка выгрузки из тела запроса (можно в gzip)"""
+    if not bot_running(request):
+        return web.Response(status=503, text="Service Unavailable")
+    fmt = request.query.get('format', 'ndjson')
+    if fmt not in DUMP_FORMATS:
+        return web.Response(status=400, text="format: ndjson или csv")
+    path = temp_path(f".{fmt}")
+    try:
+        # Тело сначала целиком ложится на диск: разбор идет кусками и не зависит от скорости клиента
+        with open(path, 'wb') as file:
+            async for data in request.content.iter_chunked(1 << 20):
+                await asyncio.to_thread(file.write, data)
+        result = await import_dump(request.app[BOT_APP_KEY], path, fmt)
+    except ValueError as error:
+        return web.Response(status=400, text=str(error))
+    finally:
+        os.remove(path)
+    return web.json_response(result, dumps=json_dumps)
+
+def create_web_app(app: Application):
+    """Собирает веб-приложение: страница статуса, health check и webhook"""
+    web_app = web.Application()
+    web_app[BOT_APP_KEY] = app
+    web_app.router.add_get('/', home)
+    web_app.router.add_get('/health', health_check)
+    web_app.router.add_get('/metrics', metrics_endpoint)
+    web_app.router.add_get('/debug/profile', debug_profile)
+    web_app.router.add_get('/admin/export', admin_export)
+    web_app.router.add_post('/admin/import', admin_import)
+    web_app.router.add_post(WEBHOOK_PATH, telegram_webhook)
+    return web_app
+
+async def start_web_server(app: Application):
+    """Запускает веб-сервер для Render в том же event loop, что и бот"""
+    runner = web.AppRunner(create_web_app(app), access_log=None)
+    await runner.setup()
+    await web.TCPSite(runner, '0.0.0.0', PORT).start()
+    logger.info("Веб-сервер запущен", extra={"port": PORT})
+    return runner
+
+# ========== КОНТЕНТ ==========
+
+class ContentCorpus:
+    """Шаблоны текстов и значения для их слотов. Варианты нумеруются от 0 до total - 1:
+    номер раскладывается по основаниям размеров слотов, поэтому любой вариант строится за O(слотов)"""
+
+    def __init__(self, templates, slots):
+        self.templates = templates
+        self.slots = slots
+        self._fields = []
+        self._sizes = []
+        for template in templates:
+            fields = list(dict.fromkeys(name for _, name, _, _ in string.Formatter().parse(template) if name))
+            missing = [name for name in fields if not slots.get(name)]
+            if missing:
+                raise ValueError(f"В шаблоне нет значений для слотов {missing}: {template[:40]!r}")
+            self._fields.append(fields)
+            self._sizes.append(math.prod(len(slots[name]) for name in fields))
+        self.total = sum(self._sizes)
+
+    @classmethod
+    def load(cls, path):
+        with open(path, encoding="utf-8") as f:
+            data = json.load(f)
+        return cls(data["templates"], data.get("slots", {}))
+
+    def render(self, index):
+        for template, fields, size in zip(self.templates, self._fields, self._sizes):
+            if index < size:
+                break
+            index -= size
+        values = {}
+        for name in fields:
+            index, choice = divmod(index, len(self.slots[name]))
+            values[name] = self.slots[name][choice]
+        return template.format(**values)
+
+class ContentPool:
+    """Заранее построенные варианты одного вида текста.
+    Чат получает вариант по своему смещению в пуле, сдвинутому на номер раунда: в одной рассылке
+    у разных чатов разные тексты, а один чат не видит повторов, пока не пройдет весь пул"""
+
+    def __init__(self, corpus, size):
+        self.corpus = corpus
+        self.size = size
+        self.variants = []
+
+    @property
+    def complete(self):
+        """Все возможные варианты уже в пуле - обновлять нечего"""
+        return self.corpus.total <= self.size
+
+    def refill(self):
+        if self.complete:
+            indices = range(self.corpus.total)
+        else:
+            indices = random.sample(range(self.corpus.total), self.size)
+        # Новый список подменяется целиком: читатели никогда не видят пул наполовину построенным
+        self.variants = [self.corpus.render(index) for index in indices]
+
+    def pick(self, chat_id, round_no):
+        return self.variants[(stable_hash(chat_id) + round_no) % len(self.variants)]
+
+class ContentEngine:
+    """Цитаты и стихи: корпуса читаются из CONTENT_DIR один раз, тексты берутся из готовых пулов"""
+
+    # Текст на случай, если файла корпуса нет
+    FALLBACK = {
+        "quotes": "Каждый день — это новый шанс стать лучше!",
+        "poems": "Спасибо за всё! Люблю тебя больше всего на свете!",
+    }
+
+    def __init__(self, directory):
+        self.directory = directory
+        self.pools = {}
+        self._requests = itertools.count()
+
+    def load(self):
+        for kind in self.FALLBACK:
+            self.pool(kind)
+
+    def pool(self, kind):
+        pool = self.pools.get(kind)
+        if pool is None:
+            path = os.path.join(self.directory, f"{kind}.json")
+            try:
+                corpus = ContentCorpus.load(path)
+            except (OSError, ValueError, KeyError) as e:
+                logger.warning("Корпус не загружен, используется запасной текст", extra={"path": path, "error": repr(e)})
+                corpus = ContentCorpus([self.FALLBACK[kind]], {})
+            pool = self.pools[kind] = ContentPool(corpus, BotConfig.CONTENT_POOL_SIZE)
+            pool.refill()
+            logger.info("Корпус загружен", extra={"kind": kind, "variants": corpus.total, "pool": len(pool.variants)})
+        return pool
+
+    def pick(self, kind, chat_id, round_no=None):
+        """Текст для чата. Без round_no - следующий по счетчику запросов (для ответов на кнопки)"""
+        if round_no is None:
+            round_no = next(self._requests)
+        return self.pool(kind).pick(chat_id, round_no)
+
+    async def run(self):
+        """Периодически пересобирает пулы, в которые не помещаются все варианты"""
+        while True:
+            await asyncio.sleep(BotConfig.CONTENT_REFILL_INTERVAL)
+            for kind, pool in list(self.pools.items()):
+                if not pool.complete:
+                    await asyncio.to_thread(pool.refill)
+                    logger.info("Пул текстов обновлен", extra={"kind": kind})
+
+content = ContentEngine(CONTENT_DIR)
+
+def daily_round():
+    """Номер раунда ежедневных рассылок: каждый день чат получает следующий вариант"""
+    return int(time.time() // 86400)
+
+def generate_motivational_quote(chat_id=0, round_no=None):
+    return content.pick("quotes", chat_id, round_no)
+
+def create_poem(chat_id=0, round_no=None):
+    return content.pick("poems", chat_id, round_no)
+
+class Reminder:
+    """Напоминание. В памяти держатся все напоминания всех чатов, поэтому запись
+    компактная: __slots__ вместо словаря и общие (интернированные) строки"""
+
+    __slots__ = ("id", "rule", "hours", "minutes", "interval", "date", "text", "next_fire", "last_fired")
+
+    def __init__(self, id=None, rule="daily", hours=None, minutes=None, interval=None, date=None, text="",
+                 next_fire=None, last_fired=None):
+        self.id = id
+        self.rule = sys.intern(rule)
+        self.hours = hours
+        self.minutes = minutes
+        self.interval = interval
+        self.date = sys.intern(date) if date else None
+        self.text = sys.intern(text)
+        self.next_fire = next_fire
+        self.last_fired = last_fired
+
+def local_timestamp(tz, day, hours, minutes):
+    """Unix timestamp для указанных даты и времени в часовом поясе tz"""
+    return datetime.datetime.combine(day, datetime.time(hours, minutes), tzinfo=tz).timestamp()
+
+def compute_next_fire(reminder, after, tz):
+    """Ближайший момент срабатывания напоминания строго после after (unix timestamp).
+    None - напоминание больше не сработает"""
+    rule = reminder.rule
+    if rule == "every":
+        step = reminder.interval * 60
+        base = reminder.next_fire or after
+        if base > after:
+            return base
+        return base + (int((after - base) // step) + 1) * step
+    if rule == "once":
+        target = local_timestamp(tz, datetime.date.fromisoformat(reminder.date), reminder.hours, reminder.minutes)
+        return target if target > after else None
+
+    day = datetime.datetime.fromtimestamp(after, tz).date()
+    while True:
+        target = local_timestamp(tz, day, reminder.hours, reminder.minutes)
+        if target > after and (rule == "daily" or day.weekday() < 5):
+            return target
+        day += datetime.timedelta(days=1)
+
+def check_schedule(rule, hours, minutes, interval, date):
+    """Проверяет поля расписания напоминания в тех же пределах, что и /create_reminder.
+    Ошибка - ValueError: с такими полями compute_next_fire упадет или уйдет в прошлое"""
+    if rule == "every":
+        if not isinstance(interval, int) or not 1 <= interval <= BotConfig.MAX_REMINDER_INTERVAL:
+            raise ValueError(f"интервал должен быть от 1 до {BotConfig.MAX_REMINDER_INTERVAL} минут: {interval!r}")
+        return
+    if rule not in ("daily", "weekdays", "once"):
+        raise ValueError(f"неизвестное правило {rule!r}")
+    if not (isinstance(hours, int) and 0 <= hours <= 23 and isinstance(minutes, int) and 0 <= minutes <= 59):
+        raise ValueError(f"время вне 0-23 часов и 0-59 минут: {hours!r}:{minutes!r}")
+    if rule == "once":
+        try:
+            datetime.date.fromisoformat(date)
+        except (TypeError, ValueError):
+            raise ValueError(f"неверная дата {date!r}") from None
+
+def describe_schedule(reminder):
+    """Расписание напоминания человеческим языком"""
+    rule = reminder.rule
+    if rule == "every":
+        return f"каждые {reminder.interval} мин"
+    at = f"{reminder.hours:02d}:{reminder.minutes:02d}"
+    if rule == "weekdays":
+        return f"по будням в {at}"
+    if rule == "once":
+        return f"{reminder.date} в {at}"
+    return f"каждый день в {at}"
+
+# ========== МЕТРИКИ ==========
+
+class Metrics:
+    """Минимальный реестр метрик в текстовом формате Prometheus"""
+
+    BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+    def __init__(self):
+        self._meta = {}        # имя -> (тип, описание)
+        self._counters = {}    # (имя, метки) -> значение
+        self._histograms = {}  # (имя, метки) -> [счетчики по корзинам, сумма, количество]
+        self._gauges = {}      # имя -> функция, возвращающая текущее значение
+        self._values = {}      # (имя, метки) -> значение gauge, заданное через set()
+
+    def describe(self, name, kind, help_text):
+        self._meta[name] = (kind, help_text)
+
+    def inc(self, name, value=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        self._counters[key] = self._counters.get(key, 0) + value
+
+    def observe(self, name, value, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        histogram = self._histograms.get(key)
+        if histogram is None:
+            histogram = self._histograms[key] = [[0] * len(self.BUCKETS), 0.0, 0]
+        for i, bound in enumerate(self.BUCKETS):
+            if value <= bound:
+                histogram[0][i] += 1
+        histogram[1] += value
+        histogram[2] += 1
+
+    def gauge(self, name, func, help_text):
+        self.describe(name, "gauge", help_text)
+        self._gauges[name] = func
+
+    def set(self, name, value, **labels):
+        """Значение gauge с метками (для gauge без функции)"""
+        self._values[(name, tuple(sorted(labels.items())))] = value
+
+    @staticmethod
+    def _labels(labels, extra=()):
+        pairs = [*labels, *extra]
+        if not pairs:
+            return ""
+        rendered = []
+        for key, value in pairs:
+            value = str(value).replace('\\', '\\\\').replace('"', '\\"')
+            rendered.append(f'{key}="{value}"')
+        return "{" + ",".join(rendered) + "}"
+
+    def render(self):
+        lines = []
+        for name, (kind, help_text) in self._meta.items():
+            lines.append(f"# HELP {name} {help_text}")
+            lines.append(f"# TYPE {name} {kind}")
+            if kind == "counter":
+                for (metric, labels), value in self._counters.items():
+                    if metric == name:
+                        lines.append(f"{name}{self._labels(labels)} {value}")
+            elif kind == "histogram":
+                for (metric, labels), (buckets, total, count) in self._histograms.items():
+                    if metric != name:
+                        continue
+                    for bound, value in zip(self.BUCKETS, buckets):
+                        lines.append(f"{name}_bucket{self._labels(labels, [('le', bound)])} {value}")
+                    lines.append(f"{name}_bucket{self._labels(labels, [('le', '+Inf')])} {count}")
+                    lines.append(f"{name}_sum{self._labels(labels)} {total}")
+                    lines.append(f"{name}_count{self._labels(labels)} {count}")
+            elif name in self._gauges:
+                lines.append(f"{name} {self._gauges[name]()}")
+            else:
+                for (metric, labels), value in self._values.items():
+                    if metric == name:
+                        lines.append(f"{name}{self._labels(labels)} {value}")
+        return "\n".join(lines) + "\n"
+
+metrics = Metrics()
+metrics.describe("bot_handler_seconds", "histogram", "Время обработки обновления обработчиком")
+metrics.describe("bot_messages_sent_total", "counter", "Отправленные сообщения")
+metrics.describe("bot_messages_failed_total", "counter", "Сообщения, которые не удалось отправить")
+metrics.describe("bot_scheduler_job_seconds", "histogram", "Время выполнения задачи планировщика")
+metrics.describe("bot_reminder_lag_seconds", "histogram", "Опоздание срабатывания задачи относительно плана")
+metrics.describe("bot_updates_dropped_total", "counter", "Обновления, отброшенные из-за переполнения очереди чата")
+metrics.describe("bot_updates_throttled_total", "counter", "Обновления, отброшенные анти-флудом")
+metrics.describe("bot_loop_lag_seconds", "histogram", "Задержка пробуждения event loop (при PROFILE)")
+metrics.describe("bot_slow_callbacks_total", "counter", "Колбэки event loop дольше PROFILE_SLOW_CALLBACK (при PROFILE)")
+metrics.describe("bot_startup_seconds", "gauge", "Длительность фаз запуска процесса")
+metrics.describe("bot_storage_dropped_writes_total", "counter", "Изменения, которые база отвергла и которые отброшены")
+metrics.describe("bot_chats_pruned_total", "counter", "Чаты, отписанные после блокировки бота")
+metrics.describe("bot_reminders_coalesced_total", "counter", "Напоминания, объединенные с другими в одно сообщение")
+
+def timed(handler):
+    """Оборачивает обработчик и пишет время его работы в bot_handler_seconds"""
+    @functools.wraps(handler)
+    async def wrapper(update, context):
+        started = time.perf_counter()
+        try:
+            if profiler.enabled:
+                return await profiler.track("handler", handler.__name__, handler(update, context))
+            return await handler(update, context)
+        finally:
+            metrics.observe("bot_handler_seconds", time.perf_counter() - started, handler=handler.__name__)
+    return wrapper
+
+# ========== ПРОФИЛИРОВАНИЕ ==========
+
+class CpuTimed:
+    """Обертка корутины, считающая процессорное время только ее собственных шагов:
+    пока корутина ждет, CPU других задач в ее счет не попадает"""
+
+    def __init__(self, coro):
+        self._coro = coro
+        self.cpu = 0.0
+
+    def __await__(self):
+        send, value = self._coro.send, None
+        while True:
+            started = time.thread_time()
+            try:
+                future = send(value)
+            except StopIteration as stop:
+                return stop.value
+            finally:
+                self.cpu += time.thread_time() - started
+            try:
+                value = yield future
+                send = self._coro.send
+            except BaseException as error:
+                send, value = self._coro.throw, error
+
+class SlowCallbackHandler(logging.Handler):
+    """Собирает предупреждения asyncio о медленных колбэках (они пишутся в режиме отладки цикла)"""
+
+    def __init__(self, keep):
+        super().__init__(logging.WARNING)
+        self.recent = collections.deque(maxlen=keep)
+        self.count = 0
+
+    def emit(self, record):
+        if not (isinstance(record.msg, str) and record.msg.startswith("Executing ") and len(record.args or ()) == 2):
+            return
+        callback, seconds = record.args
+        self.count += 1
+        self.recent.append({"at": record.created, "callback": str(callback)[:300], "seconds": round(seconds, 3)})
+        metrics.inc("bot_slow_callbacks_total")
+
+class LoopProfiler:
+    """Включается переменной PROFILE: детектор медленных колбэков, замер задержки event loop
+    и процессорное время по обработчикам, задачам планировщика и фазам тика"""
+
+    def __init__(self, enabled):
+        self.enabled = enabled
+        self.started_at = None
+        self._stats = {}  # (группа, имя) -> [вызовы, CPU всего, CPU максимум, время всего]
+        self._lag = collections.deque(maxlen=BotConfig.PROFILE_LAG_SAMPLES)
+        self._slow = SlowCallbackHandler(BotConfig.PROFILE_SLOW_CALLBACKS_KEPT)
+
+    def start(self, loop):
+        if not self.enabled:
+            return
+        self.started_at = time.time()
+        loop.set_debug(True)
+        loop.slow_callback_duration = BotConfig.PROFILE_SLOW_CALLBACK
+        asyncio_logger = logging.getLogger("asyncio")
+        asyncio_logger.setLevel(logging.WARNING)
+        asyncio_logger.addHandler(self._slow)
+        start_background(self._sample_lag(), "profiler-lag")
+        logger.info("Профилирование включено", extra={"slow_callback": BotConfig.PROFILE_SLOW_CALLBACK})
+
+    async def _sample_lag(self):
+        """Насколько позже запланированного просыпается цикл - прямая мера его блокировки"""
+        interval = BotConfig.PROFILE_LAG_INTERVAL
+        while True:
+            expected = time.perf_counter() + interval
+            await asyncio.sleep(interval)
+            lag = max(time.perf_counter() - expected, 0.0)
+            self._lag.append(lag)
+            metrics.observe("bot_loop_lag_seconds", lag)
+
+    def _record(self, group, name, cpu, wall):
+        stats = self._stats.get((group, name))
+        if stats is None:
+            stats = self._stats[(group, name)] = [0, 0.0, 0.0, 0.0]
+        stats[0] += 1
+        stats[1] += cpu
+        stats[2] = max(stats[2], cpu)
+        stats[3] += wall
+
+    async def track(self, group, name, coro):
+        """Выполняет корутину, записывая ее процессорное и полное время"""
+        timed_coro = CpuTimed(coro)
+        started = time.perf_counter()
+        try:
+            return await timed_coro
+        finally:
+            self._record(group, name, timed_coro.cpu, time.perf_counter() - started)
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        """Замер синхронного участка кода (фазы тика планировщика)"""
+        if not self.enabled:
+            yield
+            return
+        cpu, started = time.thread_time(), time.perf_counter()
+        try:
+            yield
+        finally:
+            self._record("phase", name, time.thread_time() - cpu, time.perf_counter() - started)
+
+    def snapshot(self):
+        lag = sorted(self._lag)
+        groups = {}
+        for (group, name), (calls, cpu, cpu_max, wall) in sorted(self._stats.items(), key=lambda item: -item[1][1]):
+            groups.setdefault(group, {})[name] = {
+                "calls": calls,
+                "cpu_seconds": round(cpu, 4),
+                "cpu_avg_ms": round(cpu / calls * 1000, 3),
+                "cpu_max_ms": round(cpu_max * 1000, 3),
+                "wall_seconds": round(wall, 4),
+            }
+        tasks = collections.Counter(
+            getattr(task.get_coro(), "__qualname__", "?") for task in asyncio.all_tasks()
+        )
+        return {
+            "enabled": self.enabled,
+            "uptime": round(time.time() - self.started_at, 1) if self.started_at else None,
+            "loop_lag": {
+                "samples": len(lag),
+                "last": round(self._lag[-1], 4) if lag else None,
+                "avg": round(sum(lag) / len(lag), 4) if lag else None,
+                "p99": round(lag[int(len(lag) * 0.99)], 4) if lag else None,
+                "max": round(lag[-1], 4) if lag else None,
+            },
+            "slow_callbacks": {"count": self._slow.count, "recent": list(self._slow.recent)},
+            "handlers": groups.get("handler", {}),
+            "jobs": groups.get("job", {}),
+            "phases": groups.get("phase", {}),
+            "tasks": dict(tasks.most_common()),
+            "background": sorted(task.get_name() for task in background_tasks),
+        }
+
+profiler = LoopProfiler(PROFILE)
+background_tasks = set()
+
+def start_background(coro, name):
+    """Запускает фоновую задачу: хранит ссылку на нее и пишет в лог, если задача упала"""
+    task = asyncio.get_running_loop().create_task(coro, name=name)
+    background_tasks.add(task)
+    task.add_done_callback(_background_done)
+    return task
+
+def _background_done(task):
+    background_tasks.discard(task)
+    if not task.cancelled() and task.exception() is not None:
+        logger.error("Фоновая задача завершилась с ошибкой", exc_info=task.exception(), extra={"task": task.get_name()})
+
+# ========== ОБРАБОТКА ОБНОВЛЕНИЙ ==========
+
+class FairChatUpdateProcessor(BaseUpdateProcessor):
+    """Обновления одного чата обрабатываются строго по очереди, разных чатов - параллельно.
+    Каждый чат ждет общий слот не более чем одним обновлением, а семафор отдает
+    слоты в порядке очереди, поэтому чаты обслуживаются по кругу и спам одного
+    пользователя не задерживает остальных"""
+
+    def __init__(self, max_concurrent, max_pending_per_chat):
+        # Ограничение базового класса не используем: его слоты занимали бы обновления,
+        # которые еще ждут своей очереди внутри чата
+        super().__init__(max_concurrent_updates=2 ** 31 - 1)
+        self.max_pending_per_chat = max_pending_per_chat
+        self._slots = asyncio.Semaphore(max_concurrent)
+        self._chats = {}  # chat_id -> [замок чата, число обновлений чата в обработке и в очереди]
+
+    async def do_process_update(self, update, coroutine):
+        chat = update.effective_chat if isinstance(update, Update) else None
+        if chat is None:
+            async with self._slots:
+                await coroutine
+            return
+        # Флуд отбрасываем до очереди чата и общего слота: ведро считает частоту прихода обновлений
+        if not flood_guard.allow(chat.id):
+            coroutine.close()
+            metrics.inc("bot_updates_throttled_total")
+            await answer_throttled(update)
+            return
+
+        state = self._chats.get(chat.id)
+        if state is None:
+            state = self._chats[chat.id] = [asyncio.Lock(), 0]
+        if state[1] >= self.max_pending_per_chat:
+            coroutine.close()
+            metrics.inc("bot_updates_dropped_total")
+            return
+
+        state[1] += 1
+        try:
+            async with state[0]:
+                async with self._slots:
+                    await coroutine
+        finally:
+            state[1] -= 1
+            if not state[1]:
+                del self._chats[chat.id]
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        pass
+
+class FloodGuard:
+    """Ведро токенов на каждый чат. Хранит только пару (токены, время), без объектов на чат"""
+
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self._buckets = {}  # chat_id -> (оставшиеся токены, время последнего обновления)
+
+    def allow(self, chat_id):
+        now = time.monotonic()
+        tokens, updated = self._buckets.get(chat_id, (self.burst, now))
+        tokens = min(self.burst, tokens + (now - updated) * self.rate)
+        allowed = tokens >= 1
+        self._buckets[chat_id] = (tokens - 1 if allowed else tokens, now)
+        if len(self._buckets) > 50000:
+            self._prune(now)
+        return allowed
+
+    def _prune(self, now):
+        """Забывает чаты, чьи ведра уже снова полны"""
+        full_after = self.burst / self.rate
+        self._buckets = {cid: b for cid, b in self._buckets.items() if now - b[1] < full_after}
+
+flood_guard = FloodGuard(BotConfig.FLOOD_RATE, BotConfig.FLOOD_BURST)
+
+async def answer_throttled(update: Update):
+    """Отвечает на отброшенное нажатие кнопки, иначе у пользователя так и крутится индикатор загрузки"""
+    if update.callback_query is None:
+        return
+    try:
+        await update.callback_query.answer("⏳ Слишком часто, подождите немного")
+    except TelegramError:
+        pass
+
+async def track_chat(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Стоит перед всеми обработчиками (группа -1): чат, приславший обновление, снова доступен"""
+    chat = update.effective_chat
+    if chat is not None:
+        chat_reachable(context.application, chat.id)
+
+# ========== ПЛАНИРОВЩИК ==========
+
+class ReminderScheduler:
+    """Планировщик на min-heap: спит ровно до ближайшего срабатывания
+    и трогает только те задачи, время которых наступило"""
+
+    def __init__(self):
+        self._heap = []  # (время срабатывания, порядковый номер, ключ задачи, корутина-функция)
+        self._jobs = {}  # ключ задачи -> ее актуальная запись в куче
+        self._counter = itertools.count()
+        self._wakeup = asyncio.Event()
+        self._task = None
+        self._stopping = False
+        self._running = set()  # запущенные задачи: каждая идет своей asyncio-задачей
+
+    def __len__(self):
+        return len(self._jobs)
+
+    def schedule(self, key, fire_at, callback):
+        """Ставит (или переносит) задачу key на момент fire_at"""
+        entry = (fire_at, next(self._counter), key, callback)
+        self._jobs[key] = entry
+        heapq.heappush(self._heap, entry)
+        if self._heap[0] is entry:
+            # Новая задача раньше всех остальных - будим цикл
+            self._wakeup.set()
+
+    def cancel(self, key):
+        """Отменяет задачу. Запись в куче удаляется лениво"""
+        self._jobs.pop(key, None)
+
+    def _peek(self):
+        """Выбрасывает устаревшие записи и возвращает ближайшую актуальную"""
+        while self._heap:
+            entry = self._heap[0]
+            if self._jobs.get(entry[2]) is entry:
+                return entry
+            heapq.heappop(self._heap)
+        return None
+
+    def _pop_due(self, now):
+        """Забирает из кучи все задачи, время которых уже наступило"""
+        due = []
+        while True:
+            head = self._peek()
+            if head is None or head[0] > now:
+                return due
+            heapq.heappop(self._heap)
+            fire_at, _, key, callback = head
+            del self._jobs[key]
+            due.append((fire_at, key, callback))
+
+    async def _run_job(self, fire_at, key, callback):
+        # Ключ - строка ("daily") или сам объект задачи (напоминание)
+        kind = key if isinstance(key, str) else type(key).__name__.lower()
+        metrics.observe("bot_reminder_lag_seconds", time.time() - fire_at, job=kind)
+        started = time.perf_counter()
+        try:
+            if profiler.enabled:
+                await profiler.track("job", kind, callback())
+            else:
+                await callback()
+        except Exception:
+            logger.exception("Ошибка в задаче планировщика", extra={"job": kind})
+        finally:
+            metrics.observe("bot_scheduler_job_seconds", time.perf_counter() - started, job=kind)
+
+    def _start_job(self, fire_at, key, callback):
+        # Долгая задача (рассылка на тысячи чатов) не должна задерживать остальные
+        task = asyncio.get_running_loop().create_task(self._run_job(fire_at, key, callback))
+        self._running.add(task)
+        task.add_done_callback(self._running.discard)
+
+    async def stop(self, timeout):
+        """Перестает запускать новые задачи и ждет уже запущенные не дольше timeout, потом отменяет их"""
+        self._stopping = True
+        self._wakeup.set()
+        if self._task is not None and not self._task.done():
+            await asyncio.wait([self._task])
+        running = set(self._running)
+        if not running:
+            return
+        _, pending = await asyncio.wait(running, timeout=timeout)
+        if pending:
+            logger.warning("Задачи планировщика не успели завершиться, отменяем", extra={"jobs": len(pending)})
+            for task in pending:
+                task.cancel()
+            await asyncio.wait(pending)
+
+    async def run(self):
+        logger.info("Запуск планировщика напоминаний")
+        self._task = asyncio.current_task()
+        while not self._stopping:
+            with profiler.phase("scheduler.pop_due"):
+                due = self._pop_due(time.time())
+            for job in due:
+                self._start_job(*job)
+
+            head = self._peek()
+            timeout = None if head is None else max(head[0] - time.time(), 0)
+            self._wakeup.clear()
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+
+# ========== РАССЫЛКА ==========
+
+class TokenBucket:
+    """Ведро токенов: не больше rate операций в секунду, всплеск до capacity"""
+
+    def __init__(self, rate, capacity=None):
+        self.rate = rate
+        self.capacity = capacity or rate
+        self._tokens = self.capacity
+        self._updated = time.monotonic()
+        self._paused_until = 0.0
+        self._lock = asyncio.Lock()
+
+    def pause(self, seconds):
+        """Останавливает выдачу токенов (например, после RetryAfter)"""
+        self._paused_until = max(self._paused_until, time.monotonic() + seconds)
+
+    async def acquire(self):
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                if now < self._paused_until:
+                    await asyncio.sleep(self._paused_until - now)
+                    continue
+                self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+                self._updated = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                await asyncio.sleep((1 - self._tokens) / self.rate)
+
+def retry_after_seconds(error: RetryAfter):
+    """RetryAfter.retry_after бывает как числом, так и timedelta"""
+    delay = error.retry_after
+    if isinstance(delay, datetime.timedelta):
+        return delay.total_seconds()
+    return float(delay)
+
+class Broadcaster:
+    """Отправка сообщений с учетом глобального и поштучного (на чат) лимитов Telegram"""
+
+    def __init__(self):
+        self.bucket = TokenBucket(BotConfig.GLOBAL_RATE_LIMIT)
+        self._chat_ready = {}  # chat_id -> момент, раньше которого в чат писать нельзя
+        self.in_flight = 0
+        # При остановке рассылки не начинают новые отправки: оставшиеся чаты ждут в контрольной точке
+        self.draining = False
+
+    async def _wait_for_chat(self, chat_id):
+        now = time.monotonic()
+        if len(self._chat_ready) > 10000:
+            self._chat_ready = {cid: t for cid, t in self._chat_ready.items() if t > now}
+        ready = self._chat_ready.get(chat_id, 0.0)
+        self._chat_ready[chat_id] = max(now, ready) + BotConfig.PER_CHAT_INTERVAL
+        if ready > now:
+            await asyncio.sleep(ready - now)
+
+    async def send(self, app: Application, chat_id, text, kind="message", **kwargs):
+        """Отправляет одно сообщение. Недоставленное пишется в журнал недоставленных,
+        а чат, заблокировавший бота, отписывается от ежедневных сообщений"""
+        self.in_flight += 1
+        try:
+            error = await self._send(app, chat_id, text, **kwargs)
+        finally:
+            self.in_flight -= 1
+        if error is None:
+            metrics.inc("bot_messages_sent_total", kind=kind)
+            return True
+
+        metrics.inc("bot_messages_failed_total", kind=kind)
+        logger.warning("Сообщение не доставлено", extra={"chat_id": chat_id, "kind": kind, "error": repr(error)})
+        if isinstance(error, Forbidden) or (isinstance(error, BadRequest) and "chat not found" in error.message.lower()):
+            chat_unreachable(chat_id)
+        storage.add_dead_letter(chat_id, kind, text, repr(error))
+        return False
+
+    async def _send(self, app: Application, chat_id, text, **kwargs):
+        """Отправляет одно сообщение, повторяя попытку при RetryAfter и сетевых ошибках.
+        Возвращает None при успехе или последнюю ошибку"""
+        await self._wait_for_chat(chat_id)
+        error = None
+        for attempt in range(BotConfig.SEND_RETRIES + 1):
+            await self.bucket.acquire()
+            try:
+                await app.bot.send_message(chat_id=chat_id, text=text, **kwargs)
+                return None
+            except RetryAfter as e:
+                delay = retry_after_seconds(e)
+                logger.warning("Лимит Telegram, пауза", extra={"delay": delay})
+                self.bucket.pause(delay)
+                error = e
+            except NetworkError as e:
+                error = e
+                if attempt < BotConfig.SEND_RETRIES:
+                    # Экспоненциальная задержка со случайным разбросом, чтобы повторы не шли волной
+                    await asyncio.sleep(BotConfig.RETRY_BASE_DELAY * 2 ** attempt * random.uniform(0.5, 1.5))
+            except TelegramError as e:
+                return e
+        return error
+
+    async def broadcast(self, app: Application, chat_ids, text, label="Рассылка", kind="broadcast", checkpoint=None):
+        """Рассылает text по всем chat_ids с ограниченной параллельностью и отчетом о прогрессе.
+        text - строка или функция chat_id -> текст. checkpoint - номер сохраненной рассылки
+        (begin_broadcast): обработанные чаты вычеркиваются из нее, а после полной рассылки она удаляется"""
+        chat_ids = list(chat_ids)
+        total = len(chat_ids)
+        step = max(total // 10, 1)
+        started = time.monotonic()
+        done = sent = 0
+        # Фиксированное число отправителей берет чаты из общего итератора: память не растет с числом чатов
+        pending = iter(chat_ids)
+
+        async def deliver():
+            nonlocal done, sent
+            for chat_id in pending:
+                if self.draining:
+                    return
+                ok = await self.send(app, chat_id, text(chat_id) if callable(text) else text, kind=kind)
+                if checkpoint is not None:
+                    storage.broadcast_delivered(checkpoint, chat_id)
+                done += 1
+                sent += ok
+                if done % step == 0 or done == total:
+                    logger.info("Прогресс рассылки", extra={"label": label, "done": done, "total": total, "sent": sent})
+
+        await asyncio.gather(*(deliver() for _ in range(min(BotConfig.BROADCAST_CONCURRENCY, total))))
+        if done < total:
+            logger.warning("Рассылка прервана остановкой", extra={
+                "label": label, "sent": sent, "remaining": total - done, "checkpoint": checkpoint,
+            })
+            return sent, done - sent
+        if checkpoint is not None:
+            storage.finish_broadcast(checkpoint)
+        logger.info("Рассылка завершена", extra={
+            "label": label, "sent": sent, "total": total, "elapsed": round(time.monotonic() - started, 3)
+        })
+        return sent, total - sent
+
+# ========== ХРАНИЛИЩЕ ==========
+
+class Storage:
+    """Хранилище состояния бота. Базовая реализация ничего не сохраняет (только память)"""
+
+    def load(self):
+        """Возвращает сохраненное состояние: reminders, daily_users, chat_settings, settings, next_note_id,
+        недоступные чаты unreachable и прерванные рассылки broadcasts. Заметки загружаются по чатам при первом обращении (load_notes)"""
+        return {
+            "next_note_id": 1, "reminders": {}, "daily_users": set(), "chat_settings": {}, "settings": {},
+            "unreachable": set(), "broadcasts": [],
+        }
+
+    def load_notes(self, chat_id):
+        """Заметки чата [(note_id, текст), ...]"""
+        return []
+
+    def add_note(self, chat_id, note_id, text):
+        pass
+
+    def delete_note(self, note_id):
+        pass
+
+    def save_reminder(self, chat_id, reminder):
+        pass
+
+    def delete_reminder(self, chat_id, reminder_id):
+        pass
+
+    def set_daily(self, chat_id, enabled):
+        pass
+
+    def set_unreachable(self, chat_id, unreachable):
+        pass
+
+    def set_chat_settings(self, chat_id, settings):
+        pass
+
+    def set_setting(self, key, value):
+        pass
+
+    def add_dead_letter(self, chat_id, kind, text, error):
+        pass
+
+    def begin_broadcast(self, broadcast_id, kind, round_no, chat_ids):
+        """Контрольная точка рассылки: ее вид, раунд текстов и еще не обработанные чаты"""
+        pass
+
+    def broadcast_delivered(self, broadcast_id, chat_id):
+        pass
+
+    def finish_broadcast(self, broadcast_id):
+        pass
+
+    def snapshot(self):
+        """Записи всего состояния (см. DUMP_FIELDS). None - состояние есть только в памяти"""
+        return None
+
+    async def bulk_import(self, records):
+        """Пишет разобранные записи выгрузки"""
+        pass
+
+    @property
+    def pending(self):
+        """Число изменений, еще не записанных на диск"""
+        return 0
+
+    async def run(self):
+        pass
+
+    async def flush(self):
+        pass
+
+    def close(self):
+        pass
+
+class SQLiteStorage(Storage):
+    """SQLite в режиме WAL. Изменения копятся в очереди и пишутся одной транзакцией"""
+
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS notes (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            chat_id INTEGER NOT NULL,
+            text TEXT NOT NULL
+        );
+        CREATE INDEX IF NOT EXISTS notes_chat ON notes (chat_id, id);
+        CREATE TABLE IF NOT EXISTS reminders (
+            id INTEGER PRIMARY KEY,
+            chat_id INTEGER NOT NULL,
+            hours INTEGER,
+            minutes INTEGER,
+            text TEXT NOT NULL,
+            rule TEXT NOT NULL DEFAULT 'daily',
+            interval_minutes INTEGER,
+            once_date TEXT,
+            next_fire REAL,
+            last_fired REAL
+        );
+        CREATE INDEX IF NOT EXISTS reminders_chat ON reminders (chat_id, id);
+        CREATE TABLE IF NOT EXISTS daily_users (chat_id INTEGER PRIMARY KEY);
+        CREATE TABLE IF NOT EXISTS unreachable_chats (chat_id INTEGER PRIMARY KEY);
+        CREATE TABLE IF NOT EXISTS chat_settings (
+            chat_id INTEGER PRIMARY KEY,
+            morning_hours INTEGER NOT NULL,
+            morning_minutes INTEGER NOT NULL,
+            evening_hours INTEGER NOT NULL,
+            evening_minutes INTEGER NOT NULL,
+            timezone TEXT NOT NULL
+        );
+        CREATE TABLE IF NOT EXISTS settings (key TEXT PRIMARY KEY, value TEXT NOT NULL);
+        CREATE TABLE IF NOT EXISTS changes (
+            seq INTEGER PRIMARY KEY AUTOINCREMENT,
+            chat_id INTEGER NOT NULL,
+            origin TEXT NOT NULL,
+            at REAL NOT NULL
+        );
+        CREATE TABLE IF NOT EXISTS leases (shard INTEGER PRIMARY KEY, owner TEXT NOT NULL, expires REAL NOT NULL);
+        CREATE TABLE IF NOT EXISTS workers (worker_id TEXT PRIMARY KEY, expires REAL NOT NULL);
+        CREATE TABLE IF NOT EXISTS broadcasts (
+            id TEXT PRIMARY KEY,
+            kind TEXT NOT NULL,
+            round_no INTEGER NOT NULL,
+            created REAL NOT NULL
+        );
+        CREATE TABLE IF NOT EXISTS broadcast_chats (
+            broadcast_id TEXT NOT NULL,
+            chat_id INTEGER NOT NULL,
+            PRIMARY KEY (broadcast_id, chat_id)
+        ) WITHOUT ROWID;
+        CREATE TABLE IF NOT EXISTS dead_letters (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            chat_id INTEGER NOT NULL,
+            kind TEXT NOT NULL,
+            text TEXT NOT NULL,
+            error TEXT NOT NULL,
+            at REAL NOT NULL
+        );
+    """
+
+    def __init__(self, path, track_changes=False):
+        self.path = path
+        # В шардированном режиме каждое изменение чата пишется в журнал changes,
+        # по которому остальные процессы подтягивают изменения своих чатов
+        self.track_changes = track_changes
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.executescript(self.SCHEMA)
+        self._migrate()
+        with self._conn:
+            self._conn.execute("DELETE FROM dead_letters WHERE at < ?", (time.time() - BotConfig.DEAD_LETTER_TTL,))
+            # Слишком старые прерванные рассылки уже неуместны: утро прошло
+            expired = time.time() - BotConfig.BROADCAST_RESUME_WINDOW
+            self._conn.execute(
+                "DELETE FROM broadcast_chats WHERE broadcast_id IN (SELECT id FROM broadcasts WHERE created < ?)",
+                (expired,)
+            )
+            self._conn.execute("DELETE FROM broadcasts WHERE created < ?", (expired,))
+        self._pending = []
+        self._written = set()
+        self._batch_full = asyncio.Event()
+        self._flush_lock = asyncio.Lock()
+        # Отдельное соединение для координации шардов, чтобы не мешать фоновой записи
+        self._coord = sqlite3.connect(path, check_same_thread=False)
+        self._reader = sqlite3.connect(path, check_same_thread=False)
+
+    # Колонки, добавленные после первой версии схемы
+    MIGRATIONS = {
+        "reminders": {
+            "rule": "TEXT NOT NULL DEFAULT 'daily'",
+            "interval_minutes": "INTEGER",
+            "once_date": "TEXT",
+            "next_fire": "REAL",
+            "last_fired": "REAL",
+        },
+    }
+
+    def _migrate(self):
+        for table, columns in self.MIGRATIONS.items():
+            existing = {row[1] for row in self._conn.execute(f"PRAGMA table_info({table})")}
+            for column, definition in columns.items():
+                if column not in existing:
+                    self._conn.execute(f"ALTER TABLE {table} ADD COLUMN {column} {definition}")
+        self._conn.commit()
+
+    def load(self):
+        state = super().load()
+        state["next_note_id"] = self._conn.execute("SELECT COALESCE(MAX(id), 0) + 1 FROM notes").fetchone()[0]
+        self._read_chats(self._conn, state)
+        state["settings"] = {key: json.loads(value) for key, value in self._conn.execute("SELECT key, value FROM settings")}
+        for broadcast_id, kind, round_no, created in self._conn.execute(
+                "SELECT id, kind, round_no, created FROM broadcasts ORDER BY created"):
+            chat_ids = [row[0] for row in self._conn.execute(
+                "SELECT chat_id FROM broadcast_chats WHERE broadcast_id = ?", (broadcast_id,))]
+            if chat_ids:
+                state["broadcasts"].append({"id": broadcast_id, "kind": kind, "round_no": round_no, "chat_ids": chat_ids})
+        return state
+
+    def load_notes(self, chat_id):
+        # Читается из event loop, поэтому через свое соединение, а не через соединение фоновой записи
+        return self._reader.execute("SELECT id, text FROM notes WHERE chat_id = ? ORDER BY id", (chat_id,)).fetchall()
+
+    @staticmethod
+    def _read_chats(conn, state, chat_ids=None):
+        """Читает напоминания, подписки и настройки всех чатов или только chat_ids"""
+        where, params = "", ()
+        if chat_ids is not None:
+            params = tuple(chat_ids)
+            where = f" WHERE chat_id IN ({','.join('?' * len(params))})"
+        for reminder_id, chat_id, hours, minutes, text, rule, interval, date, next_fire, last_fired in conn.execute(
+                "SELECT id, chat_id, hours, minutes, text, rule, interval_minutes, once_date, next_fire, last_fired "
+                f"FROM reminders{where} ORDER BY id", params):
+            state["reminders"].setdefault(chat_id, []).append(Reminder(
+                id=reminder_id, rule=rule, hours=hours, minutes=minutes, interval=interval, date=date,
+                text=text, next_fire=next_fire, last_fired=last_fired,
+            ))
+        state["daily_users"].update(row[0] for row in conn.execute(f"SELECT chat_id FROM daily_users{where}", params))
+        state["unreachable"].update(row[0] for row in conn.execute(f"SELECT chat_id FROM unreachable_chats{where}", params))
+        for chat_id, mh, mm, eh, em, timezone in conn.execute(f"SELECT * FROM chat_settings{where}", params):
+            state["chat_settings"][chat_id] = {"morning": (mh, mm), "evening": (eh, em), "timezone": timezone}
+        return state
+
+    # ----- координация шардов (синхронные методы, вызываются через asyncio.to_thread) -----
+
+    def load_chats(self, chat_ids=None):
+        """Состояние указанных чатов (или всех) в формате load()"""
+        state = Storage.load(self)
+        chat_ids = list(chat_ids) if chat_ids is not None else None
+        if chat_ids is None:
+            return self._read_chats(self._coord, state)
+        for start in range(0, len(chat_ids), 500):
+            self._read_chats(self._coord, state, chat_ids[start:start + 500])
+        return state
+
+    def heartbeat(self, worker_id, ttl):
+        with self._coord:
+            self._coord.execute("INSERT OR REPLACE INTO workers VALUES (?, ?)", (worker_id, time.time() + ttl))
+
+    def live_workers(self):
+        return {row[0] for row in self._coord.execute("SELECT worker_id FROM workers WHERE expires >= ?", (time.time(),))}
+
+    def acquire_lease(self, shard, owner, ttl):
+        """Берет или продлевает аренду шарда. True, если шард принадлежит owner"""
+        now = time.time()
+        with self._coord:
+            cursor = self._coord.execute(
+                "INSERT INTO leases (shard, owner, expires) VALUES (?, ?, ?) "
+                "ON CONFLICT(shard) DO UPDATE SET owner = excluded.owner, expires = excluded.expires "
+                "WHERE leases.owner = excluded.owner OR leases.expires < ?",
+                (shard, owner, now + ttl, now)
+            )
+        return cursor.rowcount == 1
+
+    def release_lease(self, shard, owner):
+        with self._coord:
+            self._coord.execute("DELETE FROM leases WHERE shard = ? AND owner = ?", (shard, owner))
+
+    def last_change(self):
+        return self._coord.execute("SELECT COALESCE(MAX(seq), 0) FROM changes").fetchone()[0]
+
+    def changes_since(self, seq, origin):
+        """Чаты, измененные другими процессами после seq, и номер последнего изменения"""
+        rows = self._coord.execute("SELECT seq, chat_id, origin FROM changes WHERE seq > ? ORDER BY seq", (seq,)).fetchall()
+        if not rows:
+            return seq, set()
+        return rows[-1][0], {chat_id for _, chat_id, row_origin in rows if row_origin != origin}
+
+    def prune_changes(self, older_than):
+        with self._coord:
+            self._coord.execute("DELETE FROM changes WHERE at < ?", (older_than,))
+
+    def claim_reminder(self, reminder_id, expected_next_fire, next_fire, last_fired):
+        """Атомарно переводит напоминание на следующее срабатывание, только если его еще никто не отправил"""
+        with self._coord:
+            cursor = self._coord.execute(
+                "UPDATE reminders SET next_fire = ?, last_fired = ? WHERE id = ? AND next_fire IS ?",
+                (next_fire, last_fired, reminder_id, expected_next_fire)
+            )
+        return cursor.rowcount == 1
+
+    @property
+    def pending(self):
+        return len(self._pending)
+
+    def _write(self, sql, params, chat_id=None):
+        self._pending.append((sql, params))
+        if chat_id is not None and self.track_changes:
+            self._written.add(chat_id)
+            self._pending.append((
+                "INSERT INTO changes (chat_id, origin, at) VALUES (?, ?, ?)", (chat_id, WORKER_ID, time.time())
+            ))
+        if len(self._pending) >= BotConfig.FLUSH_BATCH_SIZE:
+            self._batch_full.set()
+
+    def add_note(self, chat_id, note_id, text):
+        self._write("INSERT INTO notes (id, chat_id, text) VALUES (?, ?, ?)", (note_id, chat_id, text))
+
+    def delete_note(self, note_id):
+        self._write("DELETE FROM notes WHERE id = ?", (note_id,))
+
+    UPSERT_REMINDER = (
+        "INSERT OR REPLACE INTO reminders (id, chat_id, hours, minutes, text, rule, interval_minutes, "
+        "once_date, next_fire, last_fired) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)"
+    )
+    UPSERT_CHAT_SETTINGS = "INSERT OR REPLACE INTO chat_settings VALUES (?, ?, ?, ?, ?, ?)"
+
+    def save_reminder(self, chat_id, reminder):
+        self._write(
+            self.UPSERT_REMINDER,
+            (reminder.id, chat_id, reminder.hours, reminder.minutes, reminder.text, reminder.rule,
+             reminder.interval, reminder.date, reminder.next_fire, reminder.last_fired),
+            chat_id
+        )
+
+    def delete_reminder(self, chat_id, reminder_id):
+        self._write("DELETE FROM reminders WHERE id = ?", (reminder_id,), chat_id)
+
+    def set_daily(self, chat_id, enabled):
+        if enabled:
+            self._write("INSERT OR IGNORE INTO daily_users (chat_id) VALUES (?)", (chat_id,), chat_id)
+        else:
+            self._write("DELETE FROM daily_users WHERE chat_id = ?", (chat_id,), chat_id)
+
+    def set_unreachable(self, chat_id, unreachable):
+        if unreachable:
+            self._write("INSERT OR IGNORE INTO unreachable_chats (chat_id) VALUES (?)", (chat_id,), chat_id)
+        else:
+            self._write("DELETE FROM unreachable_chats WHERE chat_id = ?", (chat_id,), chat_id)
+
+    def set_chat_settings(self, chat_id, settings):
+        self._write(
+            self.UPSERT_CHAT_SETTINGS,
+            (chat_id, *settings["morning"], *settings["evening"], settings["timezone"]),
+            chat_id
+        )
+
+    def set_setting(self, key, value):
+        self._write("INSERT OR REPLACE INTO settings (key, value) VALUES (?, ?)", (key, json.dumps(value)))
+
+    def add_dead_letter(self, chat_id, kind, text, error):
+        self._write(
+            "INSERT INTO dead_letters (chat_id, kind, text, error, at) VALUES (?, ?, ?, ?, ?)",
+            (chat_id, kind, text, error, time.time())
+        )
+
+    def begin_broadcast(self, broadcast_id, kind, round_no, chat_ids):
+        self._write("INSERT INTO broadcasts (id, kind, round_no, created) VALUES (?, ?, ?, ?)",
+                    (broadcast_id, kind, round_no, time.time()))
+        self._write("INSERT OR IGNORE INTO broadcast_chats (broadcast_id, chat_id) VALUES (?, ?)",
+                    [(broadcast_id, chat_id) for chat_id in chat_ids])
+
+    def take_written(self):
+        """Чаты, измененные этим процессом с прошлого вызова (в шардированном режиме)"""
+        written, self._written = self._written, set()
+        return written
+
+    def broadcast_delivered(self, broadcast_id, chat_id):
+        self._write("DELETE FROM broadcast_chats WHERE broadcast_id = ? AND chat_id = ?", (broadcast_id, chat_id))
+
+    def finish_broadcast(self, broadcast_id):
+        # Чаты чужих шардов досылают другие процессы: рассылка удаляется, когда не останется ни одного
+        self._write("DELETE FROM broadcasts WHERE id = ? AND NOT EXISTS "
+                    "(SELECT 1 FROM broadcast_chats WHERE broadcast_id = ?)", (broadcast_id, broadcast_id))
+
+    def _execute(self, batch):
+        for sql, params in batch:
+            # Список параметров - одна операция на много строк
+            if isinstance(params, list):
+                self._conn.executemany(sql, params)
+            else:
+                self._conn.execute(sql, params)
+
+    def _commit(self, batch):
+        with self._conn:
+            self._execute(batch)
+
+    # Основные коды ошибок SQLite, после которых запись стоит повторить:
+    # BUSY, LOCKED (база занята другим процессом), READONLY, IOERR, FULL, CANTOPEN
+    RETRYABLE_ERRORS = {5, 6, 8, 10, 13, 14}
+
+    @classmethod
+    def _retryable(cls, error):
+        code = getattr(error, "sqlite_errorcode", None)
+        if code is None:
+            return isinstance(error, sqlite3.OperationalError)
+        return code & 0xFF in cls.RETRYABLE_ERRORS
+
+    def _commit_each(self, batch):
+        """Пишет пачку одной транзакцией, но каждую операцию в своей точке сохранения: операции,
+        которые база не примет никогда (нарушение ограничений, неверные данные), отбрасываются"""
+        with self._conn:
+            self._conn.execute("BEGIN")
+            for sql, params in batch:
+                self._conn.execute("SAVEPOINT operation")
+                try:
+                    self._execute([(sql, params)])
+                except sqlite3.Error as error:
+                    if self._retryable(error):
+                        raise
+                    self._conn.execute("ROLLBACK TO operation")
+                    metrics.inc("bot_storage_dropped_writes_total")
+                    logger.error("Изменение отвергнуто базой и отброшено", extra={"sql": sql, "error": str(error)})
+                self._conn.execute("RELEASE operation")
+
+    def _write_batch(self, batch):
+        """Пишет пачку. Временная ошибка пробрасывается, и ничего из пачки не записано;
+        если же пачку отвергла невыполнимая операция, остальные пишутся без нее"""
+        try:
+            self._commit(batch)
+        except sqlite3.Error as error:
+            if self._retryable(error):
+                raise
+            self._commit_each(batch)
+
+    def snapshot(self):
+        # Отдельное соединение с открытой транзакцией чтения: WAL держит для него срез базы
+        # на момент первого SELECT, а фоновая запись тем временем продолжается
+        conn = sqlite3.connect(self.path, check_same_thread=False)
+        try:
+            conn.execute("BEGIN")
+            conn.execute("SELECT COUNT(*) FROM settings").fetchone()
+            for chat_id, note_id, text in conn.execute("SELECT chat_id, id, text FROM notes ORDER BY id"):
+                yield {"type": "note", "chat_id": chat_id, "id": note_id, "text": text}
+            # Колонки в порядке Reminder.__slots__
+            for chat_id, *fields in conn.execute(
+                    "SELECT chat_id, id, rule, hours, minutes, interval_minutes, once_date, text, next_fire, last_fired "
+                    "FROM reminders ORDER BY id"):
+                yield {"type": "reminder", "chat_id": chat_id, **dict(zip(Reminder.__slots__, fields))}
+            for (chat_id,) in conn.execute("SELECT chat_id FROM daily_users ORDER BY chat_id"):
+                yield {"type": "subscriber", "chat_id": chat_id}
+            for chat_id, mh, mm, eh, em, timezone in conn.execute("SELECT * FROM chat_settings ORDER BY chat_id"):
+                yield settings_record(chat_id, {"morning": (mh, mm), "evening": (eh, em), "timezone": timezone})
+        finally:
+            conn.close()
+
+    async def bulk_import(self, records):
+        async with self._flush_lock:
+            # Накопленные изменения пишутся первыми, чтобы не обогнать загрузку
+            await self._flush()
+            await asyncio.to_thread(self._import, records)
+
+    def _import(self, records):
+        notes, reminders, subscribers, settings = [], [], [], []
+        for record in records:
+            kind, chat_id = record["type"], record["chat_id"]
+            if kind == "note":
+                notes.append((record["id"], chat_id, record["text"]))
+            elif kind == "reminder":
+                reminders.append((
+                    record["id"], chat_id, record["hours"], record["minutes"], record["text"], record["rule"],
+                    record["interval"], record["date"], record["next_fire"], record["last_fired"],
+                ))
+            elif kind == "subscriber":
+                subscribers.append((chat_id,))
+            else:
+                settings.append((chat_id, *record["morning"], *record["evening"], record["timezone"]))
+        with self._conn:
+            self._conn.executemany("INSERT OR REPLACE INTO notes (id, chat_id, text) VALUES (?, ?, ?)", notes)
+            self._conn.executemany(self.UPSERT_REMINDER, reminders)
+            self._conn.executemany("INSERT OR IGNORE INTO daily_users (chat_id) VALUES (?)", subscribers)
+            self._conn.executemany(self.UPSERT_CHAT_SETTINGS, settings)
+            if self.track_changes:
+                now = time.time()
+                self._conn.executemany(
+                    "INSERT INTO changes (chat_id, origin, at) VALUES (?, ?, ?)",
+                    [(chat_id, WORKER_ID, now) for chat_id in {record["chat_id"] for record in records}]
+                )
+
+    async def flush(self):
+        async with self._flush_lock:
+            await self._flush()
+
+    async def _flush(self):
+        batch, self._pending = self._pending, []
+        if not batch:
+            return
+        try:
+            await asyncio.to_thread(self._write_batch, batch)
+        except sqlite3.Error:
+            # Временная ошибка: пачка возвращается в начало очереди (перед изменениями,
+            # накопленными за время записи) и пишется при следующем сбросе
+            self._pending[:0] = batch
+            raise
+
+    async def run(self):
+        """Фоновая запись накопленных изменений"""
+        while True:
+            try:
+                await asyncio.wait_for(self._batch_full.wait(), BotConfig.FLUSH_INTERVAL)
+            except asyncio.TimeoutError:
+                pass
+            self._batch_full.clear()
+            try:
+                await self.flush()
+            except sqlite3.Error:
+                logger.exception("Ошибка записи в хранилище")
+
+    def close(self):
+        batch, self._pending = self._pending, []
+        if batch:
+            self._write_batch(batch)
+        self._conn.close()
+        self._coord.close()
+        self._reader.close()
+
+STORAGE_BACKENDS = {"sqlite": SQLiteStorage, "memory": Storage}
+
+def create_storage():
+    """Создает хранилище по переменной STORAGE_BACKEND"""
+    backend = STORAGE_BACKENDS.get(STORAGE_BACKEND)
+    if backend is None:
+        logger.warning("Неизвестное хранилище, данные будут только в памяти", extra={"backend": STORAGE_BACKEND})
+        return Storage()
+    if backend is SQLiteStorage:
+        return SQLiteStorage(STORAGE_PATH, track_changes=SHARD_COUNT > 1)
+    return backend()
+
+# ========== ШАРДИРОВАНИЕ ==========
+
+def stable_hash(value):
+    """64-битный хеш, одинаковый во всех процессах (встроенный hash() солится при каждом запуске)"""
+    return int.from_bytes(hashlib.blake2b(str(value).encode(), digest_size=8).digest(), "big")
+
+class HashRing:
+    """Кольцо консистентного хеширования: chat_id -> номер шарда"""
+
+    def __init__(self, shard_count, vnodes=64):
+        points = sorted((stable_hash(f"{shard}:{vnode}"), shard) for shard in range(shard_count) for vnode in range(vnodes))
+        self._keys = [key for key, _ in points]
+        self._shards = [shard for _, shard in points]
+
+    def shard(self, chat_id):
+        return self._shards[bisect.bisect(self._keys, stable_hash(chat_id)) % len(self._keys)]
+
+class ShardCoordinator:
+    """Распределяет шарды между процессами через аренду в общем SQLite.
+    Процесс рассылает и шлет напоминания только чатам своих шардов; изменения,
+    сделанные другими процессами, подтягиваются из журнала changes"""
+
+    def __init__(self, storage, shard_count, worker_id):
+        self.storage = storage
+        self.shard_count = shard_count
+        self.worker_id = worker_id
+        self.ring = HashRing(shard_count)
+        self.owned = set()
+        self._seq = 0
+        self._stale = set()  # чаты, которые нужно перечитать в следующем _sync
+
+    def owns(self, chat_id):
+        return self.ring.shard(chat_id) in self.owned
+
+    async def run(self, app: Application):
+        self._seq = await asyncio.to_thread(self.storage.last_change)
+        while True:
+            try:
+                await self._rebalance(app)
+                await self._sync(app)
+            except sqlite3.Error:
+                logger.exception("Ошибка координации шардов")
+            await asyncio.sleep(BotConfig.SHARD_SYNC_INTERVAL)
+
+    async def _rebalance(self, app: Application):
+        """Продлевает аренду своих шардов и забирает свободные до справедливой доли"""
+        await asyncio.to_thread(self.storage.heartbeat, self.worker_id, BotConfig.LEASE_TTL)
+        workers = await asyncio.to_thread(self.storage.live_workers)
+        target = -(-self.shard_count // max(len(workers | {self.worker_id}), 1))
+
+        while len(self.owned) > target:
+            shard = max(self.owned)
+            await asyncio.to_thread(self.storage.release_lease, shard, self.worker_id)
+            self._drop_shards({shard})
+
+        lost = set()
+        for shard in self.owned:
+            if not await asyncio.to_thread(self.storage.acquire_lease, shard, self.worker_id, BotConfig.LEASE_TTL):
+                lost.add(shard)
+        self._drop_shards(lost)
+
+        taken = set()
+        for shard in range(self.shard_count):
+            if len(self.owned) + len(taken) >= target:
+                break
+            if shard not in self.owned and await asyncio.to_thread(
+                    self.storage.acquire_lease, shard, self.worker_id, BotConfig.LEASE_TTL):
+                taken.add(shard)
+        if taken:
+            self.owned |= taken
+            state = await self._load_chats(None)
+            missed = []
+            apply_chat_states(app, [
+                chat_id for chat_id in set(state["reminders"]) | state["daily_users"] | set(user_reminders) | users_for_daily
+                if self.ring.shard(chat_id) in taken and chat_id not in self._stale
+            ], state, missed)
+            if missed:
+                start_background(replay_missed_reminders(app, missed), "replay-missed")
+            resume_broadcasts(app, lambda chat_id: self.ring.shard(chat_id) in taken)
+            logger.info("Получены шарды", extra={"shards": sorted(taken), "owned": sorted(self.owned)})
+
+    def _drop_shards(self, shards):
+        if not shards:
+            return
+        self.owned -= shards
+        dropped = [chat_id for chat_id in set(user_reminders) | users_for_daily if self.ring.shard(chat_id) in shards]
+        daily_index.remove_many(dropped)
+        for chat_id in dropped:
+            for reminder in user_reminders.get(chat_id, ()):
+                scheduler.cancel(reminder)
+        logger.info("Шарды отданы", extra={"shards": sorted(shards), "owned": sorted(self.owned)})
+
+    async def _sync(self, app: Application):
+        """Перечитывает чаты, измененные другими процессами. Состояние обновляется у всех чатов
+        (его видят команды), а планируются только чаты своих шардов (это делает apply_chat_states)"""
+        self._seq, changed = await asyncio.to_thread(self.storage.changes_since, self._seq, self.worker_id)
+        changed |= self._stale
+        self._stale = set()
+        if changed:
+            state = await self._load_chats(changed)
+            missed = []
+            apply_chat_states(app, changed - self._stale, state, missed)
+            if missed:
+                await replay_missed_reminders(app, missed)
+        await asyncio.to_thread(self.storage.prune_changes, time.time() - 3600)
+
+    async def _load_chats(self, chat_ids):
+        """Читает состояние чатов (None - всех). Очередь записи сначала сбрасывается в базу: иначе
+        прочитанное затрет ее изменения в памяти, а журнал changes своих изменений не вернет.
+        Чаты, измененные здесь же, пока шло чтение, попадают в _stale и перечитываются в следующем _sync"""
+        await self.storage.flush()
+        self.storage.take_written()
+        state = await asyncio.to_thread(self.storage.load_chats, chat_ids)
+        self._stale |= self.storage.take_written()
+        return state
+
+    async def claim(self, reminder, next_fire, fired_at):
+        """Гарантирует, что срабатывание напоминания отправит только один процесс"""
+        # Новое напоминание могло еще не попасть в базу из очереди записи
+        await self.storage.flush()
+        return await asyncio.to_thread(
+            self.storage.claim_reminder, reminder.id, reminder.next_fire, next_fire, fired_at
+        )
+
+sharding = None  # ShardCoordinator, если SHARD_COUNT > 1
+
+def owns_chat(chat_id):
+    """Отвечает ли этот процесс за рассылки и напоминания чата"""
+    return sharding is None or sharding.owns(chat_id)
+
+# ========== ЗАМЕТКИ ==========
+
+def tokenize(text):
+    """Слова текста в нижнем регистре (для поискового индекса)"""
+    return set(re.findall(r"\w+", text.lower()))
+
+class NotesStore:
+    """Заметки чатов со стабильными номерами, удалением за O(1) и обратным индексом для поиска.
+    Заметки чата подгружаются из хранилища при первом обращении к нему"""
+
+    def __init__(self):
+        self._notes = {}     # chat_id -> {note_id: текст}; словарь хранит порядок добавления
+        self._index = {}     # chat_id -> {слово: множество note_id}
+        self._versions = {}  # chat_id -> номер версии, растет при каждом изменении
+        self._ids = itertools.count(1)
+        self._loader = None  # chat_id -> [(note_id, текст), ...]
+        self._loaded = set()
+
+    def __len__(self):
+        return len(self._notes)
+
+    def use_loader(self, loader, next_id):
+        """Подключает ленивую загрузку заметок из хранилища"""
+        self._loader = loader
+        self._loaded.clear()
+        self._ids = itertools.count(next_id)
+
+    def _ensure(self, chat_id):
+        if self._loader is not None and chat_id not in self._loaded:
+            self._loaded.add(chat_id)
+            for note_id, text in self._loader(chat_id):
+                self._insert(chat_id, note_id, text)
+
+    def _insert(self, chat_id, note_id, text):
+        self._notes.setdefault(chat_id, {})[note_id] = text
+        index = self._index.setdefault(chat_id, {})
+        for word in tokenize(text):
+            index.setdefault(word, set()).add(note_id)
+        self._versions[chat_id] = self._versions.get(chat_id, 0) + 1
+
+    def add(self, chat_id, text):
+        self._ensure(chat_id)
+        note_id = next(self._ids)
+        self._insert(chat_id, note_id, text)
+        return note_id
+
+    def delete(self, chat_id, note_id):
+        """Удаляет заметку и возвращает ее текст (None, если такой нет)"""
+        self._ensure(chat_id)
+        chat_notes = self._notes.get(chat_id, {})
+        text = chat_notes.pop(note_id, None)
+        if text is None:
+            return None
+        index = self._index[chat_id]
+        for word in tokenize(text):
+            ids = index[word]
+            ids.discard(note_id)
+            if not ids:
+                del index[word]
+        if not chat_notes:
+            del self._notes[chat_id]
+            del self._index[chat_id]
+        self._versions[chat_id] += 1
+        return text
+
+    def count(self, chat_id):
+        self._ensure(chat_id)
+        return len(self._notes.get(chat_id, ()))
+
+    def version(self, chat_id):
+        self._ensure(chat_id)
+        return self._versions.get(chat_id, 0)
+
+    def page(self, chat_id, page, page_size):
+        """Заметки страницы page в виде списка (note_id, текст)"""
+        self._ensure(chat_id)
+        chat_notes = self._notes.get(chat_id, {})
+        start = page * page_size
+        return list(itertools.islice(chat_notes.items(), start, start + page_size))
+
+    def search(self, chat_id, query):
+        """Номера заметок, содержащих все слова запроса"""
+        self._ensure(chat_id)
+        index = self._index.get(chat_id, {})
+        words = tokenize(query)
+        if not words:
+            return []
+        # Начинаем пересечение с самого редкого слова
+        postings = sorted((index.get(word, set()) for word in words), key=len)
+        found = set(postings[0])
+        for ids in postings[1:]:
+            found &= ids
+        return sorted(found)
+
+    def get(self, chat_id, note_id):
+        self._ensure(chat_id)
+        return self._notes.get(chat_id, {}).get(note_id)
+
+    def items(self):
+        """Все заметки в памяти: (chat_id, note_id, текст)"""
+        for chat_id, chat_notes in self._notes.items():
+            for note_id, text in chat_notes.items():
+                yield chat_id, note_id, text
+
+    def put(self, chat_id, note_id, text, stored=False):
+        """Кладет заметку с готовым номером (загрузка выгрузки). stored - заметка уже в хранилище,
+        и еще не загруженный чат подтянет ее сам при первом обращении"""
+        if stored and self._loader is not None and chat_id not in self._loaded:
+            return
+        self._ensure(chat_id)
+        if note_id in self._notes.get(chat_id, ()):
+            self.delete(chat_id, note_id)
+        self._insert(chat_id, note_id, text)
+
+    def reserve(self, note_id):
+        """Новые заметки получат номера больше note_id"""
+        self._ids = itertools.count(max(next(self._ids), note_id + 1))
+
+# ========== ЕЖЕДНЕВНЫЕ СООБЩЕНИЯ ==========
+
+_timezones = {}
+
+def get_timezone(name):
+    """Возвращает объект часового пояса по имени (с кешем)"""
+    tz = _timezones.get(name)
+    if tz is None:
+        tz = _timezones[name] = ZoneInfo(name)
+    return tz
+
+def is_valid_timezone(name):
+    try:
+        get_timezone(name)
+    except (ZoneInfoNotFoundError, ValueError):
+        return False
+    return True
+
+class UtcOffsetCache:
+    """Смещения часовых поясов от UTC в минутах. Смещение меняется только при переходе
+    на летнее/зимнее время, поэтому для каждого пояса считается не чаще раза в сутки"""
+
+    def __init__(self):
+        # пояс -> (смещение, с какой минуты UTC оно верно, до какой минуты, смещение до этого периода)
+        self._cache = {}
+
+    @staticmethod
+    def _compute(timezone, utc_minute):
+        local = datetime.datetime.fromtimestamp(utc_minute * 60, get_timezone(timezone))
+        return int(local.utcoffset().total_seconds() // 60)
+
+    def _transition(self, timezone, low, high):
+        """Первая минута в (low, high], с которой действует смещение high (двоичный поиск)"""
+        offset = self._compute(timezone, low)
+        while high - low > 1:
+            middle = (low + high) // 2
+            if self._compute(timezone, middle) == offset:
+                low = middle
+            else:
+                high = middle
+        return high
+
+    def _period(self, timezone, utc_minute):
+        cached = self._cache.get(timezone)
+        if cached is not None and cached[1] <= utc_minute < cached[2]:
+            return cached
+        offset = self._compute(timezone, utc_minute)
+        # Начало периода ищем на сутки назад: минуты сразу после перехода обрабатываются особо
+        start = utc_minute - 1440
+        previous = self._compute(timezone, start)
+        if previous != offset:
+            start = self._transition(timezone, start, utc_minute)
+        end = utc_minute + 1440
+        if self._compute(timezone, end) != offset:
+            end = self._transition(timezone, utc_minute, end)
+        cached = self._cache[timezone] = (offset, start, end, previous)
+        return cached
+
+    def offset(self, timezone, utc_minute):
+        return self._period(timezone, utc_minute)[0]
+
+    def local_minutes(self, timezone, utc_minute):
+        """Минуты местных суток, которые наступают в эту минуту UTC. Обычно одна; при переводе
+        часов вперед пропущенные минуты наступают вместе с первой существующей, а при переводе
+        назад повторный час пропускается, чтобы сообщение не ушло дважды"""
+        offset, start, _, previous = self._period(timezone, utc_minute)
+        if offset > previous and utc_minute == start:
+            return [minute % 1440 for minute in range(utc_minute + previous, utc_minute + offset + 1)]
+        if offset < previous and utc_minute < start + previous - offset:
+            return []
+        return [(utc_minute + offset) % 1440]
+
+class ChatIdSet:
+    """Множество chat_id в отсортированном массиве int64: 8 байт на чат вместо ~60 у set"""
+
+    def __init__(self, chat_ids=()):
+        self._ids = array("q", sorted(set(chat_ids)))
+
+    def __len__(self):
+        return len(self._ids)
+
+    def __iter__(self):
+        return iter(self._ids)
+
+    def __contains__(self, chat_id):
+        i = bisect.bisect_left(self._ids, chat_id)
+        return i < len(self._ids) and self._ids[i] == chat_id
+
+    def __or__(self, other):
+        return set(self._ids) | set(other)
+
+    __ror__ = __or__
+
+    def add(self, chat_id):
+        i = bisect.bisect_left(self._ids, chat_id)
+        if i == len(self._ids) or self._ids[i] != chat_id:
+            self._ids.insert(i, chat_id)
+
+    def discard(self, chat_id):
+        i = bisect.bisect_left(self._ids, chat_id)
+        if i < len(self._ids) and self._ids[i] == chat_id:
+            del self._ids[i]
+
+    def update(self, chat_ids):
+        self._ids = array("q", sorted(set(self._ids).union(chat_ids)))
+
+    def difference_update(self, chat_ids):
+        chat_ids = set(chat_ids)
+        if chat_ids:
+            self._ids = array("q", (chat_id for chat_id in self._ids if chat_id not in chat_ids))
+
+class DailyScheduleIndex:
+    """Индекс подписчиков по времени отправки: (вид, часовой пояс, минута суток) -> чаты.
+    На каждом тике просматриваются только чаты, у которых наступила их минута"""
+
+    KINDS = ("morning", "evening")
+
+    def __init__(self):
+        self._slots = {}       # (вид, пояс, минута суток) -> отсортированный массив chat_id
+        self._chat_slots = {}  # chat_id -> кортеж его ключей в _slots
+        self._shared = {}      # общие экземпляры ключей: у чатов с одинаковыми настройками они одни
+        self._zones = {}       # пояс -> число записей в индексе
+        self._offsets = UtcOffsetCache()
+
+    def __len__(self):
+        return len(self._chat_slots)
+
+    def _share(self, value):
+        return self._shared.setdefault(value, value)
+
+    def _keys(self, settings):
+        timezone = settings["timezone"]
+        return self._share(tuple(
+            self._share((kind, timezone, settings[kind][0] * 60 + settings[kind][1])) for kind in self.KINDS
+        ))
+
+    def _forget(self, chat_id):
+        keys = self._chat_slots.pop(chat_id, ())
+        for key in keys:
+            self._zones[key[1]] -= 1
+            if not self._zones[key[1]]:
+                del self._zones[key[1]]
+        return keys
+
+    def add(self, chat_id, settings):
+        self.remove(chat_id)
+        keys = self._chat_slots[chat_id] = self._keys(settings)
+        self._zones[settings["timezone"]] = self._zones.get(settings["timezone"], 0) + len(keys)
+        for key in keys:
+            chats = self._slots.get(key)
+            if chats is None:
+                chats = self._slots[key] = array("q")
+            bisect.insort(chats, chat_id)
+
+    def remove(self, chat_id):
+        for key in self._forget(chat_id):
+            chats = self._slots[key]
+            del chats[bisect.bisect_left(chats, chat_id)]
+            if not chats:
+                del self._slots[key]
+
+    # Вставка и удаление по одному чату сдвигают весь массив слота, а по умолчанию все чаты
+    # в одном слоте. Пачки (загрузка, смена шардов, синхронизация) пересобирают каждый слот один раз
+
+    def add_many(self, chats):
+        """Добавляет (или переносит) чаты из пар (chat_id, настройки)"""
+        chats = dict(chats)
+        self.remove_many(chats)
+        added = {}
+        keys_by_settings = {}  # у большинства чатов одинаковые настройки: ключи считаются один раз
+        for chat_id, settings in chats.items():
+            config = (settings["timezone"], settings["morning"], settings["evening"])
+            keys = keys_by_settings.get(config)
+            if keys is None:
+                keys = keys_by_settings[config] = self._keys(settings)
+            self._chat_slots[chat_id] = keys
+            for key in keys:
+                added.setdefault(key, []).append(chat_id)
+        for key, chat_ids in added.items():
+            self._zones[key[1]] = self._zones.get(key[1], 0) + len(chat_ids)
+            self._slots[key] = array("q", sorted(itertools.chain(self._slots.get(key, ()), chat_ids)))
+
+    def remove_many(self, chat_ids):
+        removed = {}
+        for chat_id in chat_ids:
+            for key in self._forget(chat_id):
+                removed.setdefault(key, set()).add(chat_id)
+        for key, gone in removed.items():
+            chats = array("q", (chat_id for chat_id in self._slots[key] if chat_id not in gone))
+            if chats:
+                self._slots[key] = chats
+            else:
+                del self._slots[key]
+
+    def due(self, utc_minute):
+        """Возвращает {вид: чаты}, которым нужно отправить сообщение в указанную минуту (UTC).
+        Работа на тик пропорциональна числу поясов, а не чатов: местная минута - целочисленный сдвиг"""
+        result = {kind: set() for kind in self.KINDS}
+        for timezone in self._zones:
+            for minute_of_day in self._offsets.local_minutes(timezone, utc_minute):
+                for kind in self.KINDS:
+                    result[kind].update(self._slots.get((kind, timezone, minute_of_day), ()))
+        return result
 
-# Проверка обязательных переменных
-if not BOT_TOKEN:
-    print("❌ ОШИБКА: BOT_TOKEN не установлен!")
-    print("ℹ️ Установите переменную BOT_TOKEN в настройках Render")
-    exit(1)
+# Глобальные переменные
+users_for_daily = ChatIdSet()
+notes_store = NotesStore()
+user_reminders = {}
+chat_settings = {}  # chat_id -> {"morning": (ч, м), "evening": (ч, м), "timezone": имя пояса}
+last_daily_tick = None  # последняя обработанная минута (UTC, минуты от эпохи)
+pending_reminders = {}  # chat_id -> [(text, catch_up)], ожидающие отправки одним сообщением
+unreachable_chats = set()  # чаты, заблокировавшие бота: их напоминания приостановлены
+interrupted_broadcasts = []  # рассылки, прерванные остановкой прошлого процесса (Storage.load)
+reminder_ids = itertools.count(1)
+scheduler = ReminderScheduler()
+broadcaster = Broadcaster()
+daily_index = DailyScheduleIndex()
+storage = Storage()
 
-if not RENDER_URL:
-    print("⚠️ ПРЕДУПРЕЖДЕНИЕ: RENDER_URL не установлен")
-    print("ℹ️ Установите переменную RENDER_URL для анти-засыпания")
+def load_state():
+    """Загружает сохраненное состояние в глобальные переменные"""
+    global storage, sharding, reminder_ids, last_daily_tick
 
-# Конфигурация бота
-class BotConfig:
-    TIMEZONE = pytz.timezone('Asia/Yekaterinburg')
-    CHECK_INTERVAL = 300  # 5 минут
+    storage = create_storage()
+    if SHARD_COUNT > 1:
+        if isinstance(storage, SQLiteStorage):
+            sharding = ShardCoordinator(storage, SHARD_COUNT, WORKER_ID)
+        else:
+            logger.warning("Шардирование требует общего SQLite-хранилища, работаем одним процессом")
+    state = storage.load()
+    notes_store.use_loader(storage.load_notes, state["next_note_id"])
+    user_reminders.update(state["reminders"])
+    users_for_daily.update(state["daily_users"])
+    unreachable_chats.update(state["unreachable"])
+    chat_settings.update(state["chat_settings"])
+    last_daily_tick = state["settings"].get("last_daily_tick")
+    interrupted_broadcasts[:] = state["broadcasts"]
+    # В шардированном режиме чаты попадают в индекс, когда процесс получает их шард
+    daily_index.add_many((chat_id, get_chat_settings(chat_id)) for chat_id in users_for_daily if owns_chat(chat_id))
 
-# ========== ФУНКЦИИ ДЛЯ АНТИ-ЗАСЫПАНИЯ ==========
+    max_id = max((r.id for reminders in user_reminders.values() for r in reminders), default=0)
+    reminder_ids = itertools.count(max_id + 1)
+    logger.info("Состояние загружено", extra={
+        "reminders": sum(map(len, user_reminders.values())),
+        "subscribers": len(users_for_daily),
+    })
 
-def keep_alive_pinger():
-    """Пингет сервер каждые 10 минут чтобы не засыпал на Render"""
-    if not RENDER_URL:
-        print("❌ Анти-засыпание отключено: RENDER_URL не установлен")
-        return
-        
-    print("🔄 Запуск анти-засыпания...")
-    while True:
-        try:
-            response = requests.get(RENDER_URL, timeout=10)
-            print(f"✅ Пинг отправлен в {datetime.datetime.now().strftime('%H:%M:%S')} - статус: {response.status_code}")
-        except Exception as e:
-            print(f"❌ Ошибка пинга: {e}")
-        
-        # Ждем 10 минут (600 секунд)
-        time.sleep(600)
+def get_chat_settings(chat_id):
+    """Настройки ежедневных сообщений чата (или настройки по умолчанию)"""
+    settings = chat_settings.get(chat_id)
+    if settings is None:
+        settings = {
+            "morning": BotConfig.DEFAULT_MORNING_TIME,
+            "evening": BotConfig.DEFAULT_EVENING_TIME,
+            "timezone": BotConfig.TIMEZONE.key,
+        }
+    return settings
 
-# ========== ВЕБ-СЕРВЕР ДЛЯ RENDER ==========
+def update_chat_settings(chat_id, **changes):
+    """Меняет настройки чата, сохраняет их и перестраивает индекс"""
+    settings = {**get_chat_settings(chat_id), **changes}
+    chat_settings[chat_id] = settings
+    storage.set_chat_settings(chat_id, settings)
+    if chat_id in users_for_daily and owns_chat(chat_id):
+        daily_index.add(chat_id, settings)
+    return settings
 
-web_app = Flask(__name__)
+def set_daily_enabled(chat_id, enabled):
+    """Включает или отключает ежедневные сообщения для чата"""
+    if enabled:
+        users_for_daily.add(chat_id)
+        if owns_chat(chat_id):
+            daily_index.add(chat_id, get_chat_settings(chat_id))
+    else:
+        users_for_daily.discard(chat_id)
+        daily_index.remove(chat_id)
+    storage.set_daily(chat_id, enabled)
 
-@web_app.route('/')
-def home():
-    current_time = datetime.datetime.now(BotConfig.TIMEZONE).strftime('%Y-%m-%d %H:%M:%S')
-    return f"""
-    <h1>🤖 Telegram Bot Active</h1>
-    <p><strong>Статус:</strong> ✅ Работает нормально</p>
-    <p><strong>Время сервера:</strong> {current_time}</p>
-    <p><strong>Часовой пояс:</strong> Екатеринбург</p>
-    <p><strong>Последняя проверка:</strong> Каждые 5 минут</p>
-    <hr>
-    <p>Бот от: @Miha5050</p>
-    """
+# ========== ГОТОВЫЕ ОТВЕТЫ ==========
 
-@web_app.route('/health')
-def health_check():
-    """Эндпоинт для проверки здоровья"""
-    return "OK", 200
-
-def run_web_server():
-    """Запускает веб-сервер для Render"""
-    print(f"🌐 Запуск веб-сервера на порту {PORT}")
-    web_app.run(host='0.0.0.0', port=PORT, debug=False)
-
-# ========== ОСНОВНЫЕ ФУНКЦИИ БОТА ==========
-
-def generate_motivational_quote():
-    quotes = [
-        "Каждый день — это новый шанс стать лучше!",
-        "Верь в себя, и ты будешь неудержим!",
-        "Твои мечты стоят того, чтобы за них бороться.",
-        "Не сдавайся — великие дела требуют времени.",
-        "Успех — это сумма маленьких усилий, повторяемых изо дня в день.",
-        "Ты способен на большее, чем думаешь!",
-        "Ошибки — это ступени к успеху.",
-        "Начни там, где ты есть. Используй то, что у тебя есть. Делай что можешь.",
-        "Сегодняшние трудности завтра станут твоей силой.",
-        "Действие — ключевой элемент успеха.",
-        "Ты ближе к цели, чем был вчера.",
-        "Позитивное мышление привлекает позитивные результаты.",
-        "Твоё время пришло! Действуй без промедлений.",
-        "Никогда не недооценивай себя. Ты уникален!",
-        "Самый простой способ добиться успеха — никогда не сдаваться."
-    ]
-    return random.choice(quotes)
-
-def create_poem():
-    adjectives = ["заботливая", "мудрая", "прекрасная", "добрая", "умная", "организованная"]
-    actions = ["учила", "вдохновляла", "поддерживала", "воспитывала"]
-    memories = ["путешествий", "учёбы", "отдыха", "трудностей"]
-    my_memories = ["научила меня читать", "записала меня на шахматы", "записала меня в кванториум", "сводила меня в галлилео", "скачала мне фильм жил был человек"]
-
-    poem = f"""
-    Дорогая мама, ты такая {random.choice(adjectives)},
-    Ты всегда меня {random.choice(actions)} во время {random.choice(memories)}.
-    Помню, как ты {random.choice(my_memories)}
-    Спасибо за всё! Люблю тебя больше всего на свете!
-    """
-    return poem
+WELCOME_TEXT = (
+    "👋 Привет!\n\n"
+    "Я бот от пользователя @Miha5050\n\n"
+    "вы можете зажать подсказку для команды чтобы ею воспользоваться.\n\n"
+    "Используйте кнопки ниже для управления ботом:"
+)
 
-def is_exact_time(target_hour, target_minute):
-    """Проверяет совпадение времени с учетом допустимого отклонения в 5 минут"""
-    now = datetime.datetime.now(BotConfig.TIMEZONE)
-    current_total_minutes = now.hour * 60 + now.minute
-    target_total_minutes = target_hour * 60 + target_minute
-    
-    return abs(current_total_minutes - target_total_minutes) <= 5
+HELP_TEXT = (
+    "ℹ️ Доступные команды:\n\n"
+    "📝 ЗАМЕТКИ:\n"
+    "/create_note <текст> - Создать заметку\n"
+    "/delete_note <номер> - Удалить заметку\n"
+    "/search_notes <слова> - Найти заметки\n\n"
+    "🔔 НАПОМИНАНИЯ:\n"
+    "/create_reminder <часы> <минуты> <текст> - Создать напоминание\n"
+    "   (также: будни <ч> <м>, каждые <мин>, <ГГГГ-ММ-ДД> <ч> <м>)\n"
+    "/delete_reminder <номер> - Удалить напоминание\n"
+    "/list_reminders - Показать все напоминания\n\n"
+    "⚙️ ОБЩИЕ:\n"
+    "/start - Показать клавиатуру\n"
+    "/help - Показать справку\n"
+    "/set_time - Установить время уведомлений\n"
+    "/set_timezone - Установить часовой пояс\n\n"
+    "Или используйте кнопки ниже:"
+)
 
-# Глобальные переменные
-daily = "включены"
-users_for_daily = set()
-user_notes = {}
-user_reminders = {}
-morning_time = (9, 0)
-evening_time = (18, 0)
-last_morning_notification = None
-last_evening_notification = None
+NO_REMINDERS_TEXT = (
+    "🔔 У вас пока нет напоминаний.\n\n"
+    "Чтобы создать напоминание, используйте:\n"
+    "/create_reminder <часы> <минуты> <текст>\n\n"
+    "Пример: /create_reminder 9 30 Позвонить маме"
+)
 
-def get_main_keyboard():
-    global daily
+def _build_main_keyboard(daily):
     keyboard = [
         ["📝 заметки", "🔔 напоминания"],
         ["✍️ хочу интересную фразу"],
@@ -144,149 +2320,619 @@ def get_main_keyboard():
         input_field_placeholder="Выберите действие..."
     )
 
-async def send_morning_message(app: Application):
-    """Отправляет утреннее сообщение всем подписанным пользователям"""
-    global last_morning_notification
-    
-    current_time = datetime.datetime.now(BotConfig.TIMEZONE)
-    today = current_time.date()
-    
-    if daily == "включены" and users_for_daily and last_morning_notification != today:
-        message = f"🌅 Доброе утро! Хорошего дня! 🌞\n\n{generate_motivational_quote()}"
-        for chat_id in users_for_daily:
-            try:
-                await app.bot.send_message(chat_id=chat_id, text=message)
-                print(f"✅ Утреннее сообщение отправлено пользователю {chat_id}")
-            except Exception as e:
-                print(f"❌ Ошибка отправки пользователю {chat_id}: {e}")
-        
-        last_morning_notification = today
-        print(f"📅 Запомнена дата утреннего уведомления: {today}")
+# Клавиатура бывает всего двух видов - создаем обе один раз
+MAIN_KEYBOARDS = {True: _build_main_keyboard("включены"), False: _build_main_keyboard("отключены")}
+
+def get_main_keyboard(chat_id):
+    return MAIN_KEYBOARDS[chat_id in users_for_daily]
+
+class RenderCache:
+    """LRU-кеш готовых текстов списков по чатам. Запись сбрасывается, когда данные чата меняются"""
+
+    def __init__(self, max_size=10000):
+        self.max_size = max_size
+        self._items = OrderedDict()
+
+    def get(self, key, render):
+        text = self._items.get(key)
+        if text is None:
+            text = self._items[key] = render()
+            if len(self._items) > self.max_size:
+                self._items.popitem(last=False)
+        else:
+            self._items.move_to_end(key)
+        return text
+
+    def invalidate(self, key):
+        self._items.pop(key, None)
+
+render_cache = RenderCache()
+
+def note_preview(text):
+    if len(text) > BotConfig.NOTE_PREVIEW_LENGTH:
+        return text[:BotConfig.NOTE_PREVIEW_LENGTH] + "…"
+    return text
+
+def render_notes(chat_id, page=0):
+    """Страница списка заметок: (текст, клавиатура) или None, если заметок нет.
+    Ключ кеша включает версию заметок чата, поэтому после изменения старые страницы просто вытесняются"""
+    total = notes_store.count(chat_id)
+    if not total:
+        return None
+    pages = (total + BotConfig.NOTES_PAGE_SIZE - 1) // BotConfig.NOTES_PAGE_SIZE
+    page = min(max(page, 0), pages - 1)
+
+    def render():
+        lines = [f"#{note_id}. {note_preview(text)}"
+                 for note_id, text in notes_store.page(chat_id, page, BotConfig.NOTES_PAGE_SIZE)]
+        text = f"📋 Ваши заметки ({total}):\n\n" + "\n".join(lines)
+        if pages == 1:
+            return text, None
+        buttons = []
+        if page > 0:
+            buttons.append(InlineKeyboardButton("◀️", callback_data=f"notes:{page - 1}"))
+        buttons.append(InlineKeyboardButton(f"{page + 1}/{pages}", callback_data=f"notes:{page}"))
+        if page < pages - 1:
+            buttons.append(InlineKeyboardButton("▶️", callback_data=f"notes:{page + 1}"))
+        return text, InlineKeyboardMarkup([buttons])
+
+    return render_cache.get(("notes", chat_id, notes_store.version(chat_id), page), render)
 
-async def send_evening_message(app: Application):
+def render_reminders(chat_id):
+    """Текст списка напоминаний чата"""
+    if not user_reminders.get(chat_id):
+        return NO_REMINDERS_TEXT
+
+    def render():
+        reminders_list = [
+            f"🔔 {i+1}. {describe_schedule(reminder)}\n"
+            f"   📝 {reminder.text}"
+            for i, reminder in enumerate(user_reminders[chat_id])
+        ]
+        return ("📋 Ваши напоминания:\n\n" + "\n".join(reminders_list) +
+                "\n\n💡 Чтобы удалить напоминание: /delete_reminder <номер>")
+
+    return render_cache.get(("reminders", chat_id), render)
+
+async def send_morning_message(app: Application, chat_ids, round_no=None, checkpoint=None):
+    """Отправляет утреннее сообщение чатам, у которых наступило утреннее время"""
+    if chat_ids:
+        round_no = daily_round() if round_no is None else round_no
+
+        def message(chat_id):
+            return f"🌅 Доброе утро! Хорошего дня! 🌞\n\n{generate_motivational_quote(chat_id, round_no)}"
+
+        await broadcaster.broadcast(app, chat_ids, message, "Утреннее сообщение", kind="morning", checkpoint=checkpoint)
+
+async def send_evening_message(app: Application, chat_ids, round_no=None, checkpoint=None):
     """Отправляет вечернее сообщение со стихотворением"""
-    global last_evening_notification
-    
-    current_time = datetime.datetime.now(BotConfig.TIMEZONE)
-    today = current_time.date()
-    
-    if daily == "включены" and users_for_daily and last_evening_notification != today:
-        # Создаем вечернее сообщение со стихотворением
-        message = f"""🌃 Добрый вечер! 🌙
+    if chat_ids:
+        round_no = daily_round() if round_no is None else round_no
 
-{create_poem()}
+        # У каждого чата свое стихотворение из пула
+        def message(chat_id):
+            return f"""🌃 Добрый вечер! 🌙
+
+{create_poem(chat_id, round_no)}
 
 💫 Пусть этот вечер принесет умиротворение и приятные мысли!"""
-        
-        for chat_id in users_for_daily:
-            try:
-                await app.bot.send_message(chat_id=chat_id, text=message)
-                print(f"✅ Вечернее сообщение со стихотворением отправлено пользователю {chat_id}")
-            except Exception as e:
-                print(f"❌ Ошибка отправки пользователю {chat_id}: {e}")
-        
-        last_evening_notification = today
-        print(f"📅 Запомнена дата вечернего уведомления: {today}")
 
-async def check_reminders(app: Application):
-    """Проверка напоминаний"""
-    current_time = datetime.datetime.now(BotConfig.TIMEZONE)
-    print(f"🔔 Проверка напоминаний: {current_time.strftime('%H:%M:%S')}")
-    
-    for user_id in list(user_reminders.keys()):
-        if user_id not in user_reminders:
+        await broadcaster.broadcast(app, chat_ids, message, "Вечернее сообщение", kind="evening", checkpoint=checkpoint)
+
+DAILY_SENDERS = {"morning": send_morning_message, "evening": send_evening_message}
+
+def begin_broadcast(kind, round_no, chat_ids):
+    """Сохраняет контрольную точку ежедневной рассылки и возвращает ее номер (None, если чатов нет)"""
+    if not chat_ids:
+        return None
+    broadcast_id = secrets.token_hex(8)
+    storage.begin_broadcast(broadcast_id, kind, round_no, chat_ids)
+    return broadcast_id
+
+def resume_broadcasts(app: Application, owns):
+    """Досылает прерванные рассылки чатам, за которые отвечает процесс (owns(chat_id)).
+    Раунд текстов сохранен, поэтому чат получает тот же текст, что получил бы без остановки"""
+    for broadcast in interrupted_broadcasts:
+        chat_ids = [chat_id for chat_id in broadcast["chat_ids"] if owns(chat_id)]
+        if not chat_ids:
             continue
-            
-        reminders = user_reminders[user_id]
-        
-        for i in range(len(reminders)):
-            if user_id not in user_reminders or i >= len(user_reminders[user_id]):
-                break
-                
-            reminder = user_reminders[user_id][i]
-            hours = reminder["hours"]
-            minutes = reminder["minutes"]
-            text = reminder["text"]
-            
-            if is_exact_time(hours, minutes):
-                try:
-                    if (user_id in user_reminders and 
-                        i < len(user_reminders[user_id]) and
-                        user_reminders[user_id][i]["hours"] == hours and
-                        user_reminders[user_id][i]["minutes"] == minutes and
-                        user_reminders[user_id][i]["text"] == text):
-                        
-                        await app.bot.send_message(
-                            chat_id=user_id,
-                            text=f"🔔 Напоминание!\n\n{text}"
-                        )
-                        print(f"✅ Напоминание отправлено пользователю {user_id}")
-                        
-                except Exception as e:
-                    print(f"❌ Ошибка отправки напоминания: {e}")
+        broadcast["chat_ids"] = [chat_id for chat_id in broadcast["chat_ids"] if not owns(chat_id)]
+        logger.info("Возобновление прерванной рассылки", extra={
+            "kind": broadcast["kind"], "chats": len(chat_ids), "checkpoint": broadcast["id"],
+        })
+        sender = DAILY_SENDERS[broadcast["kind"]]
+        start_background(sender(app, chat_ids, broadcast["round_no"], broadcast["id"]), f"resume-{broadcast['kind']}")
+    interrupted_broadcasts[:] = [broadcast for broadcast in interrupted_broadcasts if broadcast["chat_ids"]]
+
+def reminder_timezone(user_id):
+    return get_timezone(get_chat_settings(user_id)["timezone"])
+
+def has_reminder(user_id, reminder):
+    return any(r is reminder for r in user_reminders.get(user_id, ()))
+
+def find_reminder(user_id, reminder_id):
+    return next((r for r in user_reminders.get(user_id, ()) if r.id == reminder_id), None)
+
+def remove_reminder(user_id, reminder):
+    """Удаляет напоминание из памяти, планировщика и хранилища"""
+    reminders = user_reminders.get(user_id, [])
+    reminders[:] = [r for r in reminders if r is not reminder]
+    if not reminders:
+        user_reminders.pop(user_id, None)
+    scheduler.cancel(reminder)
+    storage.delete_reminder(user_id, reminder.id)
+    render_cache.invalidate(("reminders", user_id))
+
+def advance_reminder(app: Application, user_id, reminder, after):
+    """Переводит напоминание на следующее срабатывание после after или удаляет одноразовое"""
+    reminder.next_fire = compute_next_fire(reminder, after, reminder_timezone(user_id))
+    if reminder.next_fire is None:
+        remove_reminder(user_id, reminder)
+        return
+    storage.save_reminder(user_id, reminder)
+    schedule_reminder(app, user_id, reminder)
+
+def chat_unreachable(chat_id):
+    """Чат заблокировал бота или удален: больше не тратим на него ежедневные рассылки,
+    а его напоминания приостанавливаем до первого сообщения из чата"""
+    if chat_id in users_for_daily:
+        set_daily_enabled(chat_id, False)
+        metrics.inc("bot_chats_pruned_total")
+        logger.info("Чат недоступен, ежедневные сообщения отключены", extra={"chat_id": chat_id})
+    if chat_id not in unreachable_chats:
+        unreachable_chats.add(chat_id)
+        storage.set_unreachable(chat_id, True)
+        for reminder in user_reminders.get(chat_id, ()):
+            scheduler.cancel(reminder)
+        logger.info("Чат недоступен, напоминания приостановлены", extra={"chat_id": chat_id})
+
+def chat_reachable(app: Application, chat_id):
+    """Из чата снова пришло сообщение: возобновляем его напоминания. Сработавшие за время
+    блокировки не досылаются, а переводятся на следующее срабатывание"""
+    if chat_id not in unreachable_chats:
+        return
+    unreachable_chats.discard(chat_id)
+    storage.set_unreachable(chat_id, False)
+    now = time.time()
+    for reminder in list(user_reminders.get(chat_id, ())):
+        if reminder.next_fire is None or reminder.next_fire <= now:
+            advance_reminder(app, chat_id, reminder, now)
+        else:
+            schedule_reminder(app, chat_id, reminder)
+
+def format_reminders(items):
+    """Текст сообщения для одного или нескольких напоминаний [(text, catch_up)]"""
+    if len(items) == 1:
+        text, catch_up = items[0]
+        title = "🔔 Пропущенное напоминание!" if catch_up else "🔔 Напоминание!"
+        return f"{title}\n\n{text}"
+    lines = [f"• {text}" + (" (пропущено)" if catch_up else "") for text, catch_up in items]
+    return f"🔔 Напоминания ({len(items)})!\n\n" + "\n\n".join(lines)
+
+async def deliver_reminder(app: Application, user_id, text, catch_up=False):
+    """Ставит напоминание в исходящую очередь чата. Напоминания, сработавшие в пределах
+    COALESCE_WINDOW, уходят одним сообщением"""
+    items = pending_reminders.get(user_id)
+    if items is not None:
+        items.append((text, catch_up))
+        metrics.inc("bot_reminders_coalesced_total")
+        return None
+    pending_reminders[user_id] = items = [(text, catch_up)]
+    try:
+        await asyncio.sleep(BotConfig.COALESCE_WINDOW)
+    finally:
+        pending_reminders.pop(user_id, None)
+    return await broadcaster.send(app, user_id, format_reminders(items), kind="reminder")
+
+async def fire_reminder(app: Application, user_id, reminder, catch_up=False):
+    """Отправляет напоминание и ставит его на следующее срабатывание"""
+    if not has_reminder(user_id, reminder) or user_id in unreachable_chats:
+        return
+    now = time.time()
+    if sharding is not None:
+        next_fire = compute_next_fire(reminder, now, reminder_timezone(user_id))
+        if not await sharding.claim(reminder, next_fire, now):
+            logger.info("Напоминание уже обработано другим процессом", extra={"reminder_id": reminder.id})
+            return
+        # Срабатывание за нами, и отправить его нужно в любом случае. Пока шел claim, _sync мог
+        # заменить напоминания чата прочитанными из базы: переводим дальше актуальный объект
+        reminder = find_reminder(user_id, reminder.id) or reminder
+    reminder.last_fired = now
+    if has_reminder(user_id, reminder):
+        advance_reminder(app, user_id, reminder, now)
+
+    if await deliver_reminder(app, user_id, reminder.text, catch_up):
+        logger.info("Напоминание отправлено", extra={"chat_id": user_id, "sampled": True})
+
+def schedule_reminder(app: Application, user_id, reminder):
+    """Ставит напоминание в планировщик на его next_fire"""
+    if not owns_chat(user_id) or user_id in unreachable_chats:
+        return
+    scheduler.schedule(
+        reminder,
+        reminder.next_fire,
+        functools.partial(fire_reminder, app, user_id, reminder)
+    )
+
+async def replay_missed_reminders(app: Application, missed):
+    """Досылает напоминания, пропущенные за время простоя, пачками, не занимая event loop надолго.
+    Каждое пропущенное напоминание приходит один раз, даже если за простой оно должно было сработать много раз"""
+    window_start = time.time() - BotConfig.REMINDER_CATCHUP_WINDOW
+    logger.info("Догоняем пропущенные напоминания", extra={"count": len(missed)})
+    for start in range(0, len(missed), BotConfig.REMINDER_CATCHUP_BATCH):
+        batch = missed[start:start + BotConfig.REMINDER_CATCHUP_BATCH]
+        jobs = []
+        for user_id, reminder in batch:
+            if reminder.next_fire >= window_start:
+                jobs.append(fire_reminder(app, user_id, reminder, catch_up=True))
+            elif has_reminder(user_id, reminder):
+                # Слишком старое - просто переводим на следующее срабатывание
+                advance_reminder(app, user_id, reminder, time.time())
+        await asyncio.gather(*jobs)
+        await asyncio.sleep(0)
 
 async def check_time_and_notify(app: Application):
-    """Асинхронная проверка времени и отправка уведомлений"""
-    current_time = datetime.datetime.now(BotConfig.TIMEZONE)
-    print(f"⏰ Проверка времени: {current_time.strftime('%H:%M:%S')}")
-    
-    # Проверяем утренние уведомления
-    if is_exact_time(morning_time[0], morning_time[1]):
-        print("🔔 Условие для утреннего уведомления выполнено")
-        await send_morning_message(app)
+    """Ежеминутный тик: отправляет сообщения только чатам из индекса, чья минута наступила"""
+    global last_daily_tick
+
+    current_minute = int(time.time() // 60)
+    schedule_daily_tick(app)
+
+    if last_daily_tick is None:
+        first_minute = current_minute
     else:
-        print(f"❌ Утреннее уведомление: текущее время {current_time.strftime('%H:%M')}, целевое {morning_time[0]:02d}:{morning_time[1]:02d}")
-        
-    # Проверяем вечерние уведомления
-    if is_exact_time(evening_time[0], evening_time[1]):
-        print("🔔 Условие для вечернего уведомления выполнено")
-        await send_evening_message(app)
+        # Догоняем минуты, пропущенные из-за задержки цикла или перезапуска
+        first_minute = max(last_daily_tick + 1, current_minute - BotConfig.DAILY_CATCHUP_MINUTES)
+
+    morning, evening = set(), set()
+    with profiler.phase("daily.lookup"):
+        for minute in range(first_minute, current_minute + 1):
+            due = daily_index.due(minute)
+            morning |= due["morning"]
+            evening |= due["evening"]
+
+    last_daily_tick = current_minute
+    storage.set_setting("last_daily_tick", current_minute)
+    if morning or evening:
+        logger.info("Ежедневные сообщения", extra={"morning": len(morning), "evening": len(evening)})
+        # Контрольные точки встают в очередь записи вместе с last_daily_tick, без await между ними:
+        # после перезапуска минута считается пройденной, только если ее рассылки тоже сохранены
+        round_no = daily_round()
+        morning_checkpoint = begin_broadcast("morning", round_no, morning)
+        evening_checkpoint = begin_broadcast("evening", round_no, evening)
+        await asyncio.gather(
+            send_morning_message(app, morning, round_no, morning_checkpoint),
+            send_evening_message(app, evening, round_no, evening_checkpoint),
+        )
+
+def schedule_daily_tick(app: Application):
+    """Ставит тик ежедневных сообщений на начало следующей минуты"""
+    next_minute = (int(time.time() // 60) + 1) * 60
+    scheduler.schedule("daily", next_minute, lambda: check_time_and_notify(app))
+
+def plan_reminder(app: Application, user_id, reminder, now, missed):
+    """Ставит загруженное напоминание в планировщик или в список пропущенных"""
+    try:
+        check_schedule(reminder.rule, reminder.hours, reminder.minutes, reminder.interval, reminder.date)
+    except ValueError as error:
+        # Испорченное напоминание не должно мешать запуску: оно остается в списке чата, откуда его можно удалить
+        logger.error("Напоминание с неверным расписанием не запланировано", extra={
+            "chat_id": user_id, "reminder_id": reminder.id, "error": str(error),
+        })
+        return
+    if reminder.next_fire is None:
+        # Напоминание из старой схемы без сохраненного времени срабатывания
+        advance_reminder(app, user_id, reminder, now)
+    elif reminder.next_fire <= now:
+        missed.append((user_id, reminder))
     else:
-        print(f"❌ Вечернее уведомление: текущее время {current_time.strftime('%H:%M')}, целевое {evening_time[0]:02d}:{evening_time[1]:02d}")
-    
-    # Проверяем напоминания
-    await check_reminders(app)
-    
-    print("✅ Все проверки завершены")
+        schedule_reminder(app, user_id, reminder)
+
+def apply_chat_states(app: Application, chat_ids, state, missed):
+    """Заменяет состояние чатов прочитанным из хранилища: чаты изменил другой процесс, их шард перешел
+    к нам или они загружены из выгрузки. Подписки и индекс рассылок обновляются одной пачкой"""
+    chat_ids = list(chat_ids)
+    subscribed, unsubscribed = [], []
+    for chat_id in chat_ids:
+        for reminder in user_reminders.pop(chat_id, ()):
+            scheduler.cancel(reminder)
+        if chat_id in state["reminders"]:
+            user_reminders[chat_id] = state["reminders"][chat_id]
+        if chat_id in state["chat_settings"]:
+            chat_settings[chat_id] = state["chat_settings"][chat_id]
+        (subscribed if chat_id in state["daily_users"] else unsubscribed).append(chat_id)
+        if chat_id in state["unreachable"]:
+            unreachable_chats.add(chat_id)
+        else:
+            unreachable_chats.discard(chat_id)
+        render_cache.invalidate(("reminders", chat_id))
+    users_for_daily.update(subscribed)
+    users_for_daily.difference_update(unsubscribed)
+
+    daily_index.remove_many(chat_ids)
+    daily_index.add_many((chat_id, get_chat_settings(chat_id)) for chat_id in subscribed if owns_chat(chat_id))
+    now = time.time()
+    for chat_id in chat_ids:
+        if chat_id in user_reminders and owns_chat(chat_id):
+            for reminder in list(user_reminders[chat_id]):
+                plan_reminder(app, chat_id, reminder, now, missed)
 
 def start_time_checker(app: Application):
-    """Запускает асинхронную проверку времени каждые 5 минут"""
-    async def time_checker_loop():
-        print("🕒 Запуск планировщика проверок с интервалом 5 минут")
+    """Загружает задачи в планировщик и запускает его. Пропущенные напоминания досылаются в фоне"""
+    now = time.time()
+    missed = []
+    for user_id, reminders in list(user_reminders.items()):
+        if not owns_chat(user_id):
+            continue
+        for reminder in list(reminders):
+            plan_reminder(app, user_id, reminder, now, missed)
+    schedule_daily_tick(app)
+    resume_broadcasts(app, owns_chat)
+    if sharding is not None:
+        start_background(sharding.run(app), "sharding")
+
+    start_background(scheduler.run(), "scheduler")
+    if missed:
+        start_background(replay_missed_reminders(app, missed), "replay-missed")
+
+# ========== ВЫГРУЗКА И ЗАГРУЗКА СОСТОЯНИЯ ==========
+
+# Одна запись на строку. Поля, не относящиеся к типу записи, пустые
+DUMP_FIELDS = ("type", "chat_id", "id", "text", "rule", "hours", "minutes", "interval", "date",
+               "next_fire", "last_fired", "morning", "evening", "timezone")
+DUMP_FORMATS = {"ndjson": "application/x-ndjson", "csv": "text/csv"}
+# json.dumps с параметрами создает кодировщик на каждый вызов, а записей миллионы
+_dump_encoder = json.JSONEncoder(ensure_ascii=False, separators=(",", ":"))
+import_lock = asyncio.Lock()
+
+def dump_filename(fmt):
+    return f"bot-{datetime.datetime.now(BotConfig.TIMEZONE):%Y%m%d-%H%M%S}.{fmt}"
+
+def temp_path(suffix):
+    fd, path = tempfile.mkstemp(suffix=suffix)
+    os.close(fd)
+    return path
+
+def reminder_record(chat_id, reminder):
+    return {"type": "reminder", "chat_id": chat_id, **{field: getattr(reminder, field) for field in Reminder.__slots__}}
+
+def settings_record(chat_id, settings):
+    return {
+        "type": "chat_settings", "chat_id": chat_id,
+        "morning": "%02d:%02d" % settings["morning"], "evening": "%02d:%02d" % settings["evening"],
+        "timezone": settings["timezone"],
+    }
+
+def memory_snapshot():
+    """Записи состояния из памяти (хранилище без диска). Список строится сразу, поэтому срез согласованный"""
+    records = [{"type": "note", "chat_id": chat_id, "id": note_id, "text": text}
+               for chat_id, note_id, text in notes_store.items()]
+    records += [reminder_record(chat_id, reminder)
+                for chat_id, reminders in user_reminders.items() for reminder in reminders]
+    records += [{"type": "subscriber", "chat_id": chat_id} for chat_id in users_for_daily]
+    records += [settings_record(chat_id, settings) for chat_id, settings in chat_settings.items()]
+    return iter(records)
+
+def encode_records(records, fmt, header=False):
+    if fmt == "csv":
+        buffer = io.StringIO()
+        writer = csv.DictWriter(buffer, DUMP_FIELDS)
+        if header:
+            writer.writeheader()
+        writer.writerows(records)
+        return buffer.getvalue().encode()
+    encode = _dump_encoder.encode
+    return "".join([encode(record) + "\n" for record in records]).encode()
+
+def _next_dump_chunk(records, fmt, header):
+    chunk = list(itertools.islice(records, BotConfig.DUMP_CHUNK_SIZE))
+    return len(chunk), encode_records(chunk, fmt, header)
+
+async def export_dump(fmt):
+    """Выгрузка всего состояния кусками байтов. Записи читаются из одного среза хранилища в потоке,
+    так что обработчики продолжают работать и меняют данные уже после среза"""
+    await storage.flush()
+    records = storage.snapshot()
+    if records is None:
+        records = memory_snapshot()
+    try:
+        first = True
         while True:
-            try:
-                await check_time_and_notify(app)
-            except Exception as e:
-                print(f"❌ Ошибка в проверке времени: {e}")
-            
-            # Ждем 5 минут (300 секунд) до следующей проверки
-            print("⏳ Ожидание 5 минут до следующей проверки...")
-            await asyncio.sleep(300)
-    
-    loop = asyncio.get_event_loop()
-    loop.create_task(time_checker_loop())
+            count, data = await asyncio.to_thread(_next_dump_chunk, records, fmt, first)
+            if count or first:
+                yield data
+            if not count:
+                break
+            first = False
+    finally:
+        # Если клиент отключился посреди куска, генератор еще занят в потоке: тогда соединение
+        # закроется, когда генератор соберет сборщик мусора
+        with contextlib.suppress(ValueError, AttributeError):
+            records.close()
+
+def read_dump(path, fmt):
+    """Строки файла выгрузки (можно в gzip): (номер строки, сырая запись)"""
+    with open(path, "rb") as probe:
+        gzipped = probe.read(2) == b"\x1f\x8b"
+    with (gzip.open if gzipped else open)(path, "rt", encoding="utf-8", newline="") as file:
+        if fmt == "csv":
+            reader = csv.DictReader(file)
+            for record in reader:
+                yield reader.line_num, record
+        else:
+            for line_no, line in enumerate(file, 1):
+                if line.strip():
+                    yield line_no, line
+
+def _dump_value(raw, name, convert, required=False):
+    value = raw.get(name)
+    if value is None or value == "":
+        if required:
+            raise ValueError(f"нет поля {name}")
+        return None
+    try:
+        return convert(value)
+    except (TypeError, ValueError):
+        raise ValueError(f"неверное значение {name}: {value!r}") from None
+
+def _clock(value):
+    hours, minutes = map(int, value.split(":"))
+    if not (0 <= hours <= 23 and 0 <= minutes <= 59):
+        raise ValueError(value)
+    return hours, minutes
+
+def _timezone(value):
+    if not is_valid_timezone(value):
+        raise ValueError(value)
+    return value
+
+def _record_id(value):
+    value = int(value)
+    if value < 1:
+        raise ValueError(value)
+    return value
+
+def parse_record(raw):
+    """Проверяет запись выгрузки и приводит поля к нужным типам (в CSV все поля - строки)"""
+    if isinstance(raw, str):
+        raw = json.loads(raw)
+    if not isinstance(raw, dict):
+        raise ValueError("запись должна быть объектом")
+    kind = raw.get("type")
+    record = {"type": kind, "chat_id": _dump_value(raw, "chat_id", int, required=True)}
+    if kind == "note":
+        record["id"] = _dump_value(raw, "id", _record_id, required=True)
+        record["text"] = _dump_value(raw, "text", str, required=True)
+    elif kind == "reminder":
+        rule = raw.get("rule") or "daily"
+        if rule not in ("daily", "weekdays", "every", "once"):
+            raise ValueError(f"неизвестное правило {rule!r}")
+        record.update(
+            id=_dump_value(raw, "id", _record_id, required=True),
+            rule=rule,
+            hours=_dump_value(raw, "hours", int, required=rule != "every"),
+            minutes=_dump_value(raw, "minutes", int, required=rule != "every"),
+            interval=_dump_value(raw, "interval", int, required=rule == "every"),
+            date=_dump_value(raw, "date", lambda value: datetime.date.fromisoformat(value).isoformat(),
+                             required=rule == "once"),
+            text=_dump_value(raw, "text", str) or "",
+            next_fire=_dump_value(raw, "next_fire", float),
+            last_fired=_dump_value(raw, "last_fired", float),
+        )
+        # Запись отбрасывается здесь, до записи куска в хранилище: иначе она сломает планирование после перезапуска
+        check_schedule(rule, record["hours"], record["minutes"], record["interval"], record["date"])
+    elif kind == "chat_settings":
+        record.update(
+            morning=_dump_value(raw, "morning", _clock, required=True),
+            evening=_dump_value(raw, "evening", _clock, required=True),
+            timezone=_dump_value(raw, "timezone", _timezone, required=True),
+        )
+    elif kind != "subscriber":
+        raise ValueError(f"неизвестный тип записи {kind!r}")
+    return record
+
+def parse_chunk(rows, size):
+    """Следующий кусок выгрузки: (записи, ошибки). Пустые списки - файл закончился"""
+    records, errors = [], []
+    for line_no, raw in itertools.islice(rows, size):
+        try:
+            records.append(parse_record(raw))
+        except ValueError as error:
+            errors.append(f"строка {line_no}: {error}")
+    return records, errors
+
+def current_chat_state(chat_id, state):
+    """Добавляет в state (формат Storage.load()) состояние чата из памяти"""
+    if chat_id in user_reminders:
+        state["reminders"][chat_id] = list(user_reminders[chat_id])
+    if chat_id in users_for_daily:
+        state["daily_users"].add(chat_id)
+    if chat_id in unreachable_chats:
+        state["unreachable"].add(chat_id)
+    if chat_id in chat_settings:
+        state["chat_settings"][chat_id] = chat_settings[chat_id]
+
+def apply_imported(app: Application, records, missed):
+    """Применяет загруженные записи к памяти: записи дополняют и заменяют (по номеру) данные чатов"""
+    global reminder_ids
+    stored = isinstance(storage, SQLiteStorage)
+    state = Storage.load(storage)
+    changed = set()
+    max_note_id = max_reminder_id = 0
+    for record in records:
+        kind, chat_id = record["type"], record["chat_id"]
+        if kind == "note":
+            notes_store.put(chat_id, record["id"], record["text"], stored=stored)
+            max_note_id = max(max_note_id, record["id"])
+            continue
+        if chat_id not in changed:
+            changed.add(chat_id)
+            current_chat_state(chat_id, state)
+        if kind == "reminder":
+            reminder = Reminder(**{field: record[field] for field in Reminder.__slots__})
+            reminders = [r for r in state["reminders"].get(chat_id, ()) if r.id != reminder.id]
+            state["reminders"][chat_id] = reminders + [reminder]
+            max_reminder_id = max(max_reminder_id, reminder.id)
+        elif kind == "subscriber":
+            state["daily_users"].add(chat_id)
+        else:
+            state["chat_settings"][chat_id] = {
+                "morning": record["morning"], "evening": record["evening"], "timezone": record["timezone"],
+            }
+    apply_chat_states(app, changed, state, missed)
+    if max_note_id:
+        notes_store.reserve(max_note_id)
+    if max_reminder_id:
+        reminder_ids = itertools.count(max(next(reminder_ids), max_reminder_id + 1))
+
+async def import_dump(app: Application, path, fmt):
+    """Загружает файл выгрузки кусками: каждый кусок разбирается в потоке, пишется в хранилище
+    одной транзакцией и сразу применяется в памяти. Ошибочные записи пропускаются"""
+    started = time.perf_counter()
+    counts = collections.Counter()
+    errors, missed = [], []
+    rows = read_dump(path, fmt)
+    async with import_lock:
+        try:
+            while True:
+                try:
+                    records, bad = await asyncio.to_thread(parse_chunk, rows, BotConfig.DUMP_CHUNK_SIZE)
+                except (OSError, EOFError, UnicodeDecodeError, csv.Error) as error:
+                    raise ValueError(f"файл не читается после {sum(counts.values())} записей: {error}") from None
+                if not records and not bad:
+                    break
+                if records:
+                    await storage.bulk_import(records)
+                    apply_imported(app, records, missed)
+                counts.update(record["type"] for record in records)
+                counts["skipped"] += len(bad)
+                errors.extend(bad[:10 - len(errors)])
+        finally:
+            rows.close()
+    if missed:
+        start_background(replay_missed_reminders(app, missed), "replay-imported")
+    skipped = counts.pop("skipped", 0)
+    result = {
+        "imported": dict(counts), "skipped": skipped, "errors": errors,
+        "seconds": round(time.perf_counter() - started, 3),
+    }
+    logger.info("Выгрузка загружена", extra=result)
+    return result
 
 # ========== КОМАНДЫ БОТА ==========
 
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Команда /start - показывает клавиатуру"""
-    users_for_daily.add(update.effective_chat.id)
-    
-    welcome_text = (
-        "👋 Привет!\n\n"
-        "Я бот от пользователя @Miha5050\n\n"
-        "вы можете зажать подсказку для команды чтобы ею воспользоваться.\n\n"        
-        "Используйте кнопки ниже для управления ботом:"
-    )
+    set_daily_enabled(update.effective_chat.id, True)
     
     await update.message.reply_text(
-        welcome_text,
-        reply_markup=get_main_keyboard()
+        WELCOME_TEXT,
+        reply_markup=get_main_keyboard(update.effective_chat.id)
     )
 
 async def set_time_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    """Команда /set_time - установить время утренних и вечерних уведомлений"""
-    global morning_time, evening_time
+    """Команда /set_time - установить время утренних и вечерних уведомлений для чата"""
+    chat_id = update.effective_chat.id
     
     if context.args and len(context.args) == 4:
         try:
@@ -298,14 +2944,17 @@ async def set_time_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
             if (0 <= morning_hours <= 23 and 0 <= morning_minutes <= 59 and
                 0 <= evening_hours <= 23 and 0 <= evening_minutes <= 59):
                 
-                morning_time = (morning_hours, morning_minutes)
-                evening_time = (evening_hours, evening_minutes)
+                update_chat_settings(
+                    chat_id,
+                    morning=(morning_hours, morning_minutes),
+                    evening=(evening_hours, evening_minutes)
+                )
                 
                 await update.message.reply_text(
                     f"✅ Время уведомлений установлено!\n\n"
                     f"🌅 Утренние уведомления: {morning_hours:02d}:{morning_minutes:02d}\n"
                     f"🌃 Вечерние уведомления: {evening_hours:02d}:{evening_minutes:02d}\n\n"
-                    f"Уведомления будут отправляться в указанное время ±5 минут"
+                    f"Уведомления будут отправляться точно в указанное время"
                 )
             else:
                 await update.message.reply_text("❌ Неверное время! Часы: 0-23, Минуты: 0-59")
@@ -313,15 +2962,44 @@ async def set_time_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
         except ValueError:
             await update.message.reply_text("❌ Используйте: /set_time <утро_часы> <утро_минуты> <вечер_часы> <вечер_минуты>")
     else:
+        settings = get_chat_settings(chat_id)
+        morning_time, evening_time = settings["morning"], settings["evening"]
         await update.message.reply_text(
             f"⏰ Текущее время уведомлений:\n\n"
             f"🌅 Утренние: {morning_time[0]:02d}:{morning_time[1]:02d}\n"
-            f"🌃 Вечерние: {evening_time[0]:02d}:{evening_time[1]:02d}\n\n"
+            f"🌃 Вечерние: {evening_time[0]:02d}:{evening_time[1]:02d}\n"
+            f"🌍 Часовой пояс: {settings['timezone']}\n\n"
             f"Установите новое время:\n"
             f"/set_time <утро_часы> <утро_минуты> <вечер_часы> <вечер_минуты>\n\n"
             f"Пример: /set_time 9 0 18 0"
         )
 
+async def set_timezone_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Команда /set_timezone - установить часовой пояс чата"""
+    chat_id = update.effective_chat.id
+    
+    if not context.args or len(context.args) != 1:
+        await update.message.reply_text(
+            f"🌍 Текущий часовой пояс: {get_chat_settings(chat_id)['timezone']}\n\n"
+            f"Используйте: /set_timezone <пояс>\n\n"
+            f"Пример: /set_timezone Europe/Moscow"
+        )
+        return
+    
+    timezone = context.args[0]
+    if not is_valid_timezone(timezone):
+        await update.message.reply_text("❌ Неизвестный часовой пояс. Пример: Europe/Moscow")
+        return
+    
+    update_chat_settings(chat_id, timezone=timezone)
+    # Напоминания по местному времени переносим в новый часовой пояс
+    now = time.time()
+    for reminder in list(user_reminders.get(chat_id, ())):
+        if reminder.rule != "every":
+            reminder.next_fire = None
+            advance_reminder(context.application, chat_id, reminder, now)
+    await update.message.reply_text(f"✅ Часовой пояс установлен: {timezone}")
+
 async def create_note(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Команда для создания заметки"""
     chat_id = update.effective_chat.id
@@ -329,18 +3007,36 @@ async def create_note(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if context.args:
         note_text = ' '.join(context.args)
         
-        if chat_id not in user_notes:
-            user_notes[chat_id] = []
+        if len(note_text) > BotConfig.MAX_TEXT_LENGTH:
+            await update.message.reply_text(f"❌ Заметка слишком длинная (максимум {BotConfig.MAX_TEXT_LENGTH} символов).")
+            return
+        if notes_store.count(chat_id) >= BotConfig.MAX_NOTES_PER_CHAT:
+            await update.message.reply_text(f"❌ Достигнут лимит заметок ({BotConfig.MAX_NOTES_PER_CHAT}). Удалите ненужные.")
+            return
         
-        user_notes[chat_id].append(note_text)
-        await update.message.reply_text(f"✅ Заметка создана!\n\n📝 Текст: {note_text}")
+        note_id = notes_store.add(chat_id, note_text)
+        storage.add_note(chat_id, note_id, note_text)
+        await update.message.reply_text(f"✅ Заметка #{note_id} создана!\n\n📝 Текст: {note_text}")
     else:
-        if chat_id in user_notes and user_notes[chat_id]:
-            notes_list = "\n".join([f"{i+1}. {note}" for i, note in enumerate(user_notes[chat_id])])
-            await update.message.reply_text(f"📋 Ваши заметки:\n\n{notes_list}")
+        rendered = render_notes(chat_id)
+        if rendered:
+            text, keyboard = rendered
+            await update.message.reply_text(text, reply_markup=keyboard)
         else:
             await update.message.reply_text("📝 У вас пока нет заметок.\n\nИспользуйте: /create_note <текст>")
 
+async def notes_page_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Листание списка заметок кнопками ◀️ ▶️"""
+    query = update.callback_query
+    await query.answer()
+    rendered = render_notes(update.effective_chat.id, int(query.data.split(":")[1]))
+    if rendered is None:
+        await query.edit_message_text("📝 У вас пока нет заметок.")
+        return
+    text, keyboard = rendered
+    if text != query.message.text:
+        await query.edit_message_text(text, reply_markup=keyboard)
+
 async def delete_note(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Команда для удаления заметки"""
     chat_id = update.effective_chat.id
@@ -350,63 +3046,129 @@ async def delete_note(update: Update, context: ContextTypes.DEFAULT_TYPE):
         return
     
     try:
-        note_index = int(context.args[0]) - 1
+        note_id = int(context.args[0].lstrip("#"))
     except ValueError:
         await update.message.reply_text("❌ Номер заметки должен быть числом.")
         return
     
-    if chat_id not in user_notes or not user_notes[chat_id]:
+    if not notes_store.count(chat_id):
         await update.message.reply_text("📝 У вас пока нет заметок для удаления.")
         return
     
-    if note_index < 0 or note_index >= len(user_notes[chat_id]):
-        await update.message.reply_text(f"❌ Неверный номер заметки. У вас есть заметки с 1 по {len(user_notes[chat_id])}.")
+    deleted_note = notes_store.delete(chat_id, note_id)
+    if deleted_note is None:
+        await update.message.reply_text("❌ Заметка с таким номером не найдена.")
         return
     
-    deleted_note = user_notes[chat_id].pop(note_index)
-    await update.message.reply_text(f"✅ Заметка удалена:\n\n📝 {deleted_note}")
+    storage.delete_note(note_id)
+    await update.message.reply_text(f"✅ Заметка #{note_id} удалена:\n\n📝 {deleted_note}")
 
-async def create_reminder(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    """Создание напоминания"""
-    user_id = update.effective_chat.id
+async def search_notes(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Команда /search_notes - поиск заметок по словам"""
+    chat_id = update.effective_chat.id
+    
+    if not context.args:
+        await update.message.reply_text("❌ Используйте: /search_notes <слова>")
+        return
     
-    if context.args and len(context.args) >= 3:
+    found = notes_store.search(chat_id, ' '.join(context.args))
+    if not found:
+        await update.message.reply_text("🔍 Ничего не найдено.")
+        return
+    
+    lines = [f"#{note_id}. {note_preview(notes_store.get(chat_id, note_id))}"
+             for note_id in found[:BotConfig.MAX_SEARCH_RESULTS]]
+    response = f"🔍 Найдено заметок: {len(found)}\n\n" + "\n".join(lines)
+    if len(found) > BotConfig.MAX_SEARCH_RESULTS:
+        response += f"\n\nПоказаны первые {BotConfig.MAX_SEARCH_RESULTS}. Уточните запрос."
+    await update.message.reply_text(response)
+
+REMINDER_USAGE = (
+    "❌ Используйте:\n"
+    "/create_reminder <часы> <минуты> <текст> - каждый день\n"
+    "/create_reminder будни <часы> <минуты> <текст> - по будням\n"
+    "/create_reminder каждые <минуты> <текст> - каждые N минут\n"
+    "/create_reminder <ГГГГ-ММ-ДД> <часы> <минуты> <текст> - один раз\n\n"
+    "Пример: /create_reminder 9 30 Позвонить маме"
+)
+
+def parse_reminder_args(args):
+    """Разбирает аргументы /create_reminder в новое напоминание. Ошибки - ValueError с текстом для пользователя"""
+    reminder = Reminder()
+    args = list(args)
+    if args and args[0].lower() in ("каждые", "every"):
+        if len(args) < 3:
+            raise ValueError(REMINDER_USAGE)
         try:
-            hours = int(context.args[0])
-            minutes = int(context.args[1])
-            reminder_text = ' '.join(context.args[2:])
-            
-            if hours < 0 or hours > 23 or minutes < 0 or minutes > 59:
-                await update.message.reply_text("❌ Неверное время! Часы: 0-23, Минуты: 0-59")
-                return
-            
-            if user_id not in user_reminders:
-                user_reminders[user_id] = []
-            
-            user_reminders[user_id].append({
-                "hours": hours,
-                "minutes": minutes,
-                "text": reminder_text
-            })
-            
-            reminder_number = len(user_reminders[user_id])
-            
-            await update.message.reply_text(
-                f"✅ Напоминание создано!\n\n"
-                f"🔔 Номер: {reminder_number}\n"
-                f"⏰ Время: {hours:02d}:{minutes:02d}\n"
-                f"📝 Текст: {reminder_text}\n\n"
-                f"Чтобы удалить: /delete_reminder {reminder_number}"
-            )
-            print(f"✅ Напоминание #{reminder_number} создано для пользователя {user_id}")
-            
+            interval = int(args[1])
         except ValueError:
-            await update.message.reply_text("❌ Ошибка: часы и минуты должны быть числами")
+            raise ValueError("❌ Интервал должен быть числом минут")
+        if not 1 <= interval <= BotConfig.MAX_REMINDER_INTERVAL:
+            raise ValueError(f"❌ Интервал: от 1 до {BotConfig.MAX_REMINDER_INTERVAL} минут")
+        reminder.rule, reminder.interval = "every", interval
+        text_args = args[2:]
     else:
-        await update.message.reply_text(
-            "❌ Используйте: /create_reminder <часы> <минуты> <текст>\n\n"
-            "Пример: /create_reminder 9 30 Позвонить маме"
-        )
+        if args and args[0].lower() in ("будни", "weekdays"):
+            reminder.rule = "weekdays"
+            args = args[1:]
+        elif args and re.fullmatch(r"\d{4}-\d{2}-\d{2}", args[0]):
+            try:
+                reminder.date = datetime.date.fromisoformat(args[0]).isoformat()
+                reminder.rule = "once"
+            except ValueError:
+                raise ValueError("❌ Неверная дата! Формат: ГГГГ-ММ-ДД")
+            args = args[1:]
+        if len(args) < 3:
+            raise ValueError(REMINDER_USAGE)
+        try:
+            hours, minutes = int(args[0]), int(args[1])
+        except ValueError:
+            raise ValueError("❌ Ошибка: часы и минуты должны быть числами")
+        if hours < 0 or hours > 23 or minutes < 0 or minutes > 59:
+            raise ValueError("❌ Неверное время! Часы: 0-23, Минуты: 0-59")
+        reminder.hours, reminder.minutes = hours, minutes
+        text_args = args[2:]
+
+    reminder.text = sys.intern(' '.join(text_args))
+    if len(reminder.text) > BotConfig.MAX_TEXT_LENGTH:
+        raise ValueError(f"❌ Текст слишком длинный (максимум {BotConfig.MAX_TEXT_LENGTH} символов).")
+    return reminder
+
+async def create_reminder(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Создание напоминания"""
+    user_id = update.effective_chat.id
+    
+    try:
+        reminder = parse_reminder_args(context.args or [])
+    except ValueError as e:
+        await update.message.reply_text(str(e))
+        return
+    
+    if len(user_reminders.get(user_id, ())) >= BotConfig.MAX_REMINDERS_PER_CHAT:
+        await update.message.reply_text(f"❌ Достигнут лимит напоминаний ({BotConfig.MAX_REMINDERS_PER_CHAT}). Удалите ненужные.")
+        return
+    
+    reminder.id = next(reminder_ids)
+    reminder.next_fire = compute_next_fire(reminder, time.time(), reminder_timezone(user_id))
+    if reminder.next_fire is None:
+        await update.message.reply_text("❌ Это время уже прошло.")
+        return
+    
+    user_reminders.setdefault(user_id, []).append(reminder)
+    storage.save_reminder(user_id, reminder)
+    render_cache.invalidate(("reminders", user_id))
+    schedule_reminder(context.application, user_id, reminder)
+    
+    reminder_number = len(user_reminders[user_id])
+    
+    await update.message.reply_text(
+        f"✅ Напоминание создано!\n\n"
+        f"🔔 Номер: {reminder_number}\n"
+        f"⏰ Время: {describe_schedule(reminder)}\n"
+        f"📝 Текст: {reminder.text}\n\n"
+        f"Чтобы удалить: /delete_reminder {reminder_number}"
+    )
+    logger.debug("Напоминание создано", extra={"chat_id": user_id, "number": reminder_number})
 
 async def delete_reminder(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Удаление напоминания"""
@@ -422,18 +3184,16 @@ async def delete_reminder(update: Update, context: ContextTypes.DEFAULT_TYPE):
                 await update.message.reply_text("❌ Напоминание с таким номером не найдено.")
                 return
             
-            removed_reminder = user_reminders[user_id].pop(reminder_number)
-            
-            if not user_reminders[user_id]:
-                del user_reminders[user_id]
+            removed_reminder = user_reminders[user_id][reminder_number]
+            remove_reminder(user_id, removed_reminder)
             
             await update.message.reply_text(
                 f"✅ Напоминание удалено!\n\n"
                 f"🔔 Номер: {reminder_number + 1}\n"
-                f"⏰ Время: {removed_reminder['hours']:02d}:{removed_reminder['minutes']:02d}\n"
-                f"📝 Текст: {removed_reminder['text']}"
+                f"⏰ Время: {describe_schedule(removed_reminder)}\n"
+                f"📝 Текст: {removed_reminder.text}"
             )
-            print(f"🗑️ Напоминание #{reminder_number + 1} удалено для пользователя {user_id}")
+            logger.debug("Напоминание удалено", extra={"chat_id": user_id, "number": reminder_number + 1})
             
         except ValueError:
             await update.message.reply_text("❌ Номер напоминания должен быть числом.")
@@ -442,77 +3202,40 @@ async def delete_reminder(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
 async def list_reminders(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Показать список напоминаний"""
-    user_id = update.effective_chat.id
-    
-    if user_id in user_reminders and user_reminders[user_id]:
-        reminders_list = []
-        for i, reminder_data in enumerate(user_reminders[user_id]):
-            reminders_list.append(
-                f"🔔 {i+1}. В {reminder_data['hours']:02d}:{reminder_data['minutes']:02d}\n"
-                f"   📝 {reminder_data['text']}"
-            )
-        
-        response = "📋 Ваши напоминания:\n\n" + "\n".join(reminders_list)
-        response += "\n\n💡 Чтобы удалить напоминание: /delete_reminder <номер>"
-    else:
-        response = (
-            "🔔 У вас пока нет напоминаний.\n\n"
-            "Чтобы создать напоминание, используйте:\n"
-            "/create_reminder <часы> <минуты> <текст>\n\n"
-            "Пример: /create_reminder 9 30 Позвонить маме"
-        )
-    
-    await update.message.reply_text(response)
+    await update.message.reply_text(render_reminders(update.effective_chat.id))
 
 async def handle_buttons(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Обработка нажатий кнопок"""
-    global daily
     user_text = update.message.text
     chat_id = update.effective_chat.id
 
     if user_text == "✍️ хочу интересную фразу":
-        response = f"{create_poem()}\n\ncreate by random"
+        response = f"{create_poem(chat_id)}\n\ncreate by random"
     
     elif user_text == "📝 заметки":
-        if chat_id in user_notes and user_notes[chat_id]:
-            notes_list = "\n".join([f"{i+1}. {note}" for i, note in enumerate(user_notes[chat_id])])
-            response = f"📋 Ваши заметки:\n\n{notes_list}"
-        else:
-            response = "📝 У вас пока нет заметок."
+        rendered = render_notes(chat_id)
+        if rendered:
+            text, keyboard = rendered
+            await update.message.reply_text(text, reply_markup=keyboard)
+            return
+        response = "📝 У вас пока нет заметок."
     
     elif user_text == "🔔 напоминания":
         await list_reminders(update, context)
         return
 
     elif user_text == "❓помощь":
-        response = (
-            "ℹ️ Доступные команды:\n\n"
-            "📝 ЗАМЕТКИ:\n"
-            "/create_note <текст> - Создать заметку\n"
-            "/delete_note <номер> - Удалить заметку\n\n"
-            "🔔 НАПОМИНАНИЯ:\n"
-            "/create_reminder <часы> <минуты> <текст> - Создать напоминание\n"
-            "/delete_reminder <номер> - Удалить напоминание\n"
-            "/list_reminders - Показать все напоминания\n\n"
-            "⚙️ ОБЩИЕ:\n"
-            "/start - Показать клавиатуру\n"
-            "/help - Показать справку\n"
-            "/set_time - Установить время уведомлений\n\n"
-            "Или используйте кнопки ниже:"
-        )
+        response = HELP_TEXT
     
     elif user_text.startswith("ежедневные сообщения"):
-        if daily == "включены":
-            daily = "отключены"
-            if chat_id in users_for_daily:
-                users_for_daily.remove(chat_id)
+        if chat_id in users_for_daily:
+            set_daily_enabled(chat_id, False)
             response = "Ежедневные сообщения отключены!"
         else:
-            daily = "включены"
-            users_for_daily.add(chat_id)
+            set_daily_enabled(chat_id, True)
             response = "Ежедневные сообщения включены!"
         
-        await update.message.reply_text(response, reply_markup=get_main_keyboard())
+        await update.message.reply_text(response, reply_markup=get_main_keyboard(chat_id))
         return
     
     else:
@@ -520,68 +3243,236 @@ async def handle_buttons(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
     await update.message.reply_text(response)
 
+def is_admin(update: Update):
+    return update.effective_user is not None and update.effective_user.id in ADMIN_IDS
+
+async def export_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Команда /export [ndjson|csv] - выгрузка всего состояния файлом (только для ADMIN_IDS)"""
+    if not is_admin(update):
+        return
+    fmt = context.args[0].lower() if context.args else "ndjson"
+    if fmt not in DUMP_FORMATS:
+        await update.message.reply_text("❌ Используйте: /export [ndjson|csv]")
+        return
+
+    path = temp_path(f".{fmt}.gz")
+    try:
+        with gzip.open(path, "wb") as file:
+            async for data in export_dump(fmt):
+                await asyncio.to_thread(file.write, data)
+        if os.path.getsize(path) > BotConfig.TELEGRAM_UPLOAD_LIMIT:
+            await update.message.reply_text("❌ Выгрузка больше лимита Telegram. Используйте GET /admin/export")
+            return
+        with open(path, "rb") as file:
+            await update.message.reply_document(file, filename=dump_filename(fmt) + ".gz")
+    finally:
+        os.remove(path)
+
+async def import_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Команда /import - загрузка выгрузки: в подписи к файлу или ответом на сообщение с файлом"""
+    if not is_admin(update):
+        return
+    message = update.message
+    document = message.document or (message.reply_to_message and message.reply_to_message.document)
+    if not document:
+        await message.reply_text("❌ Отправьте файл выгрузки с подписью /import или ответьте /import на сообщение с ним")
+        return
+    if (document.file_size or 0) > BotConfig.TELEGRAM_DOWNLOAD_LIMIT:
+        await message.reply_text("❌ Файл больше лимита Telegram. Используйте POST /admin/import")
+        return
+
+    fmt = "csv" if ".csv" in (document.file_name or "").lower() else "ndjson"
+    path = temp_path(f".{fmt}")
+    try:
+        telegram_file = await context.bot.get_file(document.file_id)
+        await telegram_file.download_to_drive(path)
+        result = await import_dump(context.application, path, fmt)
+    except ValueError as error:
+        await message.reply_text(f"❌ {error}")
+        return
+    finally:
+        os.remove(path)
+    imported = ", ".join(f"{kind}: {count}" for kind, count in result["imported"].items()) or "ничего"
+    errors = "".join(f"\n• {error}" for error in result["errors"])
+    await message.reply_text(
+        f"✅ Загружено ({result['seconds']} с): {imported}\nПропущено: {result['skipped']}{errors}"
+    )
+
 async def help_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Команда /help"""
-    help_text = (
-        "ℹ️ Доступные команды:\n\n"
-        "📝 ЗАМЕТКИ:\n"
-        "/create_note <текст> - Создать заметку\n"
-        "/delete_note <номер> - Удалить заметку\n\n"
-        "🔔 НАПОМИНАНИЯ:\n"
-        "/create_reminder <часы> <минуты> <текст> - Создать напоминание\n"
-        "/delete_reminder <номер> - Удалить напоминание\n"
-        "/list_reminders - Показать все напоминания\n\n"
-        "⚙️ ОБЩИЕ:\n"
-        "/start - Показать клавиатуру\n"
-        "/help - Показать справку\n"
-        "/set_time - Установить время уведомлений\n\n"
-        "Или используйте кнопки ниже:"
-    )
-    await update.message.reply_text(help_text)
+    await update.message.reply_text(HELP_TEXT)
 
 # ========== ЗАПУСК ПРИЛОЖЕНИЯ ==========
 
-def main():
-    print("🟢 Запуск бота...")
-    print(f"✅ BOT_TOKEN: {'установлен' if BOT_TOKEN else 'НЕ УСТАНОВЛЕН'}")
-    print(f"🌐 RENDER_URL: {RENDER_URL or 'не установлен'}")
-    print(f"⏰ Часовой пояс: Екатеринбург")
-    
-    # Запускаем анти-засыпание в отдельном потоке
-    if RENDER_URL:
-        pinger_thread = Thread(target=keep_alive_pinger, daemon=True)
-        pinger_thread.start()
-        print("🔄 Анти-засыпание: активировано")
-    else:
-        print("⚠️ Анти-засыпание: отключено (RENDER_URL не установлен)")
-    
-    # Запускаем веб-сервер в отдельном потоке
-    web_thread = Thread(target=run_web_server, daemon=True)
-    web_thread.start()
-    print(f"🌐 Веб-сервер: запущен на порту {PORT}")
-    
-    # Инициализируем бота
-    bot_app = Application.builder().token(BOT_TOKEN).build()
+async def start_receiving_updates(app: Application):
+    """Включает webhook, а если он недоступен - long polling. Возвращает True для webhook"""
+    if USE_WEBHOOK and RENDER_URL:
+        webhook_url = RENDER_URL.rstrip('/') + WEBHOOK_PATH
+        try:
+            await app.bot.set_webhook(
+                url=webhook_url,
+                secret_token=WEBHOOK_SECRET,
+                allowed_updates=Update.ALL_TYPES
+            )
+            logger.info("Webhook установлен", extra={"url": webhook_url})
+            return True
+        except TelegramError as e:
+            logger.error("Не удалось установить webhook, переключаемся на polling", extra={"error": repr(e)})
+
+    await app.updater.start_polling(allowed_updates=Update.ALL_TYPES)
+    logger.info("Получение обновлений: polling")
+    return False
+
+async def run_bot(app: Application):
+    """Запускает приложение и работает до сигнала остановки"""
+    metrics.gauge("bot_update_queue_size", app.update_queue.qsize, "Обновления, ожидающие обработки")
+    metrics.gauge("bot_scheduler_jobs", lambda: len(scheduler), "Задачи в планировщике")
+    metrics.gauge("bot_storage_pending_writes", lambda: storage.pending, "Изменения, ожидающие записи")
+    metrics.gauge("bot_sends_in_flight", lambda: broadcaster.in_flight, "Отправки в процессе")
+    if sharding is not None:
+        metrics.gauge("bot_owned_shards", lambda: len(sharding.owned), "Шарды, принадлежащие процессу")
+    receives_updates = BOT_ROLE != "scheduler"
+    stop_event = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        try:
+            loop.add_signal_handler(sig, stop_event.set)
+        except NotImplementedError:
+            pass
+    profiler.start(loop)
+
+    # Веб-сервер поднимаем первым, чтобы health check отвечал во время запуска бота.
+    # Процесс-планировщик не принимает обновления: ему нужен только бот для отправки
+    if early_health is not None:
+        early_health.close()
+    web_runner = await start_web_server(app) if receives_updates else None
+    mark_startup("web_server")
+    # Состояние и тексты читаются в потоке: тем временем веб-сервер отвечает на запросы
+    await asyncio.to_thread(load_state)
+    mark_startup("load_state")
+    await asyncio.to_thread(content.load)
+    mark_startup("content")
+    workers = spawn_workers() if WORKERS > 1 and BOT_ROLE == "all" and sharding is not None else []
+
+    try:
+        await app.initialize()
+        mark_startup("initialize")
+        # Запускаем планировщик и фоновую запись в хранилище
+        start_time_checker(app)
+        start_background(storage.run(), "storage")
+        start_background(content.run(), "content")
+        mark_startup("scheduler")
+
+        webhook_active = False
+        if receives_updates:
+            webhook_active = await start_receiving_updates(app)
+            await app.start()
+        mark_startup("receiving")
+
+        # Анти-засыпание нужно только для polling: в режиме webhook сервер будят сами обновления
+        if RENDER_URL and not webhook_active:
+            start_background(keep_alive_pinger(), "keep-alive")
+
+        startup_phases["total"] = round(time.perf_counter() - STARTED, 4)
+        for phase, seconds in startup_phases.items():
+            metrics.set("bot_startup_seconds", seconds, phase=phase)
+        logger.info("Все системы запущены", extra={
+            "scheduler_jobs": len(scheduler), "webhook": webhook_active, "role": BOT_ROLE, "worker_id": WORKER_ID,
+            "startup": startup_phases,
+        })
+
+        await stop_event.wait()
+    finally:
+        # Процессы-планировщики получают SIGTERM и останавливаются так же, параллельно с нами
+        for worker in workers:
+            worker.terminate()
+        if app.updater.running:
+            await app.updater.stop()
+        if app.running:
+            await app.stop()
+        await drain_outbound(BotConfig.SHUTDOWN_GRACE)
+        await app.shutdown()
+        if web_runner is not None:
+            await web_runner.cleanup()
+        await storage.flush()
+        if sharding is not None:
+            # Отдаем шарды сразу, не дожидаясь истечения аренды
+            for shard in list(sharding.owned):
+                await asyncio.to_thread(storage.release_lease, shard, WORKER_ID)
+        for worker in workers:
+            worker.wait()
+
+async def drain_outbound(timeout):
+    """Остановка без потерь: новые задачи и отправки не начинаются, начатые дожидаются (не дольше timeout).
+    Чаты, до которых рассылка не дошла, остаются в ее контрольной точке и получат сообщение после перезапуска"""
+    started = time.monotonic()
+    broadcaster.draining = True
+    await scheduler.stop(timeout)
+    while broadcaster.in_flight and time.monotonic() - started < timeout:
+        await asyncio.sleep(0.05)
+    logger.info("Отправки остановлены", extra={
+        "in_flight": broadcaster.in_flight, "elapsed": round(time.monotonic() - started, 3),
+    })
+
+def spawn_workers():
+    """Запускает WORKERS - 1 дочерних процессов-планировщиков с общим хранилищем"""
+    env = {**os.environ, "BOT_ROLE": "scheduler", "WORKERS": "1", "SHARD_COUNT": str(SHARD_COUNT)}
+    env.pop("WORKER_ID", None)
+    import subprocess  # нужен только при WORKERS > 1
+    workers = [subprocess.Popen([sys.executable, os.path.abspath(__file__)], env=env) for _ in range(WORKERS - 1)]
+    logger.info("Запущены процессы-планировщики", extra={"workers": len(workers), "shards": SHARD_COUNT})
+    return workers
+
+def create_application(base_url=None):
+    """Собирает Application со всеми обработчиками. base_url позволяет направить бота на другой сервер Bot API"""
+    builder = (
+        Application.builder()
+        .token(BOT_TOKEN)
+        .concurrent_updates(FairChatUpdateProcessor(
+            BotConfig.HANDLER_CONCURRENCY, BotConfig.MAX_PENDING_UPDATES_PER_CHAT
+        ))
+    )
+    if base_url:
+        builder = builder.base_url(base_url)
+    bot_app = builder.build()
+
+    # Раньше всех обработчиков (анти-флуд стоит еще раньше, в FairChatUpdateProcessor)
+    bot_app.add_handler(TypeHandler(Update, track_chat), group=-1)
 
     # Добавляем обработчики
-    bot_app.add_handler(CommandHandler("start", start))
-    bot_app.add_handler(CommandHandler("help", help_command))
-    bot_app.add_handler(CommandHandler("set_time", set_time_command))
-    bot_app.add_handler(CommandHandler("create_note", create_note))
-    bot_app.add_handler(CommandHandler("delete_note", delete_note))
-    bot_app.add_handler(CommandHandler("create_reminder", create_reminder))
-    bot_app.add_handler(CommandHandler("delete_reminder", delete_reminder))
-    bot_app.add_handler(CommandHandler("list_reminders", list_reminders))
-    bot_app.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, handle_buttons))
-
-    # Запускаем планировщик
-    start_time_checker(bot_app)
-
-    print("✅ Все системы запущены!")
-    print("🔔 Проверки каждые 5 минут")
-    
+    bot_app.add_handler(CommandHandler("start", timed(start)))
+    bot_app.add_handler(CommandHandler("help", timed(help_command)))
+    bot_app.add_handler(CommandHandler("set_time", timed(set_time_command)))
+    bot_app.add_handler(CommandHandler("set_timezone", timed(set_timezone_command)))
+    bot_app.add_handler(CommandHandler("create_note", timed(create_note)))
+    bot_app.add_handler(CommandHandler("delete_note", timed(delete_note)))
+    bot_app.add_handler(CommandHandler("search_notes", timed(search_notes)))
+    bot_app.add_handler(CallbackQueryHandler(timed(notes_page_callback), pattern=r"^notes:\d+$"))
+    bot_app.add_handler(CommandHandler("create_reminder", timed(create_reminder)))
+    bot_app.add_handler(CommandHandler("delete_reminder", timed(delete_reminder)))
+    bot_app.add_handler(CommandHandler("list_reminders", timed(list_reminders)))
+    bot_app.add_handler(CommandHandler("export", timed(export_command)))
+    bot_app.add_handler(CommandHandler("import", timed(import_command)))
+    bot_app.add_handler(MessageHandler(filters.Document.ALL & filters.CaptionRegex(r"^/import\b"), timed(import_command)))
+    bot_app.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, timed(handle_buttons)))
+    return bot_app
+
+def main():
+    logger.info("Запуск бота", extra={
+        "render_url": RENDER_URL, "timezone": BotConfig.TIMEZONE.key, "role": BOT_ROLE
+    })
+
+    # Состояние загружается в run_bot, уже после запуска веб-сервера
+    bot_app = create_application()
+    mark_startup("build")
+
     # Запускаем бота
-    bot_app.run_polling()
+    try:
+        asyncio.run(run_bot(bot_app))
+    finally:
+        storage.close()
+        logger.info("Данные сохранены")
+        log_listener.stop()
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()
@@ -0,0 +1,513 @@
+"""Тесты бота без сети и Telegram: хранилище в памяти, отправка подменяется.
+
+Запуск:
+    python -m pytest -q
+"""
+
+import asyncio
+import collections
+import contextlib
+import datetime
+import json
+import logging
+import os
+import queue
+import random
+import sqlite3
+import time
+import types
+
+os.environ.setdefault("BOT_TOKEN", "123:test")
+os.environ.setdefault("STORAGE_BACKEND", "memory")
+os.environ.setdefault("LOG_LEVEL", "CRITICAL")
+
+import pytest
+from aiohttp.test_utils import TestClient, TestServer
+
+import bot
+
+BERLIN = bot.get_timezone("Europe/Berlin")
+
+
+def at(tz, *args):
+    return datetime.datetime(*args, tzinfo=tz).timestamp()
+
+
+@pytest.fixture
+def chats(monkeypatch):
+    """Пустое состояние бота; отправленные напоминания копятся в списке (chat_id, текст, пропущено ли)"""
+    sent = []
+
+    async def deliver(app, user_id, text, catch_up=False):
+        sent.append((user_id, text, catch_up))
+        return True
+
+    monkeypatch.setattr(bot, "user_reminders", {})
+    monkeypatch.setattr(bot, "chat_settings", {})
+    monkeypatch.setattr(bot, "unreachable_chats", set())
+    monkeypatch.setattr(bot, "scheduler", bot.ReminderScheduler())
+    monkeypatch.setattr(bot, "deliver_reminder", deliver)
+    return sent
+
+
+def add_reminder(chat_id, **fields):
+    reminder = bot.Reminder(id=len(bot.user_reminders) + 1, text=f"r{chat_id}", **fields)
+    bot.user_reminders.setdefault(chat_id, []).append(reminder)
+    return reminder
+
+
+def utc_minute(*args):
+    return int(datetime.datetime(*args, tzinfo=datetime.timezone.utc).timestamp() // 60)
+
+
+def scheduled_at(reminder):
+    entry = bot.scheduler._jobs.get(reminder)
+    return entry and entry[0]
+
+
+# ========== compute_next_fire ==========
+
+def test_weekdays_skips_weekend():
+    reminder = bot.Reminder(rule="weekdays", hours=9, minutes=0)
+    # пятница, 10:00 -> понедельник, 09:00
+    assert bot.compute_next_fire(reminder, at(BERLIN, 2025, 6, 6, 10, 0), BERLIN) == at(BERLIN, 2025, 6, 9, 9, 0)
+
+
+def test_weekdays_same_day_before_time():
+    reminder = bot.Reminder(rule="weekdays", hours=9, minutes=0)
+    assert bot.compute_next_fire(reminder, at(BERLIN, 2025, 6, 9, 8, 59), BERLIN) == at(BERLIN, 2025, 6, 9, 9, 0)
+
+
+def test_fire_time_is_exclusive():
+    reminder = bot.Reminder(rule="daily", hours=9, minutes=0)
+    assert bot.compute_next_fire(reminder, at(BERLIN, 2025, 6, 9, 9, 0), BERLIN) == at(BERLIN, 2025, 6, 10, 9, 0)
+
+
+def test_daily_keeps_local_time_across_dst():
+    reminder = bot.Reminder(rule="daily", hours=9, minutes=0)
+    fire = bot.compute_next_fire(reminder, at(BERLIN, 2025, 3, 29, 12, 0), BERLIN)
+    assert fire == at(datetime.timezone.utc, 2025, 3, 30, 7, 0)
+
+
+def test_once_in_future_and_past():
+    reminder = bot.Reminder(rule="once", hours=18, minutes=30, date="2025-07-01")
+    assert bot.compute_next_fire(reminder, at(BERLIN, 2025, 7, 1, 12, 0), BERLIN) == at(BERLIN, 2025, 7, 1, 18, 30)
+    assert bot.compute_next_fire(reminder, at(BERLIN, 2025, 7, 1, 18, 30), BERLIN) is None
+
+
+def test_every_without_previous_fire():
+    reminder = bot.Reminder(rule="every", interval=15)
+    assert bot.compute_next_fire(reminder, 1000.0, BERLIN) == 1000.0 + 15 * 60
+
+
+def test_every_keeps_grid_after_downtime():
+    reminder = bot.Reminder(rule="every", interval=10, next_fire=1000.0)
+    # пропущено несколько срабатываний: следующее - ближайшая точка той же сетки
+    assert bot.compute_next_fire(reminder, 1000.0 + 35 * 60, BERLIN) == 1000.0 + 40 * 60
+
+
+def test_every_future_fire_is_kept():
+    reminder = bot.Reminder(rule="every", interval=10, next_fire=5000.0)
+    assert bot.compute_next_fire(reminder, 1000.0, BERLIN) == 5000.0
+
+
+# ========== Веб-сервер ==========
+
+async def admin_statuses(app):
+    headers = {"Authorization": "Bearer secret"}
+    async with TestClient(TestServer(bot.create_web_app(app))) as client:
+        export = await client.get("/admin/export", headers=headers)
+        imported = await client.post("/admin/import", data=b"", headers=headers)
+        return export.status, imported.status
+
+
+def test_admin_dump_waits_for_loaded_state(chats, monkeypatch):
+    monkeypatch.setattr(bot, "ADMIN_TOKEN", "secret")
+    app = types.SimpleNamespace(running=False)
+    # load_state еще идет в потоке: выгрузка и загрузка работали бы с заглушкой хранилища
+    assert asyncio.run(admin_statuses(app)) == (503, 503)
+    app.running = True
+    assert asyncio.run(admin_statuses(app)) == (200, 200)
+
+
+# ========== Логирование ==========
+
+def test_queued_log_keeps_traceback_separate():
+    records = queue.SimpleQueue()
+    log = logging.Logger("test")
+    log.addHandler(bot.RecordQueueHandler(records))
+    try:
+        {}["ключ"]
+    except KeyError:
+        log.exception("Ошибка в чате %s", 42, extra={"chat_id": 42})
+    entry = json.loads(bot.JsonFormatter().format(records.get_nowait()))
+    assert entry["msg"] == "Ошибка в чате 42"
+    assert entry["chat_id"] == 42
+    assert entry["exc"].startswith("Traceback") and "KeyError" in entry["exc"]
+
+
+# ========== Пропущенные напоминания ==========
+
+def test_plan_reminder_sorts_loaded_reminders(chats):
+    now = time.time()
+    future = add_reminder(1, rule="every", interval=10, next_fire=now + 60)
+    past = add_reminder(2, rule="every", interval=10, next_fire=now - 60)
+    legacy = add_reminder(3, rule="daily", hours=9, minutes=0)
+    missed = []
+    for chat_id, reminder in ((1, future), (2, past), (3, legacy)):
+        bot.plan_reminder(None, chat_id, reminder, now, missed)
+    assert missed == [(2, past)]
+    assert scheduled_at(future) == now + 60
+    assert scheduled_at(past) is None
+    # напоминание старой схемы без next_fire просто ставится на ближайшее срабатывание
+    assert legacy.next_fire > now and scheduled_at(legacy) == legacy.next_fire
+
+
+def test_replay_sends_each_missed_reminder_once(chats):
+    now = time.time()
+    # за час простоя напоминание "каждые 5 минут" должно было сработать 12 раз
+    frequent = add_reminder(1, rule="every", interval=5, next_fire=now - 3600)
+    daily = add_reminder(2, rule="daily", hours=9, minutes=0, next_fire=now - 600)
+    asyncio.run(bot.replay_missed_reminders(None, [(1, frequent), (2, daily)]))
+    assert sorted(chats) == [(1, "r1", True), (2, "r2", True)]
+    for reminder in (frequent, daily):
+        assert reminder.next_fire > now
+        assert scheduled_at(reminder) == reminder.next_fire
+
+
+def test_replay_skips_reminders_older_than_window(chats):
+    now = time.time()
+    stale = add_reminder(1, rule="daily", hours=9, minutes=0, next_fire=now - bot.BotConfig.REMINDER_CATCHUP_WINDOW - 60)
+    asyncio.run(bot.replay_missed_reminders(None, [(1, stale)]))
+    assert chats == []
+    assert stale.next_fire > now and scheduled_at(stale) == stale.next_fire
+
+
+def test_replay_removes_fired_once_reminder(chats):
+    once = add_reminder(1, rule="once", hours=9, minutes=0, date="2000-01-01", next_fire=time.time() - 60)
+    asyncio.run(bot.replay_missed_reminders(None, [(1, once)]))
+    assert chats == [(1, "r1", True)]
+    assert 1 not in bot.user_reminders
+    assert scheduled_at(once) is None
+
+
+def test_replay_skips_deleted_and_unreachable_chats(chats):
+    now = time.time()
+    deleted = bot.Reminder(id=1, rule="every", interval=5, text="x", next_fire=now - 60)
+    blocked = add_reminder(2, rule="every", interval=5, next_fire=now - 60)
+    bot.unreachable_chats.add(2)
+    asyncio.run(bot.replay_missed_reminders(None, [(1, deleted), (2, blocked)]))
+    assert chats == []
+
+
+# ========== UtcOffsetCache ==========
+
+def test_offset_around_berlin_transitions():
+    cache = bot.UtcOffsetCache()
+    assert cache.offset("Europe/Berlin", utc_minute(2025, 3, 30, 0, 59)) == 60
+    assert cache.offset("Europe/Berlin", utc_minute(2025, 3, 30, 1, 0)) == 120
+    assert cache.offset("Europe/Berlin", utc_minute(2025, 10, 26, 0, 59)) == 120
+    assert cache.offset("Europe/Berlin", utc_minute(2025, 10, 26, 1, 0)) == 60
+
+
+def test_spring_forward_fires_skipped_minutes_at_transition():
+    cache = bot.UtcOffsetCache()
+    cache.offset("Europe/Berlin", utc_minute(2025, 3, 30, 0, 59))
+    # 02:00-02:59 местного времени не существует: наступают вместе с 03:00
+    assert cache.local_minutes("Europe/Berlin", utc_minute(2025, 3, 30, 1, 0)) == list(range(120, 181))
+    assert cache.local_minutes("Europe/Berlin", utc_minute(2025, 3, 30, 1, 1)) == [181]
+
+
+def test_fall_back_skips_repeated_hour():
+    cache = bot.UtcOffsetCache()
+    assert cache.local_minutes("Europe/Berlin", utc_minute(2025, 10, 26, 0, 30)) == [150]
+    assert cache.local_minutes("Europe/Berlin", utc_minute(2025, 10, 26, 1, 30)) == []
+    assert cache.local_minutes("Europe/Berlin", utc_minute(2025, 10, 26, 2, 0)) == [180]
+
+
+@pytest.mark.parametrize("timezone", ["Europe/Berlin", "America/New_York", "Australia/Lord_Howe", "Asia/Kolkata"])
+def test_every_local_minute_once_per_day(timezone):
+    cache = bot.UtcOffsetCache()
+    counts = collections.Counter()
+    for minute in range(utc_minute(2025, 1, 1, 0, 0), utc_minute(2026, 1, 1, 0, 0)):
+        counts.update(cache.local_minutes(timezone, minute))
+    assert len(counts) == 1440
+    assert set(counts.values()) == {365}
+
+
+# ========== Индекс ежедневных рассылок ==========
+
+def index_contents(index):
+    return index._slots, index._chat_slots, index._zones
+
+
+def test_bulk_index_updates_match_single_ones():
+    rng = random.Random(1)
+    zones = ["Europe/Berlin", "Asia/Tokyo"]
+    chats = {
+        chat_id: {"morning": (rng.randrange(24), 0), "evening": (21, rng.choice((0, 30))), "timezone": rng.choice(zones)}
+        for chat_id in rng.sample(range(-10**6, 10**6), 3000)
+    }
+    single, bulk = bot.DailyScheduleIndex(), bot.DailyScheduleIndex()
+    for chat_id, settings in chats.items():
+        single.add(chat_id, settings)
+    bulk.add_many(list(chats.items())[:1000])
+    bulk.add_many(chats.items())
+    assert index_contents(bulk) == index_contents(single)
+    assert all(list(chat_ids) == sorted(chat_ids) for chat_ids in bulk._slots.values())
+
+    moved = {chat_id: {**chats[chat_id], "timezone": "UTC"} for chat_id in list(chats)[::7]}
+    gone = list(chats)[1::5]
+    for chat_id, settings in moved.items():
+        single.add(chat_id, settings)
+    for chat_id in gone:
+        single.remove(chat_id)
+    bulk.add_many(moved.items())
+    bulk.remove_many(gone)
+    assert index_contents(bulk) == index_contents(single)
+
+
+def test_chat_id_set_bulk_updates():
+    chats = bot.ChatIdSet([5, 1, 3])
+    chats.update([4, 3, 2])
+    chats.difference_update([1, 4, 9])
+    assert list(chats) == [2, 3, 5]
+    assert 3 in chats and 4 not in chats
+
+
+# ========== Хранилище ==========
+
+@pytest.fixture
+def sqlite_storage(tmp_path):
+    storage = bot.SQLiteStorage(str(tmp_path / "bot.db"))
+    yield storage
+    storage.close()
+
+
+def test_rejected_write_does_not_drop_its_batch(sqlite_storage):
+    sqlite_storage.add_note(1, 10, "первая")
+    sqlite_storage.add_note(1, 10, "дубликат номера")
+    sqlite_storage.set_daily(2, True)
+    sqlite_storage.add_note(3, 11, "другой чат")
+    asyncio.run(sqlite_storage.flush())
+    assert sqlite_storage.pending == 0
+    assert sqlite_storage.load_notes(1) == [(10, "первая")]
+    assert sqlite_storage.load_notes(3) == [(11, "другой чат")]
+    assert sqlite_storage.load()["daily_users"] == {2}
+
+
+def test_batch_is_kept_while_database_is_locked(sqlite_storage, tmp_path):
+    sqlite_storage._conn.execute("PRAGMA busy_timeout = 0")
+    sqlite_storage.set_daily(1, True)
+    other = sqlite3.connect(str(tmp_path / "bot.db"), isolation_level=None)
+    other.execute("BEGIN IMMEDIATE")
+    with pytest.raises(sqlite3.OperationalError):
+        asyncio.run(sqlite_storage.flush())
+    sqlite_storage.set_daily(2, True)
+    assert sqlite_storage.pending == 2
+    other.execute("ROLLBACK")
+    other.close()
+    asyncio.run(sqlite_storage.flush())
+    assert sqlite_storage.pending == 0
+    assert sqlite_storage.load()["daily_users"] == {1, 2}
+
+
+# ========== Шардирование ==========
+
+@pytest.fixture
+def processes(tmp_path, monkeypatch, chats):
+    """Хранилища двух процессов над одной базой: свое (bot.storage, процесс "a") и чужое (процесс "b")"""
+    monkeypatch.setattr(bot, "WORKER_ID", "a")
+    monkeypatch.setattr(bot, "users_for_daily", bot.ChatIdSet())
+    monkeypatch.setattr(bot, "daily_index", bot.DailyScheduleIndex())
+    local = bot.SQLiteStorage(str(tmp_path / "bot.db"), track_changes=True)
+    other = bot.SQLiteStorage(str(tmp_path / "bot.db"), track_changes=True)
+    monkeypatch.setattr(bot, "storage", local)
+    yield local, other
+    local.close()
+    other.close()
+
+
+@contextlib.contextmanager
+def worker(monkeypatch, worker_id):
+    monkeypatch.setattr(bot, "WORKER_ID", worker_id)
+    yield
+    monkeypatch.setattr(bot, "WORKER_ID", "a")
+
+
+def coordinator_for(storage):
+    coordinator = bot.ShardCoordinator(storage, 1, "a")
+    coordinator.owned = {0}
+    return coordinator
+
+
+def test_hash_ring_is_stable_and_moves_few_chats():
+    chats = range(1, 20001)
+    ring, same = bot.HashRing(8), bot.HashRing(8)
+    assert [ring.shard(chat_id) for chat_id in chats] == [same.shard(chat_id) for chat_id in chats]
+    grown = bot.HashRing(9)
+    moved = sum(ring.shard(chat_id) != grown.shard(chat_id) for chat_id in chats)
+    # при добавлении шарда переезжает примерно 1/9 чатов, и только на новый шард
+    assert moved < len(chats) * 0.2
+    assert all(grown.shard(chat_id) == 8 for chat_id in chats if ring.shard(chat_id) != grown.shard(chat_id))
+
+
+def test_lease_handover(tmp_path):
+    storage = bot.SQLiteStorage(str(tmp_path / "bot.db"), track_changes=True)
+    try:
+        assert storage.acquire_lease(0, "a", 60)
+        assert storage.acquire_lease(0, "a", 60)
+        assert not storage.acquire_lease(0, "b", 60)
+        storage.release_lease(0, "a")
+        assert storage.acquire_lease(0, "b", 60)
+        # просроченную аренду забирает другой процесс
+        assert storage.acquire_lease(1, "a", -1)
+        assert storage.acquire_lease(1, "b", 60)
+        assert not storage.acquire_lease(1, "a", 60)
+    finally:
+        storage.close()
+
+
+def test_sync_keeps_unflushed_local_changes(processes, monkeypatch):
+    local, other = processes
+    reminder = add_reminder(7, rule="every", interval=5, next_fire=time.time() + 60)
+    local.save_reminder(7, reminder)
+    with worker(monkeypatch, "b"):
+        other.set_daily(7, True)
+        asyncio.run(other.flush())
+    asyncio.run(coordinator_for(local)._sync(None))
+    assert [r.id for r in bot.user_reminders[7]] == [reminder.id]
+    assert 7 in bot.users_for_daily
+
+
+def test_sync_rereads_chats_changed_during_read(processes, monkeypatch):
+    local, other = processes
+    coordinator = coordinator_for(local)
+    with worker(monkeypatch, "b"):
+        other.set_daily(7, True)
+        asyncio.run(other.flush())
+    load_chats = local.load_chats
+    created = []
+
+    def load_while_user_creates_reminder(chat_ids):
+        state = load_chats(chat_ids)
+        created.append(add_reminder(7, rule="every", interval=5, next_fire=time.time() + 60))
+        local.save_reminder(7, created[0])
+        return state
+
+    monkeypatch.setattr(local, "load_chats", load_while_user_creates_reminder)
+    asyncio.run(coordinator._sync(None))
+    # прочитанное состояние чата 7 старше нового напоминания: не применяется до следующего _sync
+    assert bot.user_reminders[7] == created
+    assert 7 not in bot.users_for_daily
+    monkeypatch.setattr(local, "load_chats", load_chats)
+    asyncio.run(coordinator._sync(None))
+    assert [r.id for r in bot.user_reminders[7]] == [created[0].id]
+    assert 7 in bot.users_for_daily
+
+
+def test_claimed_reminder_is_sent_when_sync_replaces_it(processes, chats, monkeypatch):
+    local, _ = processes
+    coordinator = coordinator_for(local)
+    monkeypatch.setattr(bot, "sharding", coordinator)
+    reminder = add_reminder(7, rule="every", interval=5, next_fire=time.time() - 1)
+    local.save_reminder(7, reminder)
+    claim = coordinator.claim
+
+    async def claim_during_sync(*args):
+        await local.flush()
+        state = await asyncio.to_thread(local.load_chats, [7])
+        claimed = await claim(*args)
+        bot.user_reminders[7] = state["reminders"][7]
+        return claimed
+
+    monkeypatch.setattr(coordinator, "claim", claim_during_sync)
+    asyncio.run(bot.fire_reminder(None, 7, reminder))
+    assert chats == [(7, "r7", False)]
+    current, = bot.user_reminders[7]
+    assert current is not reminder
+    assert current.next_fire > time.time() and scheduled_at(current) == current.next_fire
+
+
+# ========== Выгрузка и загрузка ==========
+
+def test_parse_csv_reminder():
+    record = bot.parse_record({
+        "type": "reminder", "chat_id": "42", "id": "7", "rule": "once", "hours": "8", "minutes": "05",
+        "interval": "", "date": "2025-07-01", "text": "встреча", "next_fire": "", "last_fired": "",
+    })
+    assert record == {
+        "type": "reminder", "chat_id": 42, "id": 7, "rule": "once", "hours": 8, "minutes": 5, "interval": None,
+        "date": "2025-07-01", "text": "встреча", "next_fire": None, "last_fired": None,
+    }
+
+
+def test_parse_json_chat_settings():
+    record = bot.parse_record('{"type": "chat_settings", "chat_id": 1, "morning": "07:30", '
+                              '"evening": "21:00", "timezone": "Europe/Berlin"}')
+    assert record["morning"] == (7, 30)
+    assert record["evening"] == (21, 0)
+
+
+@pytest.mark.parametrize("raw", [
+    {"type": "reminder", "chat_id": 1, "id": 1, "rule": "hourly", "hours": 1, "minutes": 0},
+    {"type": "reminder", "chat_id": 1, "id": 1, "rule": "every"},
+    {"type": "reminder", "chat_id": 1, "id": 1, "rule": "daily", "hours": 25, "minutes": 0},
+    {"type": "reminder", "chat_id": 1, "id": 1, "rule": "weekdays", "hours": 9, "minutes": 60},
+    {"type": "reminder", "chat_id": 1, "id": 1, "rule": "daily", "hours": -1, "minutes": 0},
+    {"type": "reminder", "chat_id": 1, "id": 1, "rule": "every", "interval": 0},
+    {"type": "reminder", "chat_id": 1, "id": 1, "rule": "every", "interval": -5},
+    {"type": "reminder", "chat_id": 1, "id": 1, "rule": "every", "interval": 1441},
+    {"type": "reminder", "chat_id": 1, "id": 0, "rule": "daily", "hours": 9, "minutes": 0},
+    {"type": "reminder", "chat_id": 1, "id": 1, "rule": "once", "hours": 9, "minutes": 0, "date": "2025-02-30"},
+    {"type": "note", "chat_id": 1, "id": -3, "text": "a"},
+    {"type": "chat_settings", "chat_id": 1, "morning": "25:00", "evening": "21:00", "timezone": "UTC"},
+    {"type": "chat_settings", "chat_id": 1, "morning": "07:00", "evening": "21:00", "timezone": "Mars/Base"},
+    {"type": "note", "chat_id": "x", "id": 1, "text": "a"},
+    {"type": "unknown", "chat_id": 1},
+    "[1, 2]",
+])
+def test_parse_rejects_invalid(raw):
+    with pytest.raises(ValueError):
+        bot.parse_record(raw)
+
+
+def test_import_never_stores_out_of_range_reminders(tmp_path, chats, monkeypatch):
+    monkeypatch.setattr(bot, "reminder_ids", iter(range(1, 100)))
+    path = tmp_path / "dump.ndjson"
+    rows = [
+        {"type": "reminder", "chat_id": 1, "id": 1, "rule": "daily", "hours": 25, "minutes": 0, "text": "a"},
+        {"type": "reminder", "chat_id": 1, "id": 2, "rule": "every", "interval": -5, "text": "b"},
+        {"type": "reminder", "chat_id": 1, "id": 3, "rule": "every", "interval": 0, "text": "c"},
+        {"type": "reminder", "chat_id": 1, "id": 4, "rule": "daily", "hours": 9, "minutes": 30, "text": "d"},
+    ]
+    path.write_text("".join(json.dumps(row) + "\n" for row in rows))
+    storage = bot.SQLiteStorage(str(tmp_path / "bot.db"))
+    monkeypatch.setattr(bot, "storage", storage)
+    try:
+        result = asyncio.run(bot.import_dump(None, str(path), "ndjson"))
+        assert result["imported"] == {"reminder": 1}
+        assert result["skipped"] == 3
+        assert [r.id for r in bot.user_reminders[1]] == [4]
+    finally:
+        storage.close()
+    restarted = bot.SQLiteStorage(str(tmp_path / "bot.db"))
+    try:
+        assert [r.id for r in restarted.load()["reminders"][1]] == [4]
+    finally:
+        restarted.close()
+
+
+def test_broken_stored_reminder_does_not_stop_startup(chats):
+    now = time.time()
+    broken = add_reminder(1, rule="daily", hours=25, minutes=0)
+    looping = add_reminder(1, rule="every", interval=-5, next_fire=now + 60)
+    healthy = add_reminder(2, rule="daily", hours=9, minutes=0)
+    missed = []
+    for chat_id, reminder in ((1, broken), (1, looping), (2, healthy)):
+        bot.plan_reminder(None, chat_id, reminder, now, missed)
+    assert missed == []
+    assert scheduled_at(broken) is None and scheduled_at(looping) is None
+    assert scheduled_at(healthy) == healthy.next_fire
+    # испорченные напоминания остаются в списке чата, чтобы их можно было удалить
+    assert bot.user_reminders[1] == [broken, looping]